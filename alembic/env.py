@@ -19,6 +19,7 @@ if config.config_file_name is not None:
 # from myapp import mymodel
 # target_metadata = mymodel.Base.metadata
 from app.db import Base
+from app import schemas  # noqa: F401 registers the models on Base
 
 target_metadata = Base.metadata
 
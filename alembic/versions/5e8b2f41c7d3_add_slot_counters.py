@@ -0,0 +1,50 @@
+"""add slot counters
+
+Revision ID: 5e8b2f41c7d3
+Revises: 3c1d9a7e5b42
+Create Date: 2026-10-18 10:03:18.552917
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5e8b2f41c7d3'
+down_revision: Union[str, Sequence[str], None] = '3c1d9a7e5b42'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.batch_alter_table('slots') as batch_op:
+        batch_op.add_column(sa.Column('active_count', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('emergency_count', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('version', sa.Integer(), nullable=False, server_default='0'))
+
+    # Backfill from the tokens currently seated in each slot
+    op.execute(
+        """
+        UPDATE slots SET
+            active_count = (
+                SELECT COUNT(*) FROM tokens
+                WHERE tokens.slot_id = slots.id AND tokens.status = 'active'
+            ),
+            emergency_count = (
+                SELECT COUNT(*) FROM tokens
+                WHERE tokens.slot_id = slots.id AND tokens.status = 'active'
+                AND tokens.source = 'emergency'
+            )
+        """
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('slots') as batch_op:
+        batch_op.drop_column('version')
+        batch_op.drop_column('emergency_count')
+        batch_op.drop_column('active_count')
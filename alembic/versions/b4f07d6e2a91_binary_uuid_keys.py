@@ -0,0 +1,105 @@
+"""store uuid keys as 16-byte binary
+
+Revision ID: b4f07d6e2a91
+Revises: 5e8b2f41c7d3
+Create Date: 2026-10-18 11:27:54.904316
+
+"""
+import uuid
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b4f07d6e2a91'
+down_revision: Union[str, Sequence[str], None] = '5e8b2f41c7d3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+KEY_COLUMNS = {
+    'doctors': ['id'],
+    'slots': ['id', 'doctor_id'],
+    'tokens': ['id', 'doctor_id', 'slot_id'],
+}
+
+NULLABLE = {('tokens', 'slot_id')}
+
+BATCH_SIZE = 5000
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        if len(value) == 16:
+            return value
+        value = value.decode()
+    return uuid.UUID(value).bytes
+
+
+def _to_text(value):
+    if isinstance(value, str):
+        return value
+    return str(uuid.UUID(bytes=value))
+
+
+def _convert(table, column, convert):
+    """Rewrite every value of a key column in place, in rowid batches."""
+    bind = op.get_bind()
+    last_rowid = 0
+    while True:
+        rows = bind.execute(
+            sa.text(
+                f'SELECT rowid, {column} FROM {table} '
+                f'WHERE rowid > :last AND {column} IS NOT NULL '
+                f'ORDER BY rowid LIMIT :limit'
+            ),
+            {'last': last_rowid, 'limit': BATCH_SIZE},
+        ).fetchall()
+        if not rows:
+            return
+        bind.execute(
+            sa.text(f'UPDATE {table} SET {column} = :value WHERE rowid = :rowid'),
+            [{'value': convert(value), 'rowid': rowid} for rowid, value in rows],
+        )
+        last_rowid = rows[-1][0]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # SQLite keeps whatever is stored, so convert values before the table copy
+    for table, columns in KEY_COLUMNS.items():
+        for column in columns:
+            _convert(table, column, _to_bytes)
+        with op.batch_alter_table(table) as batch_op:
+            for column in columns:
+                batch_op.alter_column(
+                    column,
+                    existing_type=sa.String(length=36),
+                    type_=sa.LargeBinary(length=16),
+                    existing_nullable=(table, column) in NULLABLE,
+                )
+
+    op.create_index('ix_slots_doctor_id', 'slots', ['doctor_id'])
+    op.create_index('ix_tokens_doctor_id', 'tokens', ['doctor_id'])
+    op.create_index('ix_tokens_slot_id', 'tokens', ['slot_id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_tokens_slot_id', table_name='tokens')
+    op.drop_index('ix_tokens_doctor_id', table_name='tokens')
+    op.drop_index('ix_slots_doctor_id', table_name='slots')
+
+    for table, columns in KEY_COLUMNS.items():
+        for column in columns:
+            _convert(table, column, _to_text)
+        with op.batch_alter_table(table) as batch_op:
+            for column in columns:
+                batch_op.alter_column(
+                    column,
+                    existing_type=sa.LargeBinary(length=16),
+                    type_=sa.String(length=36),
+                    existing_nullable=(table, column) in NULLABLE,
+                )
@@ -0,0 +1,45 @@
+"""add tokens archive
+
+Revision ID: c2a6e93f0d15
+Revises: b4f07d6e2a91
+Create Date: 2026-10-18 13:05:11.730482
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c2a6e93f0d15'
+down_revision: Union[str, Sequence[str], None] = 'b4f07d6e2a91'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('tokens_archive',
+    sa.Column('id', sa.LargeBinary(length=16), nullable=False),
+    sa.Column('doctor_id', sa.LargeBinary(length=16), nullable=False),
+    sa.Column('slot_id', sa.LargeBinary(length=16), nullable=True),
+    sa.Column('source', sa.Enum('online', 'walk_in', 'paid', 'follow_up', 'emergency', name='tokensource'), nullable=False),
+    sa.Column('status', sa.Enum('active', 'cancelled', 'served', 'no_show', 'displaced', 'waiting', name='tokenstatus'), nullable=False),
+    sa.Column('priority', sa.Integer(), nullable=True),
+    sa.Column('patient_name', sa.String(), nullable=False),
+    sa.Column('patient_contact', sa.String(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.Column('archived_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_tokens_archive_doctor_id', 'tokens_archive', ['doctor_id'])
+    op.create_index('ix_tokens_archive_created_at', 'tokens_archive', ['created_at'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_tokens_archive_created_at', table_name='tokens_archive')
+    op.drop_index('ix_tokens_archive_doctor_id', table_name='tokens_archive')
+    op.drop_table('tokens_archive')
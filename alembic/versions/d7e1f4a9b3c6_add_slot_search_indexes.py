@@ -0,0 +1,35 @@
+"""add slot search indexes
+
+Revision ID: d7e1f4a9b3c6
+Revises: c2a6e93f0d15
+Create Date: 2026-10-18 15:42:07.318254
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd7e1f4a9b3c6'
+down_revision: Union[str, Sequence[str], None] = 'c2a6e93f0d15'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Both replace a single-column index that is a prefix of the new one
+    op.drop_index('ix_slots_doctor_id', table_name='slots')
+    op.create_index('ix_slots_doctor_date_start', 'slots', ['doctor_id', 'date', 'start_time', 'capacity', 'active_count', 'emergency_count', 'id'])
+    op.drop_index('ix_tokens_slot_id', table_name='tokens')
+    op.create_index('ix_tokens_slot_status_priority', 'tokens', ['slot_id', 'status', 'priority'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_tokens_slot_status_priority', table_name='tokens')
+    op.create_index('ix_tokens_slot_id', 'tokens', ['slot_id'])
+    op.drop_index('ix_slots_doctor_date_start', table_name='slots')
+    op.create_index('ix_slots_doctor_id', 'slots', ['doctor_id'])
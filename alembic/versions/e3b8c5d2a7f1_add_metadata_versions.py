@@ -0,0 +1,36 @@
+"""add metadata versions
+
+Revision ID: e3b8c5d2a7f1
+Revises: d7e1f4a9b3c6
+Create Date: 2026-10-19 10:21:36.540912
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e3b8c5d2a7f1'
+down_revision: Union[str, Sequence[str], None] = 'd7e1f4a9b3c6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    table = op.create_table('metadata_versions',
+    sa.Column('name', sa.String(length=32), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(table, [
+        {'name': 'doctors', 'version': 0},
+        {'name': 'slots', 'version': 0},
+    ])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('metadata_versions')
@@ -0,0 +1,176 @@
+"""
+Admission control for token allocation.
+
+Bounds the number of allocations running at once. Requests beyond that wait in
+a queue ordered by source priority, so an emergency is admitted before any
+queued online booking. Each source may also have a token-bucket rate limit.
+When the queue is full the lowest-priority request is shed, and shed requests
+are answered with 429 and a Retry-After estimate.
+"""
+
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Tuple
+from app.models import AdmissionStats, TokenPriority, TokenSource
+from app.settings import settings
+
+
+class AdmissionRejected(Exception):
+    """The request was shed, retry after `retry_after` seconds."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Take one token. Returns 0 on success, else seconds until one is free."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class AdmissionController:
+    """
+    Runs on the event loop, so its state needs no lock. Waiters are a heap of
+    (priority, arrival, source, future).
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int,
+        queue_size: int,
+        rate_limits: Dict[str, float],
+    ):
+        self.max_in_flight = max_in_flight
+        self.queue_size = queue_size
+        self.buckets = {
+            TokenSource(source): TokenBucket(rate, max(rate, 1.0))
+            for source, rate in rate_limits.items()
+            if rate > 0
+        }
+        self.in_flight = 0
+        self.admitted: Counter = Counter()
+        self.shed: Counter = Counter()
+        self.rate_limited: Counter = Counter()
+        self._waiters: List[Tuple[int, int, TokenSource, asyncio.Future]] = []
+        self._arrivals = itertools.count()
+        # moving average of the time an admitted request holds its seat
+        self._service_seconds = 0.05
+
+    @asynccontextmanager
+    async def admit(self, source: TokenSource) -> AsyncIterator[None]:
+        """Hold one in-flight seat for the body of the block."""
+        self._check_rate(source)
+        await self._acquire(source)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            self._service_seconds += 0.1 * (elapsed - self._service_seconds)
+            self._release()
+
+    def stats(self) -> AdmissionStats:
+        queued = Counter(source.value for _, _, source, _ in self._waiters)
+        return AdmissionStats(
+            in_flight=self.in_flight,
+            max_in_flight=self.max_in_flight,
+            queue_size=self.queue_size,
+            queued={s.value: queued[s.value] for s in TokenSource},
+            admitted={s.value: self.admitted[s] for s in TokenSource},
+            shed={s.value: self.shed[s] for s in TokenSource},
+            rate_limited={s.value: self.rate_limited[s] for s in TokenSource},
+        )
+
+    def _check_rate(self, source: TokenSource) -> None:
+        bucket = self.buckets.get(source)
+        if bucket is None:
+            return
+        wait = bucket.take()
+        if wait:
+            self.rate_limited[source] += 1
+            raise AdmissionRejected(
+                f"Rate limit exceeded for {source.value} requests",
+                math.ceil(wait),
+            )
+
+    async def _acquire(self, source: TokenSource) -> None:
+        if self.in_flight < self.max_in_flight and not self._waiters:
+            self.in_flight += 1
+            self.admitted[source] += 1
+            return
+
+        entry = (_priority(source), next(self._arrivals), source, _new_future())
+        heapq.heappush(self._waiters, entry)
+        if len(self._waiters) > self.queue_size:
+            self._shed(max(self._waiters))
+
+        future = entry[3]
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the seat was handed over just as the client went away
+                self._release()
+            else:
+                self._remove(entry)
+            raise
+        self.admitted[source] += 1
+
+    def _release(self) -> None:
+        while self._waiters:
+            future = heapq.heappop(self._waiters)[3]
+            if not future.done():
+                # hand the seat over, in_flight stays the same
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def _shed(self, entry: Tuple[int, int, TokenSource, asyncio.Future]) -> None:
+        self._remove(entry)
+        self.shed[entry[2]] += 1
+        entry[3].set_exception(
+            AdmissionRejected("Server busy, request shed", self._retry_after())
+        )
+
+    def _remove(self, entry: Tuple[int, int, TokenSource, asyncio.Future]) -> None:
+        if entry in self._waiters:
+            self._waiters.remove(entry)
+            heapq.heapify(self._waiters)
+
+    def _retry_after(self) -> int:
+        """Seconds until the current queue should have drained."""
+        backlog = (len(self._waiters) + 1) / self.max_in_flight
+        return max(1, math.ceil(backlog * self._service_seconds))
+
+
+def _priority(source: TokenSource) -> int:
+    return TokenPriority[source.name.upper()]
+
+
+def _new_future() -> asyncio.Future:
+    return asyncio.get_running_loop().create_future()
+
+
+admission_controller = AdmissionController(
+    max_in_flight=settings.admission_max_in_flight,
+    queue_size=settings.admission_queue_size,
+    rate_limits=settings.admission_rate_limits,
+)
@@ -1,23 +1,63 @@
-from datetime import datetime, time, UTC, date
+import uuid
+from types import SimpleNamespace
+from datetime import datetime, time, timedelta, UTC, date
 from typing import List, Optional
+import time as timer
+from app import clock
+from app.capture import captured
+from app.contention import contention
 from app.crud.doctor import DoctorCRUD
 from app.crud.slot import SlotCRUD
 from app.crud.token import TokenCRUD
-from app.models import TokenCreate, TokenSource, TokenStatus
-from app.schemas import Doctor, Slot, Token
+from app.models import (
+    RescheduledToken,
+    RescheduleRequest,
+    RescheduleResponse,
+    TokenCreate,
+    TokenSource,
+    TokenStatus,
+)
+from app.policies import AllocationPolicy, allocation_policy
+from sqlalchemy.engine import Row
+from sqlalchemy.exc import OperationalError
+from app.events import QUEUE_CHANGED, SLOT_CHANGED, TOKENS_CHANGED, event_bus
+from app.metadata_cache import metadata_cache
+from app.schemas import Slot, Token
 from app.settings import settings
+from app.specialization_index import specialization_index
+from app.tracing import NULL_TRACE, tracer
+
+# Slots tried per auto-assign before giving up, more only fail on races
+MAX_CANDIDATES = 20
 
 
 class AllocationService:
     def __init__(
-        self, doctor_crud: DoctorCRUD, slot_crud: SlotCRUD, token_crud: TokenCRUD
+        self,
+        doctor_crud: DoctorCRUD,
+        slot_crud: SlotCRUD,
+        token_crud: TokenCRUD,
+        policy: Optional[AllocationPolicy] = None,
     ):
         self.doctor_crud = doctor_crud
         self.slot_crud = slot_crud
         self.token_crud = token_crud
-
+        self.db = slot_crud.db_session
+        self.policy = policy or allocation_policy
+        # slots, doctor queues and tokens changed in the open transaction
+        self._changed_slots = set()
+        self._changed_doctors = set()
+        self._changed_tokens = []
+        # decision trace of the request in progress
+        self._trace = NULL_TRACE
+        # kind and start of the open transaction, and the slots it has
+        # written with (doctor_id, first write) for the contention stats
+        self._transaction = ("", 0.0)
+        self._written = {}
+
+    @captured("allocate")
     def allocate_token(self, token_request):
-        now = datetime.now(UTC)
+        now = clock.now()
 
         request_date = (
             token_request.date.date()
@@ -25,187 +65,631 @@ class AllocationService:
             else token_request.date
         )
 
-        incoming_priority = self._priority(token_request.source)
-
-        with self.db.begin():
+        incoming_priority = self.policy.priority(token_request.source)
+        trace = self._trace = tracer.start(
+            "allocate", token_request.doctor_id, token_request
+        )
+        self._transaction = ("allocate", timer.perf_counter())
 
+        try:
             # ---------- Explicit slot ----------
             if token_request.slot_id:
-                slot = self.slot_crud.get_slot_with_lock(token_request.slot_id)
+                slot = metadata_cache.slot(self.db, token_request.slot_id)
                 if not slot:
                     raise Exception("Slot not found")
+                trace.step("explicit_slot", slot_id=slot.id)
 
                 if request_date == now.date() and slot.start_time <= now.time():
                     raise Exception("Slot already started")
 
-                active_tokens = self.token_crud.get_active_tokens_for_slot_ordered(
-                    slot.id
+                token_request = self._for_doctor(token_request, slot.doctor_id)
+                token = self._admit(slot.id, token_request, incoming_priority)
+                if token is None:
+                    raise Exception("Slot full and higher priority exists")
+                self._commit()
+                trace.finish(TokenStatus.active.value)
+                return token
+
+            # ---------- Auto-assign earliest slot in the horizon ----------
+            if not token_request.doctor_id and not token_request.specialization:
+                raise Exception("doctor_id, slot_id or specialization is required")
+            if token_request.search_days > settings.max_search_days:
+                raise Exception(
+                    f"search_days must not exceed {settings.max_search_days}"
                 )
-
-                capacity = slot.capacity
-                emergency_count = sum(
-                    1 for t in active_tokens if t.source == TokenSource.emergency
+            last_date = request_date + timedelta(days=token_request.search_days - 1)
+
+            if not token_request.doctor_id:
+                # Free seats straight from the in-memory index, across doctors
+                indexed = specialization_index.candidates(
+                    self.slot_crud,
+                    token_request.specialization,
+                    request_date,
+                    last_date,
+                    now.replace(tzinfo=None),
+                    token_request.earliest_time,
+                    token_request.latest_time,
                 )
-                capacity += min(emergency_count, settings.max_emergency_overflow)
-
-                # CASE 1: free space
-                if len(active_tokens) < capacity:
-                    token = Token(
-                        doctor_id=token_request.doctor_id,
-                        slot_id=slot.id,
-                        source=token_request.source,
-                        priority=incoming_priority,
-                        status=TokenStatus.active,
-                    )
-                    self.db.add(token)
-                    return token
-
-                # CASE 2: try preemption
-                lowest = active_tokens[-1]  # worst token
-
-                if incoming_priority < lowest.priority:
-                    # displace
-                    lowest.status = TokenStatus.displaced
-                    lowest.slot_id = None
-
-                    token = Token(
-                        doctor_id=token_request.doctor_id,
-                        slot_id=slot.id,
-                        source=token_request.source,
-                        priority=incoming_priority,
-                        status=TokenStatus.active,
+                trace.step("index_candidates", slots=len(indexed))
+                for slot_id, doctor_id in indexed:
+                    token = self._admit(
+                        slot_id,
+                        self._for_doctor(token_request, doctor_id),
+                        incoming_priority,
                     )
-                    self.db.add(token)
+                    if token is not None:
+                        self._commit()
+                        trace.finish(TokenStatus.active.value)
+                        return token
+                    specialization_index.mark_dirty(slot_id)
+
+            # Preemptible slots, or everything the index did not know about
+            candidates = self.slot_crud.find_candidate_slots(
+                token_request.doctor_id and str(token_request.doctor_id),
+                request_date,
+                last_date,
+                now.replace(tzinfo=None),
+                incoming_priority,
+                self.policy.max_emergency_overflow,
+                token_request.earliest_time,
+                token_request.latest_time,
+                specialization=token_request.specialization,
+                limit=MAX_CANDIDATES,
+                preemption=self.policy.allow_preemption,
+            )
+            trace.step("sql_candidates", slots=len(candidates))
+
+            for slot_id, doctor_id in candidates:
+                # a candidate can fill up concurrently, then try the next one
+                token = self._admit(
+                    slot_id,
+                    self._for_doctor(token_request, doctor_id),
+                    incoming_priority,
+                )
+                if token is not None:
+                    self._commit()
+                    trace.finish(TokenStatus.active.value)
                     return token
 
-                # CASE 3: reject / wait
-                raise Exception("Slot full and higher priority exists")
+            raise Exception("No available slot")
+        except Exception as e:
+            self._rollback(e)
+            trace.finish(error=str(e))
+            raise
+
+    def _commit(self) -> None:
+        """Commit, then tell subscribers which slots and queues changed."""
+        self.db.commit()
+        self._trace.step("commit")
+        self._end_transaction(committed=True)
+        slots, self._changed_slots = self._changed_slots, set()
+        doctors, self._changed_doctors = self._changed_doctors, set()
+        tokens, self._changed_tokens = self._changed_tokens, []
+        for slot_id in slots:
+            event_bus.publish(SLOT_CHANGED, slot_id=slot_id)
+        for doctor_id in doctors:
+            event_bus.publish(QUEUE_CHANGED, doctor_id=doctor_id)
+        if tokens:
+            event_bus.publish(TOKENS_CHANGED, tokens=tokens)
+
+    def _rollback(self, error: Optional[Exception] = None) -> None:
+        self.db.rollback()
+        self._changed_slots = set()
+        self._changed_doctors = set()
+        self._changed_tokens = []
+        self._end_transaction(
+            committed=False,
+            busy=isinstance(error, OperationalError) or "busy" in str(error),
+        )
 
-            # ---------- Auto-assign nearest slot ----------
-            slots = self.slot_crud.get_slots_for_doctor_by_date(
-                token_request.doctor_id,
-                request_date,
+    def _write_counters(self, update, slot_id, doctor_id, *args) -> bool:
+        """Run a counter update on the slot, recording its contention."""
+        started = timer.perf_counter()
+        applied = update(slot_id, *args)
+        contention.write(slot_id, doctor_id, timer.perf_counter() - started, applied)
+        if applied and slot_id not in self._written:
+            self._written[slot_id] = (doctor_id, timer.perf_counter())
+        return applied
+
+    def _end_transaction(self, committed: bool, busy: bool = False) -> None:
+        kind, started = self._transaction
+        now = timer.perf_counter()
+        for slot_id, (doctor_id, first_write) in self._written.items():
+            contention.held(slot_id, doctor_id, now - first_write)
+        self._written = {}
+        if kind:
+            contention.transaction(kind, now - started, committed, busy)
+        self._transaction = ("", 0.0)
+
+    @staticmethod
+    def _for_doctor(token_request: TokenCreate, doctor_id) -> TokenCreate:
+        if token_request.doctor_id == doctor_id:
+            return token_request
+        return token_request.model_copy(update={"doctor_id": doctor_id})
+
+    def _admit(
+        self, slot_id: str, token_request: TokenCreate, incoming_priority: int
+    ) -> Optional[Token]:
+        """
+        Seat a token in a slot, preempting the worst active token if needed.
+        Counters are claimed with a compare-and-swap on the slot version, so a
+        concurrent allocation can never push the slot past its capacity.
+        Returns None if the slot is full of equal or better priority tokens.
+        """
+        is_emergency = token_request.source == TokenSource.emergency
+
+        for _ in range(settings.slot_update_max_retries):
+            counters = self.slot_crud.get_slot_counters(slot_id)
+            if counters is None:
+                return None
+            # an incoming emergency takes an overflow seat before displacing
+            seats = self.policy.seats(counters, is_emergency)
+            self._trace.step(
+                "slot",
+                slot_id=slot_id,
+                active_count=counters.active_count,
+                capacity=counters.capacity,
+                emergency_count=counters.emergency_count,
+                seats=seats,
             )
 
-            for slot in slots:
-                if request_date == now.date() and slot.start_time <= now.time():
+            # CASE 1: free space
+            if self.policy.admits(counters, is_emergency):
+                if not self._write_counters(
+                    self.slot_crud.compare_and_swap_counters,
+                    slot_id,
+                    counters.doctor_id,
+                    counters.version,
+                    1,
+                    int(is_emergency),
+                ):
+                    self._trace.step("conflict", slot_id=slot_id)
                     continue
+                self._changed_slots.add(slot_id)
+                return self._add_token(token_request, slot_id, incoming_priority)
 
-                locked_slot = self.slot_crud.get_slot_with_lock(slot.id)
+            # CASE 2: try preemption
+            active_tokens = self.token_crud.get_active_tokens_for_slot_ordered(slot_id)
+            if not active_tokens:
+                return None
 
-                active_tokens = self.token_crud.get_active_tokens_for_slot_ordered(
-                    locked_slot.id
+            lowest = self.policy.victim(active_tokens, incoming_priority)
+            if lowest is None:
+                # CASE 3: reject / wait
+                self._trace.step(
+                    "full",
+                    slot_id=slot_id,
+                    lowest_priority=active_tokens[-1].priority,
                 )
+                return None
 
-                capacity = locked_slot.capacity
-                emergency_count = sum(
-                    1 for t in active_tokens if t.source == TokenSource.emergency
+            emergency_delta = int(is_emergency) - int(
+                lowest.source == TokenSource.emergency
+            )
+            if not self._write_counters(
+                self.slot_crud.compare_and_swap_counters,
+                slot_id,
+                counters.doctor_id,
+                counters.version,
+                0,
+                emergency_delta,
+            ):
+                self._trace.step("conflict", slot_id=slot_id)
+                continue
+
+            self._changed_slots.add(slot_id)
+            # displace
+            if not self.token_crud.transition_tokens(
+                [lowest.id],
+                [TokenStatus.active],
+                status=TokenStatus.displaced,
+                slot_id=None,
+            ):
+                raise Exception("Slot is busy, please retry")
+            self._changed_tokens.append(
+                (
+                    lowest.id,
+                    lowest.doctor_id,
+                    None,
+                    TokenStatus.displaced,
+                    lowest.priority,
+                    lowest.created_at,
                 )
-                capacity += min(emergency_count, settings.max_emergency_overflow)
-
-                if len(active_tokens) < capacity:
-                    token = Token(
-                        doctor_id=token_request.doctor_id,
-                        slot_id=locked_slot.id,
-                        source=token_request.source,
-                        priority=incoming_priority,
-                        status=TokenStatus.active,
-                    )
-                    self.db.add(token)
-                    return token
-
-                # Try preemption in auto mode as well
-                lowest = active_tokens[-1]
-                if incoming_priority < lowest.priority:
-                    lowest.status = TokenStatus.displaced
-                    lowest.slot_id = None
-
-                    token = Token(
-                        doctor_id=token_request.doctor_id,
-                        slot_id=locked_slot.id,
-                        source=token_request.source,
-                        priority=incoming_priority,
-                        status=TokenStatus.active,
-                    )
-                    self.db.add(token)
-                    return token
-
-            raise Exception("No available slot")
+            )
+            self._trace.step(
+                "preempt",
+                slot_id=slot_id,
+                displaced=lowest.id,
+                displaced_priority=lowest.priority,
+                priority=incoming_priority,
+            )
+            self._trace.token(lowest.id)
+            return self._add_token(token_request, slot_id, incoming_priority)
+
+        contention.busy(slot_id, counters.doctor_id)
+        raise Exception("Slot is busy, please retry")
+
+    def _add_token(
+        self, token_request: TokenCreate, slot_id: str, incoming_priority: int
+    ) -> Token:
+        token = Token(
+            # set here rather than on flush so the trace and the queue
+            # positions know the token without reloading it
+            id=uuid.uuid4(),
+            doctor_id=str(token_request.doctor_id),
+            slot_id=slot_id,
+            source=token_request.source,
+            priority=incoming_priority,
+            status=TokenStatus.active,
+            patient_name=token_request.patient_name,
+            patient_contact=token_request.patient_contact,
+            created_at=clock.now(),
+        )
+        self.db.add(token)
+        self._changed_doctors.add(token.doctor_id)
+        self._changed_tokens.append(
+            (
+                token.id,
+                token.doctor_id,
+                slot_id,
+                TokenStatus.active,
+                incoming_priority,
+                token.created_at,
+            )
+        )
+        self._trace.step("seated", slot_id=slot_id, token_id=token.id)
+        self._trace.token(token.id, token_request.doctor_id)
+        return token
 
+    @captured("cancel")
     def cancel_token(self, token_id: str) -> bool:
         """Cancel a token and reallocate if possible."""
-        token = self.token_crud.get_token(token_id)
-        if not token or token.status != TokenStatus.active:
-            return False
-
-        self.token_crud.update_token_status(token_id, TokenStatus.cancelled)
-
-        # Reallocate for the slot
-        if token.slot_id:
-            self._reallocate_for_slot(token.slot_id)
-        return True
+        return self._release_token(token_id, TokenStatus.cancelled, reallocate=True)
 
+    @captured("no_show")
     def mark_no_show(self, token_id: str) -> bool:
         """Mark token as no-show and reallocate."""
-        token = self.token_crud.get_token(token_id)
-        if not token or token.status != TokenStatus.active:
-            return False
-
-        self.token_crud.update_token_status(token_id, TokenStatus.no_show)
-
-        # Reallocate for the slot
-        if token.slot_id:
-            self._reallocate_for_slot(token.slot_id)
-        return True
+        return self._release_token(token_id, TokenStatus.no_show, reallocate=True)
 
+    @captured("serve")
     def serve_token(self, token_id: str) -> bool:
         """Mark token as served."""
-        token = self.token_crud.get_token(token_id)
-        if not token or token.status != TokenStatus.active:
-            return False
-
-        self.token_crud.update_token_status(token_id, TokenStatus.served)
-        return True
+        return self._release_token(token_id, TokenStatus.served, reallocate=False)
+
+    @captured("serve_many")
+    def serve_tokens(self, token_ids: List[str]) -> List[uuid.UUID]:
+        """Mark tokens as served, returns those that were active."""
+        return self._release_tokens(token_ids, TokenStatus.served, reallocate=False)
+
+    @captured("no_show_many")
+    def mark_no_shows(self, token_ids: List[str]) -> List[uuid.UUID]:
+        """Mark tokens as no-show and reallocate, returns those that were active."""
+        return self._release_tokens(token_ids, TokenStatus.no_show, reallocate=True)
+
+    def _release_token(
+        self, token_id: str, status: TokenStatus, reallocate: bool
+    ) -> bool:
+        """Move an active token to a final status and free its seat."""
+        return bool(self._release_tokens([token_id], status, reallocate))
+
+    def _release_tokens(
+        self, token_ids: List[str], status: TokenStatus, reallocate: bool
+    ) -> List[uuid.UUID]:
+        """
+        Move active tokens to a final status and free their seats. The
+        conditional UPDATE ... RETURNING both checks that a token is still
+        active and reads the slot it leaves, nothing is loaded beforehand.
+        """
+        trace = self._trace = tracer.start(
+            status.value, request={"token_ids": token_ids}
+        )
+        self._transaction = (status.value, timer.perf_counter())
+        try:
+            released = self.token_crud.transition_token_rows(
+                token_ids, [TokenStatus.active], status=status
+            )
+            if not released:
+                self._rollback()
+                trace.finish(error="Token not found or not active")
+                return []
+
+            # slot_id -> [doctor_id, tokens, emergencies]
+            seats = {}
+            for token in released:
+                self._changed_doctors.add(token.doctor_id)
+                self._changed_tokens.append(
+                    (token.id, token.doctor_id, token.slot_id, status, None, None)
+                )
+                trace.token(token.id, token.doctor_id)
+                if token.slot_id:
+                    freed = seats.setdefault(token.slot_id, [token.doctor_id, 0, 0])
+                    freed[1] += 1
+                    freed[2] += token.source == TokenSource.emergency
+            # in key order, so concurrent bulk releases lock slots alike
+            for slot_id in sorted(seats, key=lambda slot_id: slot_id.bytes):
+                doctor_id, count, emergencies = seats[slot_id]
+                self._write_counters(
+                    self.slot_crud.release_seats,
+                    slot_id,
+                    doctor_id,
+                    count,
+                    emergencies,
+                )
+                self._changed_slots.add(slot_id)
+                trace.step("released", slot_id=slot_id, tokens=count)
+                if reallocate:
+                    self._reallocate_for_slot(slot_id)
+            self._commit()
+            trace.finish(status.value)
+            return [token.id for token in released]
+        except Exception as e:
+            self._rollback(e)
+            trace.finish(error=str(e))
+            raise
 
     def _reallocate_for_slot(self, slot_id: str) -> None:
         """
         Reallocate waiting / displaced tokens into a slot.
-        Atomic, locked, priority-aware.
+        Runs inside the caller's transaction, priority-aware.
         """
+        self.db.flush()
 
-        with self.db.begin():
-
-            slot = self.slot_crud.get_slot_with_lock(slot_id)
-            if not slot:
+        for _ in range(settings.slot_update_max_retries):
+            counters = self.slot_crud.get_slot_counters(slot_id)
+            if not counters:
                 return
 
-            active_tokens = self.token_crud.get_active_tokens_for_slot_ordered(slot_id)
-
-            capacity = slot.capacity
-            emergency_count = sum(
-                1 for t in active_tokens if t.source == TokenSource.emergency
-            )
-            capacity += min(emergency_count, settings.max_emergency_overflow)
-
-            available = capacity - len(active_tokens)
+            available = self.policy.seats(counters) - counters.active_count
             if available <= 0:
                 return
 
-            slot_date = slot.date if isinstance(slot.date, date) else slot.date.date()
+            slot_date = (
+                counters.date.date()
+                if isinstance(counters.date, datetime)
+                else counters.date
+            )
 
-            # waiting + displaced, ordered by priority then time
+            # waiting + displaced, by priority then time unless the policy
+            # reorders them, then all of them are needed to pick from
+            reorders = self.policy.reorders_waiting
             candidates = self.token_crud.get_reallocatable_tokens_for_doctor_by_date(
-                slot.doctor_id,
+                counters.doctor_id,
                 slot_date,
+                limit=None if reorders else available,
+            )
+            if reorders:
+                candidates = self.policy.waiting_order(
+                    candidates, clock.now().replace(tzinfo=None)
+                )[:available]
+            if not candidates:
+                self._trace.step("reallocate", slot_id=slot_id, free=available)
+                return
+
+            emergency_count = sum(
+                1 for t in candidates if t.source == TokenSource.emergency
             )
+            if not self._write_counters(
+                self.slot_crud.compare_and_swap_counters,
+                slot_id,
+                counters.doctor_id,
+                counters.version,
+                len(candidates),
+                emergency_count,
+            ):
+                continue
 
+            promoted = self.token_crud.transition_tokens(
+                [token.id for token in candidates],
+                [TokenStatus.waiting, TokenStatus.displaced],
+                status=TokenStatus.active,
+                slot_id=slot_id,
+            )
+            if promoted != len(candidates):
+                # promoted into another slot meanwhile, the seats are counted
+                raise Exception("Slot is busy, please retry")
             for token in candidates:
-                if available <= 0:
-                    break
+                self._trace.token(token.id)
+                self._changed_tokens.append(
+                    (
+                        token.id,
+                        token.doctor_id,
+                        slot_id,
+                        TokenStatus.active,
+                        token.priority,
+                        token.created_at,
+                    )
+                )
+            self._changed_doctors.add(counters.doctor_id)
+            self._trace.step(
+                "reallocate",
+                slot_id=slot_id,
+                free=available,
+                promoted=[token.id for token in candidates],
+            )
+            return
 
-                token.slot_id = slot.id
-                token.status = TokenStatus.active
-                available -= 1
+        contention.busy(slot_id, counters.doctor_id)
+        raise Exception("Slot is busy, please retry")
+
+    @captured("reschedule")
+    def reschedule(self, request: RescheduleRequest) -> RescheduleResponse:
+        """
+        Close a doctor's slots of a day, or some of them, and move their
+        active tokens in one transaction. In priority order each token takes
+        the earliest free seat in the doctor's other slots, then in those of
+        the other doctors of the specialization, within search_days. Tokens
+        left without a seat and booked on the day go on the doctor's waiting
+        list, those booked ahead are cancelled and returned unassigned.
+        Nobody already seated is preempted.
+        """
+        now = clock.now()
+        trace = self._trace = tracer.start("reschedule", request.doctor_id, request)
+        self._transaction = ("reschedule", timer.perf_counter())
+        try:
+            doctor = metadata_cache.doctor(self.db, request.doctor_id)
+            if not doctor:
+                raise Exception("Doctor not found")
+            doctor_id = doctor.id
+            sources = self.slot_crud.get_slot_counters_for_doctor(
+                doctor_id, request.date, request.slot_ids
+            )
+            if request.slot_ids is not None and len(sources) != len(
+                set(request.slot_ids)
+            ):
+                raise Exception("Slot not found")
+            if not sources:
+                raise Exception("No slots to reschedule")
+
+            source_ids = [slot.id for slot in sources]
+            for slot in sources:
+                self._close_slot(slot)
+            # the slots are closed, nobody else can seat a token in them now
+            tokens = self.token_crud.get_active_token_rows_for_slots(source_ids)
+            targets = self.slot_crud.get_reschedule_targets(
+                doctor_id,
+                doctor.specialization,
+                request.date,
+                request.date + timedelta(days=request.search_days - 1),
+                now.replace(tzinfo=None),
+                self.policy.max_emergency_overflow,
+                source_ids,
+            )
+            trace.step("reschedule", tokens=len(tokens), targets=len(targets))
+
+            seated, unseated = self._plan_reschedule(tokens, targets)
+            moved = {}
+            for target, group in seated:
+                self._move_tokens(target, group, source_ids)
+                moved.update((token.id, target) for token in group)
+            # the waiting list of a day only refills tokens booked that day,
+            # tokens booked ahead for it would never get a seat back
+            left = {}
+            for token in unseated:
+                booked_on = token.created_at.date() == request.date
+                status = TokenStatus.waiting if booked_on else TokenStatus.cancelled
+                left.setdefault(status, []).append(token)
+            for status, group in left.items():
+                self.token_crud.transition_tokens(
+                    [token.id for token in group],
+                    [TokenStatus.active],
+                    from_slot_ids=source_ids,
+                    status=status,
+                    slot_id=None,
+                )
+                step = "waitlisted" if status == TokenStatus.waiting else "unassigned"
+                trace.step(step, tokens=[token.id for token in group])
+                self._changed_tokens.extend(
+                    (
+                        token.id,
+                        doctor_id,
+                        None,
+                        status,
+                        token.priority,
+                        token.created_at,
+                    )
+                    for token in group
+                )
+            self._changed_doctors.add(doctor_id)
+            self._commit()
+        except Exception as e:
+            self._rollback(e)
+            trace.finish(error=str(e))
+            raise
+
+        trace.finish("rescheduled")
+        statuses = {
+            token.id: status for status, group in left.items() for token in group
+        }
+        rescheduled = []
+        for token in tokens:
+            target = moved.get(token.id)
+            rescheduled.append(
+                RescheduledToken(
+                    token_id=token.id,
+                    priority=token.priority,
+                    from_slot_id=token.slot_id,
+                    to_slot_id=target and target.id,
+                    doctor_id=target.doctor_id if target else doctor_id,
+                    status=TokenStatus.active if target else statuses[token.id],
+                )
+            )
+        return RescheduleResponse(closed_slot_ids=source_ids, tokens=rescheduled)
+
+    def _close_slot(self, slot) -> None:
+        for _ in range(settings.slot_update_max_retries):
+            if self._write_counters(
+                self.slot_crud.close_slot, slot.id, slot.doctor_id, slot.version
+            ):
+                self._changed_slots.add(slot.id)
+                self._trace.step("closed", slot_id=slot.id, tokens=slot.active_count)
+                return
+            self._trace.step("conflict", slot_id=slot.id)
+            slot = self.slot_crud.get_slot_counters(slot.id)
+        contention.busy(slot.id, slot.doctor_id)
+        raise Exception("Slot is busy, please retry")
+
+    def _plan_reschedule(self, tokens, targets):
+        """
+        Seat tokens, best priority first, in the first target with a seat
+        left for them. Returns [(target, tokens)] and the tokens left over.
+        """
+        targets = [SimpleNamespace(**row._asdict(), tokens=[]) for row in targets]
+        # targets with a seat left at least for an emergency
+        open_targets = list(targets)
+        unseated = []
+        for token in tokens:
+            is_emergency = token.source == TokenSource.emergency
+            for i, target in enumerate(open_targets):
+                if target.active_count < self.policy.seats(target, is_emergency):
+                    target.tokens.append(token)
+                    target.active_count += 1
+                    target.emergency_count += is_emergency
+                    if target.active_count >= self.policy.seats(target, True):
+                        del open_targets[i]
+                    break
+            else:
+                unseated.append(token)
+        seated = [(target, target.tokens) for target in targets if target.tokens]
+        return seated, unseated
+
+    def _move_tokens(self, target, tokens, source_ids) -> None:
+        emergencies = sum(token.source == TokenSource.emergency for token in tokens)
+        if not self._write_counters(
+            self.slot_crud.compare_and_swap_counters,
+            target.id,
+            target.doctor_id,
+            target.version,
+            len(tokens),
+            emergencies,
+        ):
+            # changed since the targets were read, retrying replans all
+            contention.busy(target.id, target.doctor_id)
+            raise Exception("Slot is busy, please retry")
+        token_ids = [token.id for token in tokens]
+        moved = self.token_crud.transition_tokens(
+            token_ids,
+            [TokenStatus.active],
+            from_slot_ids=source_ids,
+            slot_id=target.id,
+            doctor_id=target.doctor_id,
+        )
+        if moved != len(tokens):
+            raise Exception("Slot is busy, please retry")
+        self._changed_slots.add(target.id)
+        self._changed_doctors.add(target.doctor_id)
+        for token in tokens:
+            self._trace.token(token.id)
+            self._changed_tokens.append(
+                (
+                    token.id,
+                    target.doctor_id,
+                    target.id,
+                    TokenStatus.active,
+                    token.priority,
+                    token.created_at,
+                )
+            )
+        self._trace.step("rescheduled", slot_id=target.id, tokens=token_ids)
 
     def get_waiting_list(
         self, doctor_id: str, request_date: Optional[date] = None
@@ -219,18 +703,17 @@ class AllocationService:
 
     def get_slots_for_doctor(
         self, doctor_id: str, request_date: Optional[date] = None
-    ) -> List[Slot]:
+    ) -> List[Row]:
         """Get slots for a doctor, optionally filtered by date."""
-        if request_date:
-            slots = self.slot_crud.get_slots_for_doctor_by_date(doctor_id, request_date)
-        else:
-            slots = self.slot_crud.get_slots_for_doctor(doctor_id)
+        slots = metadata_cache.slots_for_doctor(self.db, doctor_id, request_date)
 
         result = []
-        now = datetime.now(UTC)
+        now = clock.now()
 
         for slot in slots:
-            slot_date = slot.date if isinstance(slot.date, date) else slot.date.date()
+            slot_date = (
+                slot.date.date() if isinstance(slot.date, datetime) else slot.date
+            )
             # Include slots from future dates or future time slots for today
             if slot_date > now.date() or (
                 slot_date == now.date() and slot.start_time >= now.time()
@@ -249,7 +732,26 @@ class AllocationService:
             else:
                 return self.slot_crud.get_all_slots()
     
-    def get_all_doctors(self) -> List[Doctor]:
-        """Get all doctors."""
-        return self.doctor_crud.get_all_doctors()
+    def get_token(self, token_id: str) -> Optional[Token]:
+        """Get a token by ID, including archived tokens."""
+        return self.token_crud.get_token_including_archive(token_id)
+
+    def get_token_history(
+        self, doctor_id: str, date_str: Optional[str]
+    ) -> List[Token]:
+        """Get all tokens of a doctor for a date (default today), live or archived."""
+        if date_str:
+            try:
+                request_date = datetime.strptime(date_str, "%Y-%m-%d").date()
+            except ValueError:
+                raise Exception("Invalid date format. Use YYYY-MM-DD.")
+        else:
+            request_date = datetime.now(UTC).date()
+        return self.token_crud.get_token_history_for_doctor_by_date(
+            doctor_id, request_date
+        )
+
+    def get_all_doctors(self, specialization: Optional[str] = None) -> List[Row]:
+        """Get all doctors, or those of a specialization."""
+        return metadata_cache.doctors(self.db, specialization)
         
\ No newline at end of file
@@ -0,0 +1,241 @@
+"""
+Utilization analytics over token history (live and archived).
+
+Token and slot columns are loaded in bulk into NumPy arrays and aggregated per
+day with bincount instead of walking ORM objects. Tokens count on the day they
+were booked. A past day is closed, and its aggregate cached in-process, once
+none of its tokens is active, waiting or displaced: a token booked ahead
+still changes status on its slot's day, final statuses never change.
+"""
+
+import threading
+import uuid
+from datetime import date, datetime, time, timedelta, UTC
+from typing import Dict, List, Set, Tuple
+import numpy as np
+from app.crud.slot import SlotCRUD
+from app.crud.token import TokenCRUD
+from app.models import AnalyticsResponse, TokenStatus, UtilizationStats
+
+FIELDS = (
+    "tokens",
+    "active",
+    "served",
+    "no_show",
+    "cancelled",
+    "displaced",
+    "wait_seconds",
+    "capacity",
+)
+TOKENS, ACTIVE, SERVED, NO_SHOW, CANCELLED, DISPLACED, WAIT, CAPACITY = range(
+    len(FIELDS)
+)
+GROUPS = ("doctor", "slot", "source")
+# statuses a token leaves later, its booking day is not closed while it has one
+PENDING_STATUSES = (TokenStatus.active, TokenStatus.waiting, TokenStatus.displaced)
+
+# per group: (keys, counts[len(keys), len(FIELDS)])
+DayAggregate = Dict[str, Tuple[np.ndarray, np.ndarray]]
+
+_closed_days: Dict[date, DayAggregate] = {}
+_cache_lock = threading.Lock()
+
+
+class AnalyticsService:
+    def __init__(self, slot_crud: SlotCRUD, token_crud: TokenCRUD):
+        self.slot_crud = slot_crud
+        self.token_crud = token_crud
+
+    def utilization(self, start: date, end: date) -> AnalyticsResponse:
+        """Aggregate per doctor, slot and source for the days [start, end]."""
+        today = datetime.now(UTC).date()
+        days = [start + timedelta(days=n) for n in range((end - start).days + 1)]
+
+        with _cache_lock:
+            aggregates = {d: _closed_days[d] for d in days if d in _closed_days}
+        missing = [d for d in days if d not in aggregates]
+
+        if missing:
+            computed, open_days = self._compute_days(missing[0], missing[-1])
+            for day in missing:
+                aggregates[day] = computed.get(day, _empty_day())
+            with _cache_lock:
+                for day in missing:
+                    if day < today and day not in open_days:
+                        _closed_days[day] = aggregates[day]
+
+        merged = _merge([aggregates[d] for d in days])
+        return AnalyticsResponse(
+            start=start,
+            end=end,
+            by_doctor=_stats(*merged["doctor"], _uuid_key),
+            by_slot=_stats(*merged["slot"], _uuid_key),
+            by_source=_stats(*merged["source"], _str_key),
+        )
+
+    def _compute_days(
+        self, first: date, last: date
+    ) -> Tuple[Dict[date, DayAggregate], Set[date]]:
+        """Aggregates of the days, and the days with tokens that may still change."""
+        start = datetime.combine(first, time.min)
+        end = datetime.combine(last + timedelta(days=1), time.min)
+
+        token_rows = self.token_crud.get_token_columns(start, end)
+        slot_rows = self.slot_crud.get_slot_capacity_columns(start, end)
+
+        doctor, slot, source, status, created, updated = _columns(token_rows, 6)
+        doctor = np.array(doctor, dtype="S16")
+        slot = np.array([s or b"" for s in slot], dtype="S16")
+        source = np.array(source, dtype="U16")
+        status = np.array(status, dtype="U16")
+        created = np.array(created, dtype="datetime64[us]")
+        updated = np.array(updated, dtype="datetime64[us]")
+
+        counts = np.zeros((len(status), len(FIELDS)))
+        counts[:, TOKENS] = 1
+        counts[:, ACTIVE] = status == TokenStatus.active.name
+        counts[:, SERVED] = status == TokenStatus.served.name
+        counts[:, NO_SHOW] = status == TokenStatus.no_show.name
+        counts[:, CANCELLED] = status == TokenStatus.cancelled.name
+        counts[:, DISPLACED] = status == TokenStatus.displaced.name
+        # booking to served, updated_at is the time of the last transition
+        counts[:, WAIT] = np.where(
+            counts[:, SERVED] > 0, (updated - created) / np.timedelta64(1, "s"), 0
+        )
+        token_days = created.astype("datetime64[D]")
+        pending = np.isin(status, [s.name for s in PENDING_STATUSES])
+        open_days = set(np.unique(token_days[pending]).astype(date))
+
+        slot_id, slot_doctor, slot_date, capacity = _columns(slot_rows, 4)
+        slot_id = np.array(slot_id, dtype="S16")
+        slot_doctor = np.array(slot_doctor, dtype="S16")
+        slot_days = np.array(slot_date, dtype="datetime64[D]")
+        capacity_counts = np.zeros((len(slot_id), len(FIELDS)))
+        capacity_counts[:, CAPACITY] = np.array(capacity, dtype=float)
+
+        seated = slot != b""
+        per_group = {
+            "doctor": _by_day(
+                np.concatenate([token_days, slot_days]),
+                np.concatenate([doctor, slot_doctor]),
+                np.concatenate([counts, capacity_counts]),
+            ),
+            "slot": _by_day(
+                np.concatenate([token_days[seated], slot_days]),
+                np.concatenate([slot[seated], slot_id]),
+                np.concatenate([counts[seated], capacity_counts]),
+            ),
+            "source": _by_day(token_days, source, counts),
+        }
+
+        days = set()
+        for grouped in per_group.values():
+            days.update(grouped)
+        aggregates = {
+            day: {
+                group: per_group[group].get(day, _empty_group(group))
+                for group in GROUPS
+            }
+            for day in days
+        }
+        return aggregates, open_days
+
+
+def clear_cache() -> None:
+    with _cache_lock:
+        _closed_days.clear()
+
+
+def _columns(rows: List[Tuple], width: int) -> List[tuple]:
+    return list(zip(*rows)) if rows else [()] * width
+
+
+def _by_day(
+    days: np.ndarray, keys: np.ndarray, counts: np.ndarray
+) -> Dict[date, Tuple[np.ndarray, np.ndarray]]:
+    """Sum counts per (day, key) with one bincount per field."""
+    if len(keys) == 0:
+        return {}
+    day_values, day_index = np.unique(days, return_inverse=True)
+    key_values, key_index = np.unique(keys, return_inverse=True)
+    # compact (day, key) group ids, sorted by day first
+    pairs, group_index = np.unique(
+        day_index.astype(np.int64) * len(key_values) + key_index, return_inverse=True
+    )
+    summed = np.stack(
+        [
+            np.bincount(group_index, weights=counts[:, f], minlength=len(pairs))
+            for f in range(len(FIELDS))
+        ],
+        axis=1,
+    )
+    pair_day, pair_key = np.divmod(pairs, len(key_values))
+    bounds = np.searchsorted(pair_day, np.arange(len(day_values) + 1))
+
+    result = {}
+    for n, day in enumerate(day_values.astype(date)):
+        rows = slice(bounds[n], bounds[n + 1])
+        result[day] = (key_values[pair_key[rows]], summed[rows])
+    return result
+
+
+def _merge(days: List[DayAggregate]) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    merged = {}
+    for group in GROUPS:
+        keys = np.concatenate([day[group][0] for day in days])
+        counts = np.concatenate([day[group][1] for day in days])
+        if len(keys) == 0:
+            merged[group] = _empty_group(group)
+            continue
+        key_values, key_index = np.unique(keys, return_inverse=True)
+        totals = np.zeros((len(key_values), len(FIELDS)))
+        np.add.at(totals, key_index, counts)
+        merged[group] = (key_values, totals)
+    return merged
+
+
+def _stats(keys: np.ndarray, counts: np.ndarray, key_name) -> List[UtilizationStats]:
+    tokens = counts[:, TOKENS]
+    served = counts[:, SERVED]
+    capacity = counts[:, CAPACITY]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        no_show_rate = np.where(tokens > 0, counts[:, NO_SHOW] / tokens, 0.0)
+        preemption_rate = np.where(tokens > 0, counts[:, DISPLACED] / tokens, 0.0)
+        avg_wait = np.where(served > 0, counts[:, WAIT] / served / 60, np.nan)
+        utilization = np.where(
+            capacity > 0, (counts[:, ACTIVE] + served) / capacity, np.nan
+        )
+
+    return [
+        UtilizationStats(
+            key=key_name(keys[n]),
+            tokens=int(tokens[n]),
+            served=int(served[n]),
+            no_show=int(counts[n, NO_SHOW]),
+            cancelled=int(counts[n, CANCELLED]),
+            displaced=int(counts[n, DISPLACED]),
+            capacity=int(capacity[n]),
+            no_show_rate=float(no_show_rate[n]),
+            preemption_rate=float(preemption_rate[n]),
+            avg_wait_minutes=None if np.isnan(avg_wait[n]) else float(avg_wait[n]),
+            utilization=None if np.isnan(utilization[n]) else float(utilization[n]),
+        )
+        for n in range(len(keys))
+    ]
+
+
+def _empty_group(group: str) -> Tuple[np.ndarray, np.ndarray]:
+    dtype = "U16" if group == "source" else "S16"
+    return np.array([], dtype=dtype), np.zeros((0, len(FIELDS)))
+
+
+def _empty_day() -> DayAggregate:
+    return {group: _empty_group(group) for group in GROUPS}
+
+
+def _uuid_key(key: bytes) -> str:
+    return str(uuid.UUID(bytes=bytes(key).ljust(16, b"\0")))
+
+
+def _str_key(key: str) -> str:
+    return str(key)
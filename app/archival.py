@@ -0,0 +1,68 @@
+"""
+Moves finished tokens of past days from `tokens` to `tokens_archive` so the
+live table only holds the current planning horizon.
+
+Run from cron:
+    python -m app.archival
+or in-process by setting `archive_interval_minutes` > 0.
+"""
+
+import asyncio
+import logging
+from datetime import datetime, time, timedelta, UTC
+from app.crud.token import TokenCRUD
+from app.db import SessionLocal
+from app.models import TokenStatus
+from app.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# Waiting and displaced tokens are only reallocated on the day they were
+# created, so once that day is over they are as final as the others
+ARCHIVABLE_STATUSES = [
+    TokenStatus.served,
+    TokenStatus.cancelled,
+    TokenStatus.no_show,
+    TokenStatus.displaced,
+    TokenStatus.waiting,
+]
+
+
+def archive_cutoff(now: datetime = None) -> datetime:
+    """Start of the oldest day that is still kept in the live table."""
+    now = now or datetime.now(UTC)
+    first_live_day = now.date() - timedelta(days=settings.archive_after_days - 1)
+    return datetime.combine(first_live_day, time.min)
+
+
+def archive_finished_tokens(cutoff: datetime = None, batch_size: int = None) -> int:
+    """Archive in batches until nothing is left. Returns tokens moved."""
+    cutoff = cutoff or archive_cutoff()
+    batch_size = batch_size or settings.archive_batch_size
+
+    db = SessionLocal()
+    try:
+        token_crud = TokenCRUD(db)
+        total = 0
+        while True:
+            moved = token_crud.archive_tokens(cutoff, ARCHIVABLE_STATUSES, batch_size)
+            total += moved
+            if moved < batch_size:
+                return total
+    finally:
+        db.close()
+
+
+async def run_periodically(interval_minutes: int) -> None:
+    """Archive on a fixed interval, off the event loop."""
+    while True:
+        try:
+            moved = await asyncio.to_thread(archive_finished_tokens)
+            logger.info("Archived %d tokens", moved)
+        except Exception:
+            logger.exception("Token archival failed")
+        await asyncio.sleep(interval_minutes * 60)
+
+
+if __name__ == "__main__":
+    print(f"Archived {archive_finished_tokens()} tokens")
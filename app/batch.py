@@ -0,0 +1,147 @@
+"""
+Building blocks of long-running batch jobs: the simulation, seeding, imports,
+replays.
+
+A job that keeps one session for its whole run and loads results with .all()
+holds on to everything it has read until it ends, so its memory grows with
+the run. These keep it bounded by the chunk size instead:
+- `chunks` cuts any iterable into lists of at most `size` items
+- `end_chunk` commits and empties the session, nothing loaded or added for a
+  chunk outlives it
+- `stream` reads a select in partitions with yield_per instead of building
+  the whole result. SQLite holds a read lock while the statement is open, so
+  use it for read-only passes, and page with a key for read-then-write ones
+- `MemoryProfile` samples memory at chunk boundaries: the resident set size
+  always, and with tracemalloc on, traced current and peak memory, plus the
+  top allocation sites at the end
+
+`make_service` builds an AllocationService on a job's own session and
+`temp_database` gives a job, replay or benchmark a throwaway SQLite file.
+"""
+
+import os
+import tempfile
+import tracemalloc
+from contextlib import contextmanager
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Row
+from sqlalchemy.orm import Session, sessionmaker
+from app.allocation_service import AllocationService
+from app.crud.doctor import DoctorCRUD
+from app.crud.slot import SlotCRUD
+from app.crud.token import TokenCRUD
+from app.db import Base
+from app.policies import AllocationPolicy
+
+
+def make_service(db: Session, policy: Optional[AllocationPolicy] = None):
+    return AllocationService(DoctorCRUD(db), SlotCRUD(db), TokenCRUD(db), policy)
+
+
+@contextmanager
+def temp_database() -> Iterator[sessionmaker]:
+    """Yield a sessionmaker bound to a fresh SQLite database file."""
+    fd, path = tempfile.mkstemp(suffix=".db", prefix="opd_bench_")
+    os.close(fd)
+    engine = create_engine(
+        f"sqlite:///{path}", connect_args={"check_same_thread": False, "timeout": 30}
+    )
+    Base.metadata.create_all(bind=engine)
+    try:
+        yield sessionmaker(autoflush=False, bind=engine)
+    finally:
+        engine.dispose()
+        os.remove(path)
+
+
+def chunks(items: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(items)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def end_chunk(db: Session) -> None:
+    """Commit the chunk and drop every object it loaded from the session."""
+    db.commit()
+    db.expunge_all()
+
+
+def stream(db: Session, query, batch_size: int) -> Iterator[List[Row]]:
+    """The rows of a select, batch_size at a time."""
+    result = db.execute(query.execution_options(yield_per=batch_size))
+    for partition in result.partitions():
+        yield partition
+        # ORM entities of the partition, columns leave nothing behind
+        db.expunge_all()
+
+
+class MemoryProfile:
+    """Memory of a batch job, sampled at chunk boundaries."""
+
+    def __init__(self, trace: bool = False, top: int = 10):
+        self.trace = trace
+        self.top = top
+        self.samples: List[int] = []
+
+    def __enter__(self) -> "MemoryProfile":
+        if self.trace:
+            tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        if self.trace:
+            tracemalloc.stop()
+
+    def sample(self) -> str:
+        """Record the memory now, and describe it for a progress line."""
+        rss = _rss()
+        parts = []
+        if rss is not None:
+            self.samples.append(rss)
+            parts.append(f"rss {_mb(rss)}")
+        if self.trace:
+            current, peak = tracemalloc.get_traced_memory()
+            parts.append(f"traced {_mb(current)} (peak {_mb(peak)})")
+        return ", ".join(parts)
+
+    def report(self) -> str:
+        """Peak memory, growth over the samples and the top allocation sites."""
+        lines = []
+        if self.samples:
+            lines.append(
+                f"rss first {_mb(self.samples[0])}, last {_mb(self.samples[-1])}, "
+                f"max {_mb(max(self.samples))} over {len(self.samples)} samples"
+            )
+        if self.trace:
+            current, peak = tracemalloc.get_traced_memory()
+            lines.append(f"traced now {_mb(current)}, peak {_mb(peak)}")
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                [
+                    tracemalloc.Filter(False, tracemalloc.__file__),
+                    tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+                ]
+            )
+            lines.append(f"top {self.top} allocation sites:")
+            for stat in snapshot.statistics("lineno")[: self.top]:
+                frame = stat.traceback[0]
+                lines.append(
+                    f"  {_mb(stat.size):>10} {stat.count:9d} blocks  "
+                    f"{frame.filename}:{frame.lineno}"
+                )
+        return "\n".join(lines)
+
+
+def _rss() -> Optional[int]:
+    """Resident set size in bytes, None where /proc is missing."""
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def _mb(size: int) -> str:
+    return f"{size / 2**20:.1f} MB"
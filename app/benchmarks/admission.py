@@ -0,0 +1,175 @@
+"""
+Load test of admission control: emergency latency under an online flood.
+
+    python -m app.benchmarks.admission [--online 3000] [--rate 500]
+
+Starts the API under uvicorn on a throwaway database and floods POST
+/allocation/tokens with online bookings while a separate client books
+emergencies one after another, once without admission control (every request
+goes straight to the thread pool) and once with the configured controller.
+Reports emergency latency percentiles against an idle baseline, plus the status
+codes per source.
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, UTC
+import httpx
+from app.benchmarks.common import seed_doctors_and_slots, temp_database
+from app.settings import settings
+
+NO_ADMISSION = {
+    "ADMISSION_MAX_IN_FLIGHT": str(10**9),
+    "ADMISSION_QUEUE_SIZE": str(10**9),
+    "ADMISSION_RATE_LIMITS": "{}",
+}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(database_url: str, port: int, env: dict) -> subprocess.Popen:
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:server", "--port", str(port)],
+        env={**os.environ, **env, "DATABASE_URL": database_url},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    for _ in range(100):
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/health")
+            return server
+        except httpx.TransportError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("server did not start")
+
+
+def probe_emergencies(base_url, doctor_ids, day, count: int, gap: float, out):
+    """Book emergencies one after another from a thread with its own client."""
+    with httpx.Client(base_url=base_url, timeout=None) as client:
+        for n in range(count):
+            started = time.perf_counter()
+            response = client.post(
+                "/allocation/tokens",
+                json=booking(doctor_ids[n % len(doctor_ids)], day, "emergency", n),
+            )
+            out.append((time.perf_counter() - started, response.status_code))
+            time.sleep(gap)
+
+
+def booking(doctor_id, day, source: str, n: int) -> dict:
+    return {
+        "doctor_id": str(doctor_id),
+        "slot_id": None,
+        "date": f"{day}T00:00:00",
+        "source": source,
+        "patient_name": f"Patient {n}",
+        "patient_contact": "0000000000",
+    }
+
+
+async def flood(base_url, doctor_ids, day, online: int, rate: float) -> Counter:
+    """Send online bookings at a fixed rate without waiting for responses."""
+    statuses = Counter()
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+
+    async def book(client, n):
+        body = booking(doctor_ids[n % len(doctor_ids)], day, "online", n)
+        try:
+            response = await client.post("/allocation/tokens", json=body)
+            statuses["online", response.status_code] += 1
+        except httpx.TransportError as e:
+            statuses["online", type(e).__name__] += 1
+
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=None
+    ) as client:
+        tasks = []
+        for n in range(online):
+            tasks.append(asyncio.create_task(book(client, n)))
+            await asyncio.sleep(1 / rate)
+        await asyncio.gather(*tasks)
+    return statuses
+
+
+def run(base_url, doctor_ids, day, args, online: int):
+    emergencies = []
+    prober = threading.Thread(
+        target=probe_emergencies,
+        args=(base_url, doctor_ids, day, args.emergencies, args.gap_ms / 1000),
+        kwargs={"out": emergencies},
+    )
+    prober.start()
+    statuses = asyncio.run(flood(base_url, doctor_ids, day, online, args.rate))
+    prober.join()
+    for _, status in emergencies:
+        statuses["emergency", status] += 1
+    return [latency for latency, _ in emergencies], statuses
+
+
+def report(label: str, latencies, statuses) -> None:
+    ordered = sorted(latencies)
+    p95 = ordered[int(0.95 * (len(ordered) - 1))]
+    print(
+        f"{label:<22} emergency p50 {statistics.median(ordered) * 1e3:8.1f} ms  "
+        f"p95 {p95 * 1e3:8.1f} ms  max {ordered[-1] * 1e3:8.1f} ms"
+    )
+    for (source, status), count in sorted(statuses.items(), key=str):
+        print(f"    {source:<10} {status}: {count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--online", type=int, default=3000)
+    parser.add_argument("--rate", type=float, default=500, help="online per second")
+    parser.add_argument("--emergencies", type=int, default=100)
+    parser.add_argument("--gap-ms", type=float, default=50)
+    args = parser.parse_args()
+
+    day = datetime.now(UTC).date() + timedelta(days=1)
+    runs = {
+        "idle": (NO_ADMISSION, 0),
+        "flood, no admission": (NO_ADMISSION, args.online),
+        "flood, admission": ({}, args.online),
+    }
+    print(
+        f"{args.online} online bookings at {args.rate:.0f}/s, {args.emergencies} "
+        f"emergencies {args.gap_ms:.0f} ms apart, max_in_flight="
+        f"{settings.admission_max_in_flight}, queue={settings.admission_queue_size}"
+    )
+    for label, (env, online) in runs.items():
+        with temp_database() as Session:
+            session = Session()
+            doctors = seed_doctors_and_slots(
+                session, doctors=4, slots_per_day=8, capacity=10**6
+            )
+            doctor_ids = [d.id for d in doctors]
+            database_url = str(session.get_bind().url)
+            session.close()
+
+            port = free_port()
+            server = start_server(database_url, port, env)
+            try:
+                latencies, statuses = run(
+                    f"http://127.0.0.1:{port}", doctor_ids, day, args, online
+                )
+            finally:
+                server.terminate()
+                server.wait()
+            report(label, latencies, statuses)
+
+
+if __name__ == "__main__":
+    main()
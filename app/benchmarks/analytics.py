@@ -0,0 +1,65 @@
+"""
+Time the vectorized utilization analytics over a year of token history.
+
+    python -m app.benchmarks.analytics [--days 365] [--tokens-per-day 1000]
+
+Reports a cold run (everything loaded from the database) and a warm run where
+all closed days come from the per-day cache.
+"""
+
+import argparse
+import random
+import time as clock
+from datetime import datetime, time, timedelta, UTC
+from sqlalchemy import select
+from app import analytics
+from app.analytics import AnalyticsService
+from app.archival import ARCHIVABLE_STATUSES
+from app.benchmarks.archival import insert_day
+from app.benchmarks.common import seed_doctors_and_slots, temp_database
+from app.crud.slot import SlotCRUD
+from app.crud.token import TokenCRUD
+from app.schemas import Slot
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--tokens-per-day", type=int, default=1000)
+    args = parser.parse_args()
+
+    rng = random.Random(3)
+    today = datetime.now(UTC).date()
+    first = today - timedelta(days=args.days - 1)
+
+    with temp_database() as Session:
+        db = Session()
+        doctors = seed_doctors_and_slots(db, doctors=20, slots_per_day=4)
+        doctor_ids = [d.id for d in doctors]
+        slot_ids = db.scalars(select(Slot.id)).all()
+        token_crud = TokenCRUD(db)
+
+        for n in range(args.days):
+            day = datetime.combine(first + timedelta(days=n), time.min)
+            insert_day(db, day, doctor_ids, slot_ids, args.tokens_per_day, rng)
+        # half of the year is already archived
+        while token_crud.archive_tokens(
+            datetime.combine(first + timedelta(days=args.days // 2), time.min),
+            ARCHIVABLE_STATUSES,
+            10000,
+        ):
+            pass
+
+        service = AnalyticsService(SlotCRUD(db), token_crud)
+        analytics.clear_cache()
+        for label in ("cold", "warm"):
+            started = clock.perf_counter()
+            report = service.utilization(first, today)
+            elapsed = clock.perf_counter() - started
+            tokens = sum(s.tokens for s in report.by_source)
+            print(f"{label}: {tokens} tokens over {args.days} days in {elapsed:.2f}s")
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Show that live token queries stay flat over a year when finished tokens are
+archived daily, compared with letting the tokens table grow.
+
+    python -m app.benchmarks.archival [--days 365] [--tokens-per-day 1000]
+"""
+
+import argparse
+import random
+import uuid
+from datetime import datetime, time, timedelta, UTC
+from sqlalchemy import func, insert, select
+from app.archival import ARCHIVABLE_STATUSES
+from app.benchmarks.common import seed_doctors_and_slots, temp_database, timed
+from app.crud.token import TokenCRUD
+from app.models import TokenSource, TokenStatus
+from app.schemas import Slot, Token
+
+TERMINAL_MIX = [TokenStatus.served] * 8 + [
+    TokenStatus.cancelled,
+    TokenStatus.no_show,
+    TokenStatus.displaced,
+]
+
+
+def insert_day(db, day: datetime, doctor_ids, slot_ids, tokens: int, rng) -> None:
+    """A finished day: mostly terminal tokens plus a few still waiting."""
+    rows = []
+    for i in range(tokens):
+        status = TokenStatus.waiting if i % 50 == 0 else rng.choice(TERMINAL_MIX)
+        rows.append(
+            {
+                "id": uuid.uuid4(),
+                "doctor_id": rng.choice(doctor_ids),
+                "slot_id": rng.choice(slot_ids),
+                "source": rng.choice(list(TokenSource)),
+                "status": status,
+                "priority": rng.randint(1, 5),
+                "patient_name": f"Patient {i}",
+                "patient_contact": "0000000000",
+                "created_at": day + timedelta(minutes=i % 600),
+                "updated_at": day + timedelta(minutes=i % 600),
+            }
+        )
+    db.execute(insert(Token), rows)
+    db.commit()
+
+
+def run(days: int, tokens_per_day: int, archive: bool, repeat: int) -> list:
+    rng = random.Random(1)
+    samples = []
+    with temp_database() as Session:
+        db = Session()
+        doctors = seed_doctors_and_slots(db, doctors=10, slots_per_day=4)
+        doctor_ids = [d.id for d in doctors]
+        slot_ids = db.scalars(select(Slot.id)).all()
+        token_crud = TokenCRUD(db)
+        start = datetime.combine(datetime.now(UTC).date(), time.min) - timedelta(
+            days=days
+        )
+
+        for n in range(days):
+            day = start + timedelta(days=n)
+            insert_day(db, day, doctor_ids, slot_ids, tokens_per_day, rng)
+            if archive:
+                while token_crud.archive_tokens(
+                    day + timedelta(days=1), ARCHIVABLE_STATUSES, 5000
+                ):
+                    pass
+
+            if (n + 1) % 30 == 0 or n + 1 == days:
+                doctor_id, slot_id = doctor_ids[0], slot_ids[0]
+                waiting = timed(
+                    lambda: token_crud.get_waiting_tokens_for_doctor_by_date(
+                        doctor_id, day.date()
+                    ),
+                    repeat,
+                )
+                active = timed(
+                    lambda: token_crud.get_tokens_for_slot(slot_id), repeat
+                )
+                live = db.scalar(select(func.count()).select_from(Token))
+                samples.append((n + 1, live, waiting, active))
+        db.close()
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--tokens-per-day", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    for archive in (False, True):
+        print(f"\n{'with' if archive else 'without'} daily archival")
+        print(f"{'day':>5} {'live rows':>10} {'waiting list':>14} {'slot active':>13}")
+        for day, live, waiting, active in run(
+            args.days, args.tokens_per_day, archive, args.repeat
+        ):
+            print(
+                f"{day:>5} {live:>10} {waiting * 1e6:>11.0f} us "
+                f"{active * 1e6:>10.0f} us"
+            )
+
+
+if __name__ == "__main__":
+    main()
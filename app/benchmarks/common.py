@@ -0,0 +1,67 @@
+"""
+Helpers shared by the benchmark scripts.
+Every benchmark runs against its own throwaway SQLite file.
+"""
+
+import time
+from datetime import datetime, time as dtime, timedelta, UTC
+from typing import List
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from app.batch import make_service, temp_database  # noqa: F401 re-exported
+from app.schemas import Doctor, Slot
+
+
+def seed_doctors_and_slots(
+    db: Session,
+    doctors: int = 1,
+    slots_per_day: int = 4,
+    days: int = 1,
+    capacity: int = 10,
+    specialization: str = "Cardiology",
+) -> List[Doctor]:
+    """Create doctors with hourly slots starting tomorrow."""
+    first_day = datetime.now(UTC).date() + timedelta(days=1)
+    created = []
+    for d in range(doctors):
+        doctor = Doctor(name=f"Dr. Bench {d}", specialization=specialization)
+        db.add(doctor)
+        db.flush()
+        for day in range(days):
+            slot_date = datetime.combine(first_day + timedelta(days=day), dtime(0, 0))
+            for i in range(slots_per_day):
+                db.add(
+                    Slot(
+                        doctor_id=doctor.id,
+                        start_time=dtime(9 + i, 0),
+                        end_time=dtime(10 + i, 0),
+                        date=slot_date,
+                        capacity=capacity,
+                    )
+                )
+        created.append(doctor)
+    db.commit()
+    return created
+
+
+class RoundTrips:
+    """Statements and commits sent on an engine."""
+
+    def __init__(self, engine):
+        self.statements = self.commits = 0
+        event.listen(engine, "before_cursor_execute", self._statement)
+        event.listen(engine, "commit", self._commit)
+
+    def _statement(self, *args):
+        self.statements += 1
+
+    def _commit(self, *args):
+        self.commits += 1
+
+
+def timed(fn, repeat: int) -> float:
+    """Return the mean seconds per call of fn over repeat calls."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
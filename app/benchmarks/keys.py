@@ -0,0 +1,144 @@
+"""
+Compare 36-char string UUID keys with 16-byte binary keys on the tokens table.
+
+    python -m app.benchmarks.keys [--tokens 2000000]
+
+Builds the same token dataset under both layouts and reports index sizes,
+database file size and primary key / foreign key lookup latency. A slot_id
+lookup returns tokens/5000 ids; binary keys come back as uuid.UUID, string
+keys as str, so it is also timed with the string ids parsed to uuid.UUID as
+the response models do.
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+import uuid
+from sqlalchemy import (
+    Column,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    bindparam,
+    create_engine,
+    select,
+    text,
+)
+from app.schemas import BinaryUUID
+
+BATCH_SIZE = 20000
+
+INDEXES = ("sqlite_autoindex_tokens_1", "ix_tokens_doctor_id", "ix_tokens_slot_id")
+
+
+def tokens_table(key_type) -> Table:
+    return Table(
+        "tokens",
+        MetaData(),
+        Column("id", key_type, primary_key=True),
+        Column("doctor_id", key_type, nullable=False, index=True),
+        Column("slot_id", key_type, nullable=True, index=True),
+        Column("status", String(9), nullable=False),
+        Column("priority", Integer),
+    )
+
+
+def build(path: str, key_type, encode, tokens: int, slots: list, doctors: list):
+    engine = create_engine(f"sqlite:///{path}")
+    table = tokens_table(key_type)
+    table.metadata.create_all(engine)
+    rng = random.Random(42)
+    ids = []
+    with engine.begin() as conn:
+        for start in range(0, tokens, BATCH_SIZE):
+            rows = []
+            for _ in range(min(BATCH_SIZE, tokens - start)):
+                token_id = uuid.uuid4()
+                ids.append(token_id)
+                rows.append(
+                    {
+                        "id": encode(token_id),
+                        "doctor_id": encode(rng.choice(doctors)),
+                        "slot_id": encode(rng.choice(slots)),
+                        "status": "served",
+                        "priority": rng.randint(1, 5),
+                    }
+                )
+            conn.execute(table.insert(), rows)
+    return engine, table, ids
+
+
+def index_sizes(engine) -> dict:
+    with engine.connect() as conn:
+        rows = conn.execute(
+            text("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name")
+        ).fetchall()
+    return dict(rows)
+
+
+def lookup_latency(engine, stmt, keys, decode=None) -> float:
+    with engine.connect() as conn:
+        start = time.perf_counter()
+        for key in keys:
+            values = conn.execute(stmt, {"key": key}).scalars().all()
+            if decode is not None:
+                for value in values:
+                    decode(value)
+        return (time.perf_counter() - start) / len(keys)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--tokens", type=int, default=1_000_000)
+    parser.add_argument("--lookups", type=int, default=20000)
+    args = parser.parse_args()
+
+    doctors = [uuid.uuid4() for _ in range(50)]
+    slots = [uuid.uuid4() for _ in range(5000)]
+    # key type, how keys are bound, how returned keys become uuid.UUID
+    layouts = {
+        "string(36)": (String(36), str, uuid.UUID),
+        "binary(16)": (BinaryUUID, lambda value: value, None),
+    }
+
+    print(f"{args.tokens} tokens, {args.lookups} lookups per query")
+    for name, (key_type, encode, decode) in layouts.items():
+        fd, path = tempfile.mkstemp(suffix=".db", prefix="opd_keys_")
+        os.close(fd)
+        try:
+            engine, table, ids = build(
+                path, key_type, encode, args.tokens, slots, doctors
+            )
+            with engine.begin() as conn:
+                conn.execute(text("VACUUM"))
+            sizes = index_sizes(engine)
+
+            rng = random.Random(7)
+            sample_ids = [encode(rng.choice(ids)) for _ in range(args.lookups)]
+            sample_slots = [encode(rng.choice(slots)) for _ in range(args.lookups)]
+            id_latency = lookup_latency(
+                engine,
+                select(table.c.priority).where(table.c.id == bindparam("key")),
+                sample_ids,
+            )
+            by_slot = select(table.c.id).where(table.c.slot_id == bindparam("key"))
+            slot_latency = lookup_latency(engine, by_slot, sample_slots)
+            uuid_latency = lookup_latency(engine, by_slot, sample_slots, decode)
+            engine.dispose()
+
+            print(f"\n{name}")
+            print(f"  {'db file':<28}{os.path.getsize(path) / 2**20:9.1f} MiB")
+            for index in INDEXES:
+                print(f"  {index:<28}{sizes.get(index, 0) / 2**20:9.1f} MiB")
+            print(f"  {'lookup by id':<28}{id_latency * 1e6:9.1f} us")
+            print(f"  {'lookup by slot_id':<28}{slot_latency * 1e6:9.1f} us")
+            print(f"  {'  ids as uuid.UUID':<28}{uuid_latency * 1e6:9.1f} us")
+        finally:
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Benchmark of the doctor and slot metadata cache.
+
+    python -m app.benchmarks.metadata_cache [--ops 5000] [--doctors 20]
+
+Runs one request mix against a fresh database per configuration: allocations
+into an explicit slot, the doctor list (all and by specialization) and a
+doctor's slots of a day, with a new slot added every --change-every requests
+to invalidate the cache. Configurations:
+1. no cache, every lookup reads the tables as before
+2. cache, versions checked on every lookup (metadata_cache_check_ms = 0)
+3. cache, versions checked at most every 1000 ms (the default)
+and reports statements and time per request of each kind, plus the hit ratio.
+"""
+
+import argparse
+import random
+import time
+from datetime import datetime, time as dtime, UTC
+from sqlalchemy import select
+from app import clock
+from app.benchmarks.common import (
+    RoundTrips,
+    make_service,
+    seed_doctors_and_slots,
+    temp_database,
+)
+from app.crud.slot import SlotCRUD
+from app.metadata_cache import metadata_cache
+from app.models import SlotCreate, TokenCreate, TokenSource
+from app.schemas import Slot
+
+SPECIALIZATIONS = ("Cardiology", "Dermatology", "Orthopedics", "Pediatrics")
+SLOTS_PER_DAY = 8
+CONFIGURATIONS = [
+    ("no cache", False, 0),
+    ("cache, check every lookup", True, 0),
+    ("cache, check every 1000 ms", True, 1000),
+]
+
+
+def seed(Session, doctors: int):
+    db = Session()
+    per_specialization, extra = divmod(doctors, len(SPECIALIZATIONS))
+    for n, specialization in enumerate(SPECIALIZATIONS):
+        seed_doctors_and_slots(
+            db,
+            doctors=per_specialization + (n < extra),
+            slots_per_day=SLOTS_PER_DAY,
+            days=2,
+            capacity=10000,
+            specialization=specialization,
+        )
+    slots = db.execute(select(Slot.id, Slot.doctor_id, Slot.date)).all()
+    db.close()
+    return slots
+
+
+def requests(slots, ops: int, seed: int):
+    """(kind, argument) pairs, the same for every configuration."""
+    rng = random.Random(seed)
+    doctor_ids = sorted({slot.doctor_id for slot in slots})
+    stream = []
+    for _ in range(ops):
+        roll = rng.random()
+        if roll < 0.6:
+            stream.append(("allocate", rng.choice(slots).id))
+        elif roll < 0.7:
+            stream.append(("doctors", None))
+        elif roll < 0.8:
+            stream.append(("doctors", rng.choice(SPECIALIZATIONS)))
+        else:
+            stream.append(("slots", rng.choice(doctor_ids)))
+    return stream
+
+
+def run(Session, stream, day, doctor_id, change_every: int):
+    db = Session()
+    trips = RoundTrips(Session.kw["bind"])
+    service = make_service(db)
+    totals = {}
+    for n, (kind, argument) in enumerate(stream):
+        if change_every and n % change_every == change_every - 1:
+            SlotCRUD(db).create_slot(
+                SlotCreate(
+                    doctor_id=doctor_id,
+                    start_time=dtime(20, 0),
+                    end_time=dtime(21, 0),
+                    capacity=10,
+                ),
+                datetime.combine(day, dtime(0, 0)),
+            )
+        statements = trips.statements
+        started = time.perf_counter()
+        if kind == "allocate":
+            service.allocate_token(
+                TokenCreate(
+                    slot_id=argument,
+                    date=datetime.combine(day, dtime(0, 0)),
+                    source=TokenSource.walk_in,
+                    patient_name="Bench",
+                    patient_contact="0000000000",
+                )
+            )
+        elif kind == "doctors":
+            service.get_all_doctors(argument)
+        else:
+            service.get_slots_for_doctor(argument, day)
+        elapsed = time.perf_counter() - started
+        count, total_statements, total_seconds = totals.get(kind, (0, 0, 0.0))
+        totals[kind] = (
+            count + 1,
+            total_statements + trips.statements - statements,
+            total_seconds + elapsed,
+        )
+    db.close()
+    return {
+        kind: (statements / count, seconds / count * 1e6)
+        for kind, (count, statements, seconds) in totals.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--ops", type=int, default=5000)
+    parser.add_argument("--doctors", type=int, default=20)
+    parser.add_argument("--change-every", type=int, default=2500)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    results = []
+    for name, enabled, check_ms in CONFIGURATIONS:
+        metadata_cache.enabled = enabled
+        metadata_cache.check_interval = check_ms / 1000
+        metadata_cache.clear()
+        with temp_database() as Session:
+            slots = seed(Session, args.doctors)
+            day = min(slot.date for slot in slots).date()
+            stream = requests(slots, args.ops, args.seed)
+            # before the first slot starts, so every allocation is accepted
+            clock.freeze(datetime.combine(day, dtime(6, 0), tzinfo=UTC))
+            try:
+                per_kind = run(
+                    Session, stream, day, slots[0].doctor_id, args.change_every
+                )
+            finally:
+                clock.freeze(None)
+            results.append((name, per_kind, metadata_cache.stats()))
+
+    kinds = ("allocate", "doctors", "slots")
+    print(f"{args.ops} requests, {args.doctors} doctors")
+    print(
+        f"  {'statements / µs per request':<30}"
+        + "".join(f"{kind:>16}" for kind in kinds)
+    )
+    for name, per_kind, _ in results:
+        print(
+            f"  {name:<30}"
+            + "".join(
+                f"{per_kind[k][0]:7.2f} /{per_kind[k][1]:6.0f}" for k in kinds
+            )
+        )
+    for name, _, stats in results[1:]:
+        print(
+            f"  {name:<30}hit ratio {stats['hit_ratio']:.1%}, "
+            f"{stats['version_checks']} version checks, "
+            f"{stats['invalidations']} invalidations"
+        )
+    before, after = results[0][1]["allocate"][0], results[-1][1]["allocate"][0]
+    print(
+        f"statements per allocation {before:.2f} -> {after:.2f} "
+        f"({(before - after) / before:.0%} fewer)"
+    )
+
+
+if __name__ == "__main__":
+    main()
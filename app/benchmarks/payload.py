@@ -0,0 +1,180 @@
+"""
+Bytes on the wire and server CPU of the polled list routes.
+
+    python -m app.benchmarks.payload [--tokens 2000] [--slots 500] [--polls 100]
+
+One doctor has --slots full slots tomorrow and --tokens tokens on the
+waiting list. Every --poll-seconds of clock time --changes seated tokens are
+cancelled, each seat going to the head of the waiting list, then --readers
+screens poll the waiting list and the day's slots, each keeping its own
+since= cursor. Each way of answering a poll is reported in bytes per poll and
+server CPU per poll:
+1. full JSON, what every poll cost before
+2. full JSON gzipped on every response, like a compression middleware
+3. full JSON gzipped once per read model snapshot
+4. as 3 with fields= keeping what a screen shows
+5. as 4 with since=, only the items changed since the reader's last poll
+"""
+
+import argparse
+import gzip
+import random
+import time
+import uuid
+from datetime import datetime, time as dtime, timedelta, UTC
+from sqlalchemy import insert, select
+from app import clock
+from app.benchmarks.common import make_service, seed_doctors_and_slots, temp_database
+from app.models import TokenSource, TokenStatus
+from app.policies import SOURCE_PRIORITY
+from app.read_model import read_model
+from app.schemas import Slot, Token
+from app.serialization import SLOT_FIELDS, TOKEN_FIELDS, select_fields
+from app.settings import settings
+
+WAITING_FIELDS = select_fields("priority,status,created_at", TOKEN_FIELDS)
+SLOT_SHOWN_FIELDS = select_fields("start_time,end_time", SLOT_FIELDS)
+
+
+def seed(Session, tokens: int, slots: int, capacity: int):
+    """Full slots tomorrow, and tokens waiting for a seat in them."""
+    db = Session()
+    doctor_id = seed_doctors_and_slots(db, slots_per_day=0)[0].id
+    day = clock.now().date() + timedelta(days=1)
+    slot_ids = [uuid.uuid4() for _ in range(slots)]
+    db.execute(
+        insert(Slot),
+        [
+            {
+                "id": slot_id,
+                "doctor_id": doctor_id,
+                "start_time": dtime(9, 0),
+                "end_time": dtime(17, 0),
+                "date": datetime.combine(day, dtime(0, 0)),
+                "capacity": capacity,
+                "active_count": capacity,
+            }
+            for slot_id in slot_ids
+        ],
+    )
+    booked = datetime.combine(day, dtime(0, 0))
+    rows = [(slot_id, TokenStatus.active) for slot_id in slot_ids] * capacity
+    rows += [(None, TokenStatus.waiting)] * tokens
+    db.execute(
+        insert(Token),
+        [
+            {
+                "doctor_id": doctor_id,
+                "slot_id": slot_id,
+                "source": TokenSource.online,
+                "status": status,
+                "priority": SOURCE_PRIORITY[TokenSource.online],
+                "patient_name": f"Patient {n}",
+                "patient_contact": "0000000000",
+                "created_at": booked + timedelta(seconds=n),
+                "updated_at": clock.now(),
+            }
+            for n, (slot_id, status) in enumerate(rows)
+        ],
+    )
+    db.commit()
+    db.close()
+    return doctor_id, day
+
+
+def poll(mode: str, cursor, doctor_id, day):
+    """A reader's poll of both views: payloads and the cursor to keep."""
+    if mode == "full":
+        return read_model.waiting_list(doctor_id), read_model.slots(day)
+    if mode == "gzip per response":
+        payloads = read_model.waiting_list(doctor_id), read_model.slots(day)
+        return [
+            p._replace(body=gzip.compress(p.body, settings.compression_level))
+            for p in payloads
+        ]
+    if mode == "gzip per snapshot":
+        return (
+            read_model.waiting_list(doctor_id, TOKEN_FIELDS, True),
+            read_model.slots(day, SLOT_FIELDS, True),
+        )
+    if mode == "gzip + fields" or cursor is None:
+        return (
+            read_model.waiting_list(doctor_id, WAITING_FIELDS, True),
+            read_model.slots(day, SLOT_SHOWN_FIELDS, True),
+        )
+    return (
+        read_model.waiting_list_changes(doctor_id, cursor[0], WAITING_FIELDS, True),
+        read_model.slot_changes(day, cursor[1], SLOT_SHOWN_FIELDS, True),
+    )
+
+
+def run(Session, doctor_id, day, mode: str, args):
+    read_model.session_factory = Session
+    # rebuilt on the first poll after a change, like a busy OPD
+    read_model.staleness, read_model.max_age = 0, 3600
+    read_model.clear()
+    db = Session()
+    service = make_service(db)
+    rng = random.Random(1)
+    active = list(db.scalars(select(Token.id).where(Token.slot_id.is_not(None))))
+    cursors = [None] * args.readers
+    sent, cpu = [0, 0], 0.0
+    for _ in range(args.polls):
+        clock.freeze(clock.now() + timedelta(seconds=args.poll_seconds))
+        for _ in range(args.changes):
+            # the freed seat goes to the head of the waiting list
+            service.cancel_token(active.pop(rng.randrange(len(active))))
+        for reader in range(args.readers):
+            started = time.process_time()
+            payloads = poll(mode, cursors[reader], doctor_id, day)
+            cpu += time.process_time() - started
+            cursors[reader] = [p.cursor for p in payloads]
+            for view, payload in enumerate(payloads):
+                sent[view] += len(payload.body)
+    db.close()
+    polls = args.polls * args.readers
+    return [size / polls for size in sent], cpu / polls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--tokens", type=int, default=2000)
+    parser.add_argument("--slots", type=int, default=500)
+    parser.add_argument("--capacity", type=int, default=4)
+    parser.add_argument("--polls", type=int, default=100)
+    parser.add_argument("--readers", type=int, default=10)
+    parser.add_argument("--changes", type=int, default=4)
+    parser.add_argument("--poll-seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    print(
+        f"{args.tokens} waiting tokens, {args.slots} slots, {args.readers} readers "
+        f"polling every {args.poll_seconds:g}s, {args.changes} changes per poll"
+    )
+    print(f"  {'':<20}{'waiting list':>14}{'slots':>12}{'cpu per poll':>15}")
+    baseline = None
+    for mode in (
+        "full",
+        "gzip per response",
+        "gzip per snapshot",
+        "gzip + fields",
+        "gzip + fields + since",
+    ):
+        with temp_database() as Session:
+            clock.freeze(datetime.now(UTC).replace(microsecond=0))
+            try:
+                doctor_id, day = seed(
+                    Session, args.tokens, args.slots, args.capacity
+                )
+                sizes, micros = run(Session, doctor_id, day, mode, args)
+            finally:
+                clock.freeze(None)
+        baseline = baseline or sum(sizes)
+        print(
+            f"  {mode:<20}{sizes[0]:12.0f} B{sizes[1]:10.0f} B{micros:10.0f} µs"
+            f"  {sum(sizes) / baseline:6.1%} of the bytes"
+        )
+
+
+if __name__ == "__main__":
+    main()
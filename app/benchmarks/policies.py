@@ -0,0 +1,165 @@
+"""
+Comparative benchmark of the allocation policies.
+
+    python -m app.benchmarks.policies [--ops 600] [--doctors 2] [--seed 1]
+
+Replays the same synthetic morning against each policy, every run on a fresh
+database: allocations by doctor of every token source, oversubscribing the
+day several times over, and cancellations of earlier tokens that free seats
+for the displaced ones. The allocation clock is frozen on the slot day and
+moves forward with every operation, so aging sees real waits. Per policy it
+reports the allocation latency, the share of allocations seated (and of
+emergencies), seat utilization at the end, how many tokens were preempted,
+how many of them never got a seat back, and how long the others waited.
+"""
+
+import argparse
+import random
+import time
+from datetime import datetime, time as dtime, timedelta, UTC
+from sqlalchemy import select
+from app import clock
+from app.benchmarks.common import make_service, seed_doctors_and_slots, temp_database
+from app.models import TokenCreate, TokenSource, TokenStatus
+from app.policies import make_policy
+from app.schemas import Slot, Token
+
+SLOTS_PER_DAY = 4
+CAPACITY = 10
+# how often each source asks for a token
+SOURCE_WEIGHTS = {
+    TokenSource.online: 35,
+    TokenSource.walk_in: 25,
+    TokenSource.follow_up: 15,
+    TokenSource.paid: 15,
+    TokenSource.emergency: 10,
+}
+
+
+def operations(ops: int, doctors: int, seed: int):
+    """("allocate", doctor index, source) or ("cancel", allocation number)."""
+    rng = random.Random(seed)
+    stream, allocations = [], 0
+    for _ in range(ops):
+        if allocations and rng.random() < 0.2:
+            stream.append(("cancel", rng.randrange(allocations)))
+            continue
+        source = rng.choices(list(SOURCE_WEIGHTS), list(SOURCE_WEIGHTS.values()))[0]
+        stream.append(("allocate", rng.randrange(doctors), source))
+        allocations += 1
+    return stream
+
+
+def run(policy, stream, doctors: int):
+    with temp_database() as Session:
+        db = Session()
+        doctor_ids = [
+            doctor.id
+            for doctor in seed_doctors_and_slots(
+                db, doctors=doctors, slots_per_day=SLOTS_PER_DAY, capacity=CAPACITY
+            )
+        ]
+        day = db.scalars(select(Slot.date)).first().date()
+        service = make_service(db, policy)
+        # the whole stream runs before the first slot starts at 9:00
+        start = datetime.combine(day, dtime(6, 0), tzinfo=UTC)
+        step = timedelta(hours=3) / len(stream)
+        latencies, allocated, displaced_at, waits = [], [], {}, []
+        requests = emergencies = seated = seated_emergencies = 0
+
+        for n, op in enumerate(stream):
+            now = start + step * n
+            clock.freeze(now)
+            if op[0] == "allocate":
+                _, doctor, source = op
+                requests += 1
+                emergencies += source == TokenSource.emergency
+                request = TokenCreate(
+                    doctor_id=doctor_ids[doctor],
+                    slot_id=None,
+                    date=datetime.combine(day, dtime(0, 0)),
+                    source=source,
+                    patient_name="Bench",
+                    patient_contact="0000000000",
+                )
+                started = time.perf_counter()
+                try:
+                    token = service.allocate_token(request)
+                except Exception:
+                    token = None  # turned away
+                latencies.append(time.perf_counter() - started)
+                allocated.append(token and token.id)
+                if token is not None:
+                    seated += 1
+                    seated_emergencies += source == TokenSource.emergency
+            elif allocated[op[1]] is not None:
+                try:
+                    service.cancel_token(str(allocated[op[1]]))
+                except Exception:
+                    pass  # already displaced or cancelled
+
+            statuses = dict(
+                db.execute(
+                    select(Token.id, Token.status).where(
+                        Token.id.in_(list(displaced_at))
+                        | (Token.status == TokenStatus.displaced)
+                    )
+                ).all()
+            )
+            for token_id, status in statuses.items():
+                if status == TokenStatus.displaced:
+                    displaced_at.setdefault(token_id, now)
+                elif token_id in displaced_at:
+                    waits.append((now - displaced_at.pop(token_id)).total_seconds())
+
+        active = db.query(Token).filter(Token.status == TokenStatus.active).count()
+        db.close()
+    clock.freeze(None)
+
+    latencies.sort()
+    return {
+        "p50": latencies[len(latencies) // 2] * 1e3,
+        "p95": latencies[int(len(latencies) * 0.95)] * 1e3,
+        "seated": seated / requests * 100,
+        "emergency": seated_emergencies / emergencies * 100 if emergencies else 0.0,
+        "utilization": active / (doctors * SLOTS_PER_DAY * CAPACITY) * 100,
+        "preempted": len(waits) + len(displaced_at),
+        "stranded": len(displaced_at),
+        "mean_wait": sum(waits) / len(waits) / 60 if waits else 0.0,
+        "max_wait": max(waits, default=0.0) / 60,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--ops", type=int, default=600)
+    parser.add_argument("--doctors", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--aging-minutes", type=int, default=30)
+    args = parser.parse_args()
+
+    stream = operations(args.ops, args.doctors, args.seed)
+    policies = [
+        make_policy("default", aging_minutes=0),
+        make_policy("default", allow_preemption=False, aging_minutes=0),
+        make_policy("default", aging_minutes=args.aging_minutes),
+        make_policy("fifo", aging_minutes=0),
+    ]
+
+    seats = args.doctors * SLOTS_PER_DAY * CAPACITY
+    print(f"{len(stream)} operations, {seats} seats")
+    print(
+        f"  {'':48}{'p50 ms':>7}{'p95 ms':>7}{'seated':>7}{'emerg':>7}"
+        f"{'util':>6}{'preempt':>8}{'strand':>7}{'wait min':>14}"
+    )
+    for policy in policies:
+        r = run(policy, stream, args.doctors)
+        print(
+            f"  {policy!r:<48}{r['p50']:7.2f}{r['p95']:7.2f}{r['seated']:6.0f}%"
+            f"{r['emergency']:6.0f}%{r['utilization']:5.0f}%{r['preempted']:8d}"
+            f"{r['stranded']:7d}{r['mean_wait']:7.1f}/{r['max_wait']:<6.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Benchmark of token queue positions.
+
+    python -m app.benchmarks.queue_position [--sizes 100 1000 5000] [--polls 1000]
+
+For each queue length it fills one slot with that many active tokens, then
+polls the position of random tokens, serving the head of the queue and
+allocating a new token every --write-every polls. Positions are answered:
+1. by reading the token and the slot's active tokens in order, and finding
+   the token in them, what a client had to do before
+2. by app.queue_positions, kept up to date by the allocation events
+and reports statements and time per poll. Positions are checked against the
+database after every write.
+"""
+
+import argparse
+import random
+import time
+import uuid
+from datetime import datetime, time as dtime, timedelta, UTC
+from sqlalchemy import insert, select, update
+from app import clock
+from app.benchmarks.common import (
+    RoundTrips,
+    make_service,
+    seed_doctors_and_slots,
+    temp_database,
+)
+from app.crud.token import TokenCRUD
+from app.models import TokenCreate, TokenSource, TokenStatus
+from app.policies import SOURCE_PRIORITY
+from app.queue_positions import queue_positions
+from app.schemas import Slot, Token
+
+
+def seed(Session, size: int, extra: int):
+    """One slot holding size active tokens, with room for extra more."""
+    db = Session()
+    doctor = seed_doctors_and_slots(db, slots_per_day=1, capacity=size + extra)[0]
+    slot = db.execute(select(Slot.id, Slot.date)).one()
+    rng = random.Random(size)
+    booked = datetime.combine(slot.date.date(), dtime(0, 0))
+    rows = []
+    for n in range(size):
+        source = rng.choice(list(TokenSource))
+        rows.append(
+            {
+                "id": uuid.uuid4(),
+                "doctor_id": doctor.id,
+                "slot_id": slot.id,
+                "source": source,
+                "status": TokenStatus.active,
+                "priority": SOURCE_PRIORITY[source],
+                "patient_name": "Bench",
+                "patient_contact": "0000000000",
+                "created_at": booked + timedelta(seconds=n),
+                "updated_at": booked + timedelta(seconds=n),
+            }
+        )
+    db.execute(insert(Token), rows)
+    db.execute(update(Slot).values(active_count=size))
+    db.commit()
+    db.close()
+    return slot
+
+
+def naive_position(db, token_id):
+    crud = TokenCRUD(db)
+    token = crud.get_token(token_id)
+    queue = crud.get_active_tokens_for_slot_ordered(token.slot_id)
+    return [t.id for t in queue].index(token.id)
+
+
+def indexed_position(db, token_id):
+    return queue_positions.position(db, token_id)["ahead"]
+
+
+def run(Session, slot, position, polls: int, write_every: int):
+    db = Session()
+    trips = RoundTrips(Session.kw["bind"])
+    service = make_service(db)
+    crud = TokenCRUD(db)
+    rng = random.Random(1)
+    token_ids = [row.id for row in crud.get_queue_rows_for_slot(slot.id)]
+    seconds, statements = 0.0, 0
+    for n in range(polls):
+        if n % write_every == write_every - 1:
+            # a second on, so new tokens do not tie on created_at
+            clock.freeze(clock.now() + timedelta(seconds=1))
+            head = order(crud, slot.id)[0]
+            service.serve_token(head)
+            token_ids.remove(head)
+            token = service.allocate_token(
+                TokenCreate(
+                    slot_id=slot.id,
+                    date=slot.date,
+                    source=rng.choice(list(TokenSource)),
+                    patient_name="Bench",
+                    patient_contact="0000000000",
+                )
+            )
+            token_ids.append(token.id)
+            db.expire_all()
+        token_id = rng.choice(token_ids)
+        before = trips.statements
+        started = time.perf_counter()
+        ahead = position(db, token_id)
+        seconds += time.perf_counter() - started
+        statements += trips.statements - before
+        if n % write_every == 0 and ahead != order(crud, slot.id).index(token_id):
+            raise AssertionError(f"wrong position for {token_id}")
+    db.close()
+    return statements / polls, seconds / polls * 1e6
+
+
+def order(crud, slot_id):
+    rows = crud.get_queue_rows_for_slot(slot_id)
+    return [row.id for row in sorted(rows, key=lambda r: (r.priority, r.created_at))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--polls", type=int, default=1000)
+    parser.add_argument("--write-every", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{args.polls} polls, a serve and an allocation every {args.write_every}")
+    print(f"  {'tokens':>7}{'read slot':>22}{'queue index':>22}")
+    for size in args.sizes:
+        results = []
+        for position in (naive_position, indexed_position):
+            queue_positions.clear()
+            with temp_database() as Session:
+                slot = seed(Session, size, args.polls)
+                # before the slot starts, so every allocation is accepted
+                day = slot.date.date()
+                clock.freeze(datetime.combine(day, dtime(6, 0), tzinfo=UTC))
+                try:
+                    results.append(
+                        run(
+                            Session,
+                            slot,
+                            position,
+                            args.polls,
+                            args.write_every,
+                        )
+                    )
+                finally:
+                    clock.freeze(None)
+        print(
+            f"  {size:7d}"
+            + "".join(
+                f"{statements:8.2f} stmt {micros:7.0f} µs"
+                for statements, micros in results
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Queue and availability polling next to a stream of bookings.
+
+    python -m app.benchmarks.read_model [--readers 8] [--writers 2] [--seconds 5]
+
+Writer threads book online tokens while reader threads poll a doctor's waiting
+list and the day's availability every --poll-ms, as reception screens do.
+Runs once reading through to the database on every poll and once from the
+read model, and reports poll latency, bookings per second and booking latency.
+"""
+
+import argparse
+import statistics
+import threading
+import time
+from datetime import datetime, timedelta, UTC
+from app.benchmarks.common import make_service, seed_doctors_and_slots, temp_database
+from app.models import TokenCreate, TokenSource
+from app.read_model import read_model
+
+
+def run(Session, doctor_ids, day, args, staleness_ms: int, max_age_ms: int):
+    read_model.session_factory = Session
+    read_model.staleness = staleness_ms / 1000
+    read_model.max_age = max_age_ms / 1000
+    read_model.clear()
+    stop = threading.Event()
+    polls, latencies = [], []
+
+    def reader(n: int):
+        doctor_id = doctor_ids[n % len(doctor_ids)]
+        while not stop.wait(args.poll_ms / 1000):
+            started = time.perf_counter()
+            read_model.waiting_list(doctor_id)
+            read_model.availability(day)
+            polls.append(time.perf_counter() - started)
+
+    def writer(n: int):
+        db = Session()
+        service = make_service(db)
+        booking = 0
+        while not stop.is_set():
+            started = time.perf_counter()
+            service.allocate_token(
+                TokenCreate(
+                    doctor_id=doctor_ids[(n + booking) % len(doctor_ids)],
+                    slot_id=None,
+                    date=datetime.combine(day, datetime.min.time()),
+                    source=TokenSource.online,
+                    patient_name=f"Patient {n}-{booking}",
+                    patient_contact="0000000000",
+                )
+            )
+            latencies.append(time.perf_counter() - started)
+            booking += 1
+        db.close()
+
+    threads = [threading.Thread(target=reader, args=(n,)) for n in range(args.readers)]
+    threads += [threading.Thread(target=writer, args=(n,)) for n in range(args.writers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    polls.sort()
+    latencies.sort()
+    return (
+        polls[int(len(polls) * 0.95)],
+        len(latencies) / args.seconds,
+        statistics.median(latencies),
+        latencies[int(len(latencies) * 0.95)],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--doctors", type=int, default=4)
+    parser.add_argument("--slots-per-day", type=int, default=8)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--poll-ms", type=float, default=10)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    day = datetime.now(UTC).date() + timedelta(days=1)
+    print(
+        f"{args.readers} readers every {args.poll_ms:g} ms, {args.writers} writers, "
+        f"{args.doctors} doctors, {args.seconds:g}s per run"
+    )
+    for label, staleness_ms, max_age_ms in (
+        ("read through", 0, 0),
+        ("read model 1s", 1000, 5000),
+    ):
+        # a fresh database per run so both start from empty queues
+        with temp_database() as Session:
+            db = Session()
+            doctors = seed_doctors_and_slots(
+                db,
+                doctors=args.doctors,
+                slots_per_day=args.slots_per_day,
+                capacity=10000,
+            )
+            doctor_ids = [d.id for d in doctors]
+            db.close()
+            poll_p95, bookings, p50, p95 = run(
+                Session, doctor_ids, day, args, staleness_ms, max_age_ms
+            )
+        print(
+            f"  {label:<15}poll p95 {poll_p95 * 1e3:7.2f} ms  "
+            f"{bookings:5.0f} bookings/s  "
+            f"booking p50 {p50 * 1e3:6.1f} ms  p95 {p95 * 1e3:6.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Benchmark of rescheduling a cancelled doctor's day.
+
+    python -m app.benchmarks.reschedule [--tokens 600] [--doctors 10]
+
+A day of one doctor is filled with --tokens active tokens of every source and
+the other doctors of the specialization are half full. It then moves them:
+1. the old way, cancelling each token and allocating a new one by
+   specialization through the API path
+2. with AllocationService.reschedule, in one transaction
+and checks afterwards that the slot counters match the token rows.
+"""
+
+import argparse
+import random
+import sys
+import time
+from collections import Counter
+from sqlalchemy import insert, select
+from app.benchmarks.common import make_service, seed_doctors_and_slots, temp_database
+from app.crud.main import day_bounds
+from app.models import RescheduleRequest, TokenCreate, TokenSource, TokenStatus
+from app.policies import SOURCE_PRIORITY
+from app.schemas import Slot, Token
+
+SPECIALIZATION = "Cardiology"
+SLOTS_PER_DAY = 8
+DAYS = 2
+
+
+def seed(Session, doctors: int, tokens: int, seed: int):
+    """Fill the first doctor's first day with tokens, half fill the rest."""
+    rng = random.Random(seed)
+    db = Session()
+    doctor_ids = [
+        doctor.id
+        for doctor in seed_doctors_and_slots(
+            db,
+            doctors=doctors,
+            slots_per_day=SLOTS_PER_DAY,
+            days=DAYS,
+            capacity=-(-tokens // SLOTS_PER_DAY),
+            specialization=SPECIALIZATION,
+        )
+    ]
+    slots = db.execute(
+        select(Slot.id, Slot.doctor_id, Slot.date, Slot.capacity).order_by(
+            Slot.date, Slot.start_time
+        )
+    ).all()
+    first_day = slots[0].date
+    rows, counts = [], Counter()
+    for slot in slots:
+        if slot.doctor_id == doctor_ids[0] and slot.date == first_day:
+            fill = -(-tokens // SLOTS_PER_DAY)
+        else:
+            fill = slot.capacity // 2
+        for _ in range(fill):
+            source = rng.choice(list(TokenSource))
+            rows.append(
+                {
+                    "doctor_id": slot.doctor_id,
+                    "slot_id": slot.id,
+                    "source": source,
+                    "priority": SOURCE_PRIORITY[source],
+                    "status": TokenStatus.active,
+                    "patient_name": "Bench",
+                    "patient_contact": "0000000000",
+                }
+            )
+            counts[slot.id, source == TokenSource.emergency] += 1
+    db.execute(insert(Token), rows)
+    for slot in slots:
+        db.query(Slot).filter(Slot.id == slot.id).update(
+            {
+                "active_count": counts[slot.id, False] + counts[slot.id, True],
+                "emergency_count": counts[slot.id, True],
+            }
+        )
+    db.commit()
+    db.close()
+    return doctor_ids[0], first_day.date()
+
+
+def one_by_one(Session, doctor_id, day) -> int:
+    """Cancel and re-allocate every token of the day, as clients do today."""
+    db = Session()
+    service = make_service(db)
+    day_slots = (Slot.doctor_id == doctor_id, Slot.date == day_bounds(day)[0])
+    # closed by hand, or cancelling frees seats the allocations refill
+    db.query(Slot).filter(*day_slots).update({"capacity": 0})
+    db.commit()
+    tokens = db.execute(
+        select(Token.id, Token.source)
+        .join(Slot, Slot.id == Token.slot_id)
+        .where(*day_slots, Token.status == TokenStatus.active)
+        .order_by(Token.priority)
+    ).all()
+    for token in tokens:
+        service.cancel_token(token.id)
+        try:
+            service.allocate_token(
+                TokenCreate(
+                    specialization=SPECIALIZATION,
+                    slot_id=None,
+                    date=day,
+                    search_days=DAYS,
+                    source=token.source,
+                    patient_name="Bench",
+                    patient_contact="0000000000",
+                )
+            )
+        except Exception:
+            pass  # no seat left
+    db.close()
+    return len(tokens)
+
+
+def in_one_transaction(Session, doctor_id, day):
+    db = Session()
+    response = make_service(db).reschedule(
+        RescheduleRequest(doctor_id=doctor_id, date=day, search_days=DAYS)
+    )
+    db.close()
+    return response
+
+
+def counter_mismatches(Session) -> int:
+    db = Session()
+    active = Counter(
+        db.scalars(
+            select(Token.slot_id).where(Token.status == TokenStatus.active)
+        ).all()
+    )
+    mismatches = sum(
+        slot.active_count != active[slot.id] for slot in db.scalars(select(Slot))
+    )
+    db.close()
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--tokens", type=int, default=600)
+    parser.add_argument("--doctors", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    mismatches = 0
+    with temp_database() as Session:
+        doctor_id, day = seed(Session, args.doctors, args.tokens, args.seed)
+        started = time.perf_counter()
+        moved = one_by_one(Session, doctor_id, day)
+        old = time.perf_counter() - started
+        mismatches += counter_mismatches(Session)
+
+    with temp_database() as Session:
+        doctor_id, day = seed(Session, args.doctors, args.tokens, args.seed)
+        started = time.perf_counter()
+        response = in_one_transaction(Session, doctor_id, day)
+        new = time.perf_counter() - started
+        mismatches += counter_mismatches(Session)
+
+    seated = sum(token.to_slot_id is not None for token in response.tokens)
+    elsewhere = sum(token.doctor_id != doctor_id for token in response.tokens)
+    print(f"{moved} tokens of one doctor's day, {args.doctors - 1} other doctors")
+    print(f"  cancel + allocate each   {old * 1e3:9.1f} ms")
+    print(
+        f"  reschedule               {new * 1e3:9.1f} ms  ({old / new:.0f}x), "
+        f"{seated} seated ({elsewhere} with other doctors), "
+        f"{len(response.tokens) - seated} without a seat"
+    )
+    print(f"{mismatches} slot counter mismatches")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Compare the bulk serialization path of the list routes with per-item models.
+
+    python -m app.benchmarks.serialization [--items 10000]
+
+Fills one doctor's waiting list and a day of slots with --items rows each and
+times the full HTTP round trip of both routes through the previous handlers
+(ORM objects, model_validate per item, response_model validation) and the
+current ones (column tuples dumped by a TypeAdapter), with peak traced memory.
+The read model is set to rebuild on every request so its cache is not measured.
+"""
+
+import argparse
+import time
+import tracemalloc
+from datetime import datetime, time as dtime, timedelta, UTC
+from typing import List
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+from app import db
+from app.benchmarks.common import seed_doctors_and_slots, temp_database
+from app.models import SlotResponse, TokenResponse, TokenSource, TokenStatus
+from app.read_model import read_model
+from app.routers.allocation import get_allocation_service, router
+from app.schemas import Slot, Token
+
+legacy = FastAPI()
+
+
+@legacy.get("/doctors/{doctor_id}/waiting", response_model=List[TokenResponse])
+async def legacy_waiting(doctor_id, service=Depends(get_allocation_service)):
+    tokens = service.get_waiting_list(doctor_id)
+    return [TokenResponse.model_validate(t) for t in tokens]
+
+
+@legacy.get("/slots", response_model=List[SlotResponse])
+async def legacy_slots(date: str = None, service=Depends(get_allocation_service)):
+    slots = service.get_all_slots_for_date(date)
+    return [SlotResponse.model_validate(s) for s in slots]
+
+
+def fill(Session, items: int):
+    session = Session()
+    doctor = seed_doctors_and_slots(session, slots_per_day=0)[0]
+    doctor_id = doctor.id
+    day = datetime.now(UTC).date() + timedelta(days=1)
+    created = datetime.now(UTC)
+    session.add_all(
+        Token(
+            doctor_id=doctor_id,
+            source=TokenSource.online,
+            status=TokenStatus.waiting,
+            priority=5,
+            patient_name=f"Patient {n}",
+            patient_contact="0000000000",
+            created_at=created,
+        )
+        for n in range(items)
+    )
+    session.add_all(
+        Slot(
+            doctor_id=doctor_id,
+            start_time=dtime(9, 0),
+            end_time=dtime(10, 0),
+            date=datetime.combine(day, dtime(0, 0)),
+            capacity=10,
+        )
+        for _ in range(items)
+    )
+    session.commit()
+    session.close()
+    return doctor_id, day
+
+
+def measure(client: TestClient, url: str, repeat: int):
+    client.get(url)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        body = client.get(url).content
+    latency = (time.perf_counter() - start) / repeat
+    tracemalloc.start()
+    client.get(url)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return latency, peak, body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--items", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    current = FastAPI()
+    current.include_router(router)
+    with temp_database() as Session:
+        doctor_id, day = fill(Session, args.items)
+        read_model.session_factory = Session
+        read_model.staleness = read_model.max_age = 0
+
+        def get_db():
+            session = Session()
+            try:
+                yield session
+            finally:
+                session.close()
+
+        routes = {
+            "waiting list": (
+                f"/doctors/{doctor_id}/waiting",
+                f"/allocation/doctors/{doctor_id}/waiting",
+            ),
+            "slots by date": (f"/slots?date={day}", f"/allocation/slots?date={day}"),
+        }
+        print(f"{args.items} items per response, {args.repeat} requests each")
+        for app in (legacy, current):
+            app.dependency_overrides[db.get_db] = get_db
+        with TestClient(legacy) as old_client, TestClient(current) as new_client:
+            for name, (old_url, new_url) in routes.items():
+                old = measure(old_client, old_url, args.repeat)
+                new = measure(new_client, new_url, args.repeat)
+                same = old_client.get(old_url).json() == new_client.get(new_url).json()
+                print(f"\n{name} (identical output: {same})")
+                for label, (latency, peak, body) in (("per-item", old), ("bulk", new)):
+                    print(
+                        f"  {label:<9}{latency * 1e3:9.1f} ms  "
+                        f"peak {peak / 2**20:6.1f} MiB  "
+                        f"body {len(body) / 2**20:5.1f} MiB"
+                    )
+                print(f"  speedup  {old[0] / new[0]:9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Throughput of the doctor-sharded deployment against the number of shards.
+
+    python -m app.benchmarks.sharding [--shards 1 2 4] [--seconds 10] [--direct]
+
+For each shard count it seeds --doctors doctors, partitions them with
+app.sharding, starts the shard servers and the router, and drives allocations
+by doctor over HTTP from --clients load processes of --threads threads each,
+on keep-alive connections. With --direct the load processes pick the shard
+themselves and skip the router, to tell the shards' scaling from the router's
+cost. Reports allocations per second, the speedup over one shard (scaled from
+the first shard count) and the p50 / p95 latency.
+
+Scaling needs a core per shard, plus cores for the router and the load
+processes. With fewer cores the shards only take turns on them, and the
+numbers show the machine, not the deployment.
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, timedelta
+from pathlib import Path
+from typing import List
+import httpx
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from app.benchmarks.common import seed_doctors_and_slots
+from app.db import Base
+from app.models import TokenSource
+from app.sharding import Cluster, HashRing, shard_database_urls, split_database
+
+
+def seed(directory: str, doctors: int, shards: int) -> List[str]:
+    source = f"sqlite:///{Path(directory) / 'source.db'}"
+    engine = create_engine(source)
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    doctor_ids = [
+        str(doctor.id)
+        for doctor in seed_doctors_and_slots(
+            db, doctors=doctors, slots_per_day=4, capacity=10**6
+        )
+    ]
+    db.close()
+    engine.dispose()
+    split_database(source, shard_database_urls(directory, shards))
+    return doctor_ids
+
+
+def load(
+    urls: List[str],
+    doctor_ids: List[str],
+    seconds: float,
+    threads: int,
+    seed: int,
+    direct: bool,
+):
+    """One load process: allocations until the deadline, from several threads."""
+    ring = HashRing(len(urls)) if direct else None
+    day = str(date.today() + timedelta(days=1))
+    deadline = time.monotonic() + seconds
+
+    def worker(n: int):
+        rng = random.Random(seed * 1000 + n)
+        latencies, errors = [], 0
+        with httpx.Client(timeout=60) as client:
+            while time.monotonic() < deadline:
+                doctor_id = rng.choice(doctor_ids)
+                url = urls[ring.shard(doctor_id)] if ring else urls[0]
+                started = time.perf_counter()
+                response = client.post(
+                    f"{url}/allocation/tokens",
+                    json={
+                        "doctor_id": doctor_id,
+                        "slot_id": None,
+                        "date": day,
+                        "source": rng.choice(list(TokenSource)).value,
+                        "patient_name": "Bench",
+                        "patient_contact": "0000000000",
+                    },
+                )
+                latencies.append(time.perf_counter() - started)
+                errors += response.status_code != 200
+        return latencies, errors
+
+    with ThreadPoolExecutor(threads) as pool:
+        results = list(pool.map(worker, range(threads)))
+    latencies = [latency for latencies, _ in results for latency in latencies]
+    return latencies, sum(errors for _, errors in results)
+
+
+def run(shards: int, args) -> dict:
+    with tempfile.TemporaryDirectory(prefix="opd_shards_") as directory:
+        doctor_ids = seed(directory, args.doctors, shards)
+        cluster = Cluster(
+            shards,
+            directory,
+            args.port,
+            args.router_workers,
+            # measure the servers, not the per-source rate limits
+            env={"ADMISSION_RATE_LIMITS": "{}"},
+        )
+        try:
+            cluster.wait_ready()
+            urls = cluster.shard_urls if args.direct else [cluster.router_url]
+            with ProcessPoolExecutor(args.clients) as pool:
+                futures = [
+                    pool.submit(
+                        load,
+                        urls,
+                        doctor_ids,
+                        args.seconds,
+                        args.threads,
+                        n,
+                        args.direct,
+                    )
+                    for n in range(args.clients)
+                ]
+                results = [future.result() for future in futures]
+        finally:
+            cluster.stop()
+
+    latencies = sorted(
+        latency for latencies, _ in results for latency in latencies
+    )
+    return {
+        "throughput": len(latencies) / args.seconds,
+        "errors": sum(errors for _, errors in results),
+        "p50": latencies[len(latencies) // 2] * 1e3,
+        "p95": latencies[int(len(latencies) * 0.95)] * 1e3,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--doctors", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--clients", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--router-workers", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8200)
+    parser.add_argument("--direct", action="store_true")
+    args = parser.parse_args()
+
+    if hasattr(os, "sched_getaffinity"):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = os.cpu_count()
+    print(
+        f"{cores} cores, {args.doctors} doctors, "
+        f"{args.clients} x {args.threads} clients, "
+        + ("straight to the shards" if args.direct else "through the router")
+    )
+    print(f"  {'shards':>6}{'alloc/s':>10}{'speedup':>9}{'p50 ms':>9}{'p95 ms':>9}")
+    baseline = None
+    for shards in args.shards:
+        result = run(shards, args)
+        baseline = baseline or result["throughput"] / shards
+        print(
+            f"  {shards:6d}{result['throughput']:10.0f}"
+            f"{result['throughput'] / baseline:8.1f}x"
+            f"{result['p50']:9.1f}{result['p95']:9.1f}"
+            + (f"  {result['errors']} errors" if result["errors"] else "")
+        )
+    if cores < max(args.shards) + 2:
+        print(
+            f"fewer cores than shards + router + load: expect at most "
+            f"{cores}x, not {max(args.shards)}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
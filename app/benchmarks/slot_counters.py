@@ -0,0 +1,159 @@
+"""
+Concurrency check and benchmark for the denormalized slot counters.
+
+    python -m app.benchmarks.slot_counters [--threads 8] [--requests 40]
+
+1. Many threads allocate into the same slot at once; afterwards the slot must
+   never hold more active tokens than capacity + emergency overflow, and the
+   counters must match the token rows.
+2. Compares the admission capacity check of the counter path against the old
+   path that loaded every active token of the slot.
+"""
+
+import argparse
+import random
+import sys
+import threading
+from app.benchmarks.common import (
+    make_service,
+    seed_doctors_and_slots,
+    temp_database,
+    timed,
+)
+from app.crud.slot import SlotCRUD
+from app.crud.token import TokenCRUD
+from app.models import TokenCreate, TokenSource, TokenStatus
+from app.schemas import Slot, Token
+from app.settings import settings
+
+
+def run_concurrency_check(Session, threads: int, requests: int) -> bool:
+    db = Session()
+    doctor = seed_doctors_and_slots(db, slots_per_day=1, capacity=10)[0]
+    slot = db.query(Slot).filter(Slot.doctor_id == doctor.id).one()
+    slot_id, slot_date, capacity = slot.id, slot.date, slot.capacity
+    db.close()
+
+    sources = list(TokenSource)
+    barrier = threading.Barrier(threads)
+    outcomes = {"allocated": 0, "rejected": 0}
+    lock = threading.Lock()
+
+    def worker(n: int):
+        session = Session()
+        service = make_service(session)
+        barrier.wait()
+        for i in range(requests):
+            request = TokenCreate(
+                doctor_id=doctor.id,
+                slot_id=slot_id,
+                date=slot_date,
+                source=random.choice(sources),
+                patient_name=f"Patient {n}-{i}",
+                patient_contact="0000000000",
+            )
+            try:
+                service.allocate_token(request)
+                key = "allocated"
+            except Exception:
+                key = "rejected"
+            with lock:
+                outcomes[key] += 1
+        session.close()
+
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+
+    db = Session()
+    active = (
+        db.query(Token)
+        .filter(Token.slot_id == slot_id, Token.status == TokenStatus.active)
+        .all()
+    )
+    emergencies = sum(1 for t in active if t.source == TokenSource.emergency)
+    slot = db.get(Slot, slot_id)
+    limit = capacity + settings.max_emergency_overflow
+    db.close()
+
+    print(
+        f"{threads} threads x {requests} requests: {outcomes['allocated']} allocated, "
+        f"{outcomes['rejected']} rejected"
+    )
+    print(
+        f"active tokens {len(active)} (limit {limit}), "
+        f"counters active={slot.active_count} emergency={slot.emergency_count}"
+    )
+    ok = (
+        len(active) <= limit
+        and slot.active_count == len(active)
+        and slot.emergency_count == emergencies
+    )
+    print("invariants hold" if ok else "INVARIANT VIOLATED")
+    return ok
+
+
+def run_benchmark(Session, repeat: int) -> None:
+    db = Session()
+    doctor = seed_doctors_and_slots(db, slots_per_day=1, capacity=200)[0]
+    slot = db.query(Slot).filter(Slot.doctor_id == doctor.id).one()
+    service = make_service(db)
+    for i in range(200):
+        service.allocate_token(
+            TokenCreate(
+                doctor_id=doctor.id,
+                slot_id=slot.id,
+                date=slot.date,
+                source=TokenSource.online,
+                patient_name=f"Patient {i}",
+                patient_contact="0000000000",
+            )
+        )
+
+    slot_crud, token_crud = SlotCRUD(db), TokenCRUD(db)
+    slot_id = slot.id
+
+    def token_scan():
+        # previous path: lock the slot, load all its active tokens
+        locked = slot_crud.get_slot_with_lock(slot_id)
+        active = token_crud.get_active_tokens_for_slot_ordered(slot_id)
+        emergency = sum(1 for t in active if t.source == TokenSource.emergency)
+        return len(active) < locked.capacity + min(
+            emergency, settings.max_emergency_overflow
+        )
+
+    def counter_read():
+        counters = slot_crud.get_slot_counters(slot_id)
+        return counters.active_count < counters.capacity + min(
+            counters.emergency_count, settings.max_emergency_overflow
+        )
+
+    scan = timed(token_scan, repeat)
+    counters = timed(counter_read, repeat)
+    print(f"capacity check with 200 active tokens ({repeat} runs):")
+    print(f"  token scan   {scan * 1e6:9.1f} us/check")
+    print(
+        f"  counter row  {counters * 1e6:9.1f} us/check  "
+        f"({scan / counters:.1f}x faster)"
+    )
+    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--repeat", type=int, default=500)
+    args = parser.parse_args()
+
+    with temp_database() as Session:
+        ok = run_concurrency_check(Session, args.threads, args.requests)
+    with temp_database() as Session:
+        run_benchmark(Session, args.repeat)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Earliest-available-slot search over a multi-day horizon.
+
+    python -m app.benchmarks.slot_search [--days 60] [--slots-per-day 8]
+
+One doctor whose slots are full with paid tokens on every day but the last, so
+an online booking can neither take a seat nor preempt anyone before the final
+day. Compares one auto-assign request with search_days covering the horizon
+against a client retrying day by day, and times the candidate query alone.
+"""
+
+import argparse
+import time
+import uuid
+from datetime import datetime, timedelta, UTC
+from sqlalchemy import insert, select, update
+from app.benchmarks.common import make_service, seed_doctors_and_slots, temp_database
+from app.models import TokenCreate, TokenPriority, TokenSource, TokenStatus
+from app.schemas import Slot, Token
+from app.settings import settings
+
+CAPACITY = 10
+
+
+def fill_all_but_last_day(db, doctor_id, last_day) -> None:
+    full = db.execute(
+        select(Slot.id).where(Slot.doctor_id == doctor_id, Slot.date < last_day)
+    ).scalars()
+    rows = [
+        {
+            "id": uuid.uuid4(),
+            "doctor_id": doctor_id,
+            "slot_id": slot_id,
+            "source": TokenSource.paid,
+            "status": TokenStatus.active,
+            "priority": TokenPriority.PAID,
+            "patient_name": "Patient",
+            "patient_contact": "0000000000",
+        }
+        for slot_id in full
+        for _ in range(CAPACITY)
+    ]
+    db.execute(insert(Token), rows)
+    db.execute(
+        update(Slot)
+        .where(Slot.doctor_id == doctor_id, Slot.date < last_day)
+        .values(active_count=CAPACITY)
+    )
+    db.commit()
+
+
+def request(doctor_id, day, search_days: int) -> TokenCreate:
+    return TokenCreate(
+        doctor_id=doctor_id,
+        slot_id=None,
+        date=datetime.combine(day, datetime.min.time()),
+        source=TokenSource.online,
+        patient_name="Patient",
+        patient_contact="0000000000",
+        search_days=search_days,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--days", type=int, default=60)
+    parser.add_argument("--slots-per-day", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with temp_database() as Session:
+        db = Session()
+        doctor = seed_doctors_and_slots(
+            db, slots_per_day=args.slots_per_day, days=args.days, capacity=CAPACITY
+        )[0]
+        doctor_id = doctor.id
+        first_day = datetime.now(UTC).date() + timedelta(days=1)
+        last_day = first_day + timedelta(days=args.days - 1)
+        fill_all_but_last_day(
+            db, doctor_id, datetime.combine(last_day, datetime.min.time())
+        )
+        service = make_service(db)
+
+        def horizon_search():
+            return service.allocate_token(request(doctor_id, first_day, args.days))
+
+        def day_by_day():
+            for n in range(args.days):
+                try:
+                    return service.allocate_token(
+                        request(doctor_id, first_day + timedelta(days=n), 1)
+                    )
+                except Exception:
+                    continue
+
+        def candidates():
+            return service.slot_crud.find_candidate_slots(
+                doctor_id,
+                first_day,
+                last_day,
+                datetime.now(UTC).replace(tzinfo=None),
+                TokenPriority.ONLINE,
+                settings.max_emergency_overflow,
+            )
+
+        print(
+            f"{args.days} days x {args.slots_per_day} slots, "
+            f"{args.days - 1} days full ({args.repeat} runs each)"
+        )
+        for label, fn in (
+            ("candidate query", candidates),
+            ("search_days horizon", horizon_search),
+            ("day-by-day retries", day_by_day),
+        ):
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                result = fn()
+            elapsed = (time.perf_counter() - start) / args.repeat
+            print(f"  {label:<22}{elapsed * 1e3:8.2f} ms")
+            assert result, f"{label} found nothing"
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
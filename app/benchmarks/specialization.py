@@ -0,0 +1,128 @@
+"""
+Allocation by specialization across many doctors.
+
+    python -m app.benchmarks.specialization [--doctors 300] [--days 14]
+
+Times choosing the next slot from the in-memory specialization heap against the
+SQL candidate query over every doctor of the specialization and against asking
+each doctor in turn, then books --bookings tokens by specialization and checks
+how the load is spread over the doctors.
+"""
+
+import argparse
+import time
+from collections import Counter
+from datetime import datetime, timedelta, UTC
+from sqlalchemy import select
+from app.benchmarks.common import make_service, seed_doctors_and_slots, temp_database
+from app.models import TokenCreate, TokenPriority, TokenSource
+from app.schemas import Token
+from app.settings import settings
+from app.specialization_index import specialization_index
+
+SPECIALIZATION = "Cardiology"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--doctors", type=int, default=300)
+    parser.add_argument("--days", type=int, default=14)
+    parser.add_argument("--slots-per-day", type=int, default=8)
+    parser.add_argument("--bookings", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    with temp_database() as Session:
+        db = Session()
+        doctors = seed_doctors_and_slots(
+            db,
+            doctors=args.doctors,
+            slots_per_day=args.slots_per_day,
+            days=args.days,
+            capacity=2,
+            specialization=SPECIALIZATION,
+        )
+        doctor_ids = [d.id for d in doctors]
+        service = make_service(db)
+        first_day = datetime.now(UTC).date() + timedelta(days=1)
+        last_day = first_day + timedelta(days=args.days - 1)
+        now = datetime.now(UTC).replace(tzinfo=None)
+
+        specialization_index.clear()
+        started = time.perf_counter()
+        specialization_index.candidates(
+            service.slot_crud, SPECIALIZATION, first_day, last_day, now
+        )
+        build = time.perf_counter() - started
+
+        def heap_choice():
+            return specialization_index.candidates(
+                service.slot_crud, SPECIALIZATION, first_day, last_day, now, limit=1
+            )
+
+        def sql_choice():
+            return service.slot_crud.find_candidate_slots(
+                None,
+                first_day,
+                last_day,
+                now,
+                TokenPriority.ONLINE,
+                settings.max_emergency_overflow,
+                specialization=SPECIALIZATION,
+                limit=1,
+            )
+
+        def per_doctor():
+            # what reception does today: look at every doctor's next slot
+            return [
+                service.slot_crud.find_candidate_slots(
+                    doctor_id,
+                    first_day,
+                    last_day,
+                    now,
+                    TokenPriority.ONLINE,
+                    settings.max_emergency_overflow,
+                    limit=1,
+                )
+                for doctor_id in doctor_ids
+            ]
+
+        slots = args.doctors * args.days * args.slots_per_day
+        print(f"{args.doctors} doctors, {slots} slots")
+        print(f"  {'index build':<24}{build * 1e3:9.2f} ms (once per ttl)")
+        for label, fn, repeat in (
+            ("heap choice", heap_choice, args.repeat),
+            ("sql over specialization", sql_choice, max(1, args.repeat // 20)),
+            ("every doctor checked", per_doctor, max(1, args.repeat // 20)),
+        ):
+            started = time.perf_counter()
+            for _ in range(repeat):
+                fn()
+            elapsed = (time.perf_counter() - started) / repeat
+            print(f"  {label:<24}{elapsed * 1e3:9.3f} ms")
+
+        started = time.perf_counter()
+        for n in range(args.bookings):
+            service.allocate_token(
+                TokenCreate(
+                    specialization=SPECIALIZATION,
+                    slot_id=None,
+                    date=datetime.combine(first_day, datetime.min.time()),
+                    source=TokenSource.online,
+                    patient_name=f"Patient {n}",
+                    patient_contact="0000000000",
+                    search_days=args.days,
+                )
+            )
+        elapsed = (time.perf_counter() - started) / args.bookings
+        load = Counter(db.scalars(select(Token.doctor_id)).all())
+        db.close()
+        print(
+            f"  {args.bookings} bookings by specialization: "
+            f"{elapsed * 1e3:.2f} ms each ({settings.specialization_strategy}), "
+            f"{len(load)} doctors used, at most {max(load.values())} per doctor"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Import-time budget and cold-start measurement for the API.
+
+    python -m app.benchmarks.startup [--budget-ms 900]
+
+1. Runs `python -X importtime -c "import app.main"` in a fresh interpreter,
+   prints the slowest imports and fails if app.main exceeds the budget. The
+   default budget is about 10% over the import measured on one core, around
+   800 ms; pass a bigger one on slower machines.
+2. Starts uvicorn in a subprocess and measures the time until the first
+   request to /health is served: interpreter start, imports, schema creation
+   and the first request together, the best, median and worst of --runs.
+"""
+
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+
+def import_times(env: dict) -> dict:
+    """Cumulative import time in microseconds per module."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app.main"],
+        capture_output=True,
+        text=True,
+        env=env,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|", 2)
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def first_request_seconds(env: dict, timeout: float = 30.0) -> float:
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:server", "--port", str(port)],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/health") as r:
+                    if r.status == 200:
+                        return time.perf_counter() - started
+            except OSError:
+                time.sleep(0.01)
+        raise TimeoutError("server did not answer /health")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--budget-ms", type=float, default=900)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{tmp}/startup.db")
+
+        runs = [import_times(env) for _ in range(args.runs)]
+        best = min(runs, key=lambda t: t["app.main"])
+        total_ms = best["app.main"] / 1000
+        print(f"import app.main: {total_ms:.0f} ms (best of {args.runs})")
+        slowest = sorted(
+            ((n, t) for n, t in best.items() if "." not in n or n.startswith("app.")),
+            key=lambda item: item[1],
+            reverse=True,
+        )
+        for name, cumulative in slowest[: args.top]:
+            print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+        cold = [first_request_seconds(env) for _ in range(args.runs)]
+        print(
+            f"cold start to first /health: best {min(cold) * 1000:.0f} ms, "
+            f"median {statistics.median(cold) * 1000:.0f} ms, "
+            f"worst {max(cold) * 1000:.0f} ms over {args.runs} runs"
+        )
+
+    if total_ms > args.budget_ms:
+        print(f"import budget of {args.budget_ms:.0f} ms exceeded")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
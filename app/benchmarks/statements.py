@@ -0,0 +1,129 @@
+"""
+Micro-benchmark of the prebuilt CRUD statements.
+
+    python -m app.benchmarks.statements [--calls 5000]
+
+Per-call time of the hot lookups: built as a fresh query chain on every call
+(as they were) against the statements SlotCRUD and TokenCRUD now build once
+with bound parameters. The database work is the same, the difference is
+statement construction and cache key generation.
+"""
+
+import argparse
+from sqlalchemy import select
+from app import clock
+from app.benchmarks.common import seed_doctors_and_slots, temp_database, timed
+from app.crud.main import day_bounds
+from app.crud.slot import SlotCRUD
+from app.crud.token import TokenCRUD
+from app.models import TokenSource, TokenStatus
+from app.schemas import Slot, Token
+
+
+def seed(db):
+    doctor = seed_doctors_and_slots(db, slots_per_day=4, capacity=10)[0]
+    slot = db.scalars(select(Slot)).first()
+    for n, status in enumerate(
+        [TokenStatus.active] * 8 + [TokenStatus.waiting, TokenStatus.displaced] * 4
+    ):
+        db.add(
+            Token(
+                doctor_id=doctor.id,
+                slot_id=slot.id if status == TokenStatus.active else None,
+                source=TokenSource.walk_in,
+                priority=4,
+                status=status,
+                patient_name=f"Bench {n}",
+                patient_contact="0000000000",
+            )
+        )
+    db.commit()
+    return doctor.id, slot.id
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--calls", type=int, default=5000)
+    args = parser.parse_args()
+
+    with temp_database() as Session:
+        db = Session()
+        doctor_id, slot_id = seed(db)
+        slot_crud, token_crud = SlotCRUD(db), TokenCRUD(db)
+        today = clock.now().date()
+        day_start, day_end = day_bounds(today)
+
+        cases = {
+            "slot lookup": (
+                lambda: db.query(Slot).filter(Slot.id == slot_id).first(),
+                lambda: slot_crud.get_slot(slot_id),
+            ),
+            "slot counters": (
+                lambda: db.execute(
+                    select(
+                        Slot.id,
+                        Slot.doctor_id,
+                        Slot.date,
+                        Slot.start_time,
+                        Slot.capacity,
+                        Slot.active_count,
+                        Slot.emergency_count,
+                        Slot.version,
+                    ).where(Slot.id == slot_id)
+                ).first(),
+                lambda: slot_crud.get_slot_counters(slot_id),
+            ),
+            "active tokens of a slot": (
+                lambda: db.query(Token)
+                .filter(Token.slot_id == slot_id, Token.status == TokenStatus.active)
+                .order_by(Token.priority, Token.created_at)
+                .all(),
+                lambda: token_crud.get_active_tokens_for_slot_ordered(slot_id),
+            ),
+            "waiting list of a day": (
+                lambda: db.query(Token)
+                .filter(
+                    Token.doctor_id == doctor_id,
+                    Token.status == TokenStatus.waiting,
+                    Token.created_at >= day_start,
+                    Token.created_at < day_end,
+                )
+                .order_by(Token.priority, Token.created_at)
+                .all(),
+                lambda: token_crud.get_waiting_tokens_for_doctor_by_date(
+                    doctor_id, today
+                ),
+            ),
+            "reallocatable tokens": (
+                lambda: db.query(Token)
+                .filter(
+                    Token.doctor_id == doctor_id,
+                    Token.status.in_([TokenStatus.waiting, TokenStatus.displaced]),
+                    Token.created_at >= day_start,
+                    Token.created_at < day_end,
+                )
+                .order_by(Token.priority, Token.created_at)
+                .limit(3)
+                .all(),
+                lambda: token_crud.get_reallocatable_tokens_for_doctor_by_date(
+                    doctor_id, today, limit=3
+                ),
+            ),
+        }
+
+        print(f"µs per call, mean of {args.calls}")
+        print(f"  {'':26}{'per call':>10}{'prebuilt':>10}")
+        for name, (rebuilt, prebuilt) in cases.items():
+            assert rebuilt() == prebuilt(), name
+            timed(rebuilt, args.calls // 10)
+            timed(prebuilt, args.calls // 10)
+            before = timed(rebuilt, args.calls) * 1e6
+            after = timed(prebuilt, args.calls) * 1e6
+            print(
+                f"  {name:<26}{before:10.0f}{after:10.0f}  {before / after:4.1f}x"
+            )
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
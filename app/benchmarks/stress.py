@@ -0,0 +1,329 @@
+"""
+Concurrency stress test of the allocation invariants.
+
+    python -m app.benchmarks.stress [--processes 2] [--threads 4] [--seconds 15]
+
+Worker processes, each with several threads and their own engine, hammer one
+SQLite file with random allocations (by doctor, specialization or explicit
+slot, every token source), cancellations and single or bulk no-shows.
+Afterwards it checks:
+- slot counters equal the active tokens they count
+- no slot holds more than capacity + min(emergencies, max_emergency_overflow)
+- no displaced token has a better priority than an active token of the same
+  doctor and day, and no seat is free while one waits
+- no lost tokens: every allocated token exists with a consistent status, and
+  every cancel or no-show that succeeded stuck
+and reports the throughput reached, plus the slots and doctors that lost the
+most time on counter updates (--contention-out writes the full report as
+JSON). Exits with status 1 on any violation, so it can gate a concurrency
+change.
+
+Every doctor has one slot, on a day the allocation clock is frozen in. Tokens
+are only reallocated within the day they were created and a doctor's slots
+are not ordered against each other, so this is where the priority rule is
+exact. Serving is left out, it frees a seat without promoting anyone.
+"""
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, time as dtime, timedelta, UTC
+from typing import Dict, List
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+from app import clock
+from app.benchmarks.common import make_service, seed_doctors_and_slots, temp_database
+from app.contention import contention
+from app.models import TokenCreate, TokenSource, TokenStatus
+from app.schemas import Slot, Token
+from app.settings import settings
+
+SPECIALIZATION = "Cardiology"
+SOURCES = [
+    (TokenSource.emergency, 0.10),
+    (TokenSource.paid, 0.15),
+    (TokenSource.follow_up, 0.15),
+    (TokenSource.walk_in, 0.25),
+    (TokenSource.online, 0.35),
+]
+
+
+def random_request(rng, doctor_ids, slot_ids, day) -> TokenCreate:
+    sources, weights = zip(*SOURCES)
+    request = {
+        "slot_id": None,
+        "date": datetime.combine(day, dtime.min),
+        "source": rng.choices(sources, weights)[0],
+        "patient_name": "Stress",
+        "patient_contact": "0000000000",
+    }
+    target = rng.random()
+    if target < 0.15:
+        n = rng.randrange(len(slot_ids))
+        request.update(slot_id=slot_ids[n], doctor_id=doctor_ids[n])
+    elif target < 0.40:
+        request["specialization"] = SPECIALIZATION
+    else:
+        request["doctor_id"] = rng.choice(doctor_ids)
+    return TokenCreate(**request)
+
+
+def run_thread(Session, rng, deadline, doctor_ids, slot_ids, day, release_share):
+    db = Session()
+    service = make_service(db)
+    ops, errors = Counter(), Counter()
+    allocated, released = [], {}
+    seated = []
+    while time.monotonic() < deadline:
+        if len(seated) > 3 and rng.random() < release_share * 0.2:
+            rng.shuffle(seated)
+            token_ids, seated[:3] = seated[:3], []
+            try:
+                for token_id in service.mark_no_shows(token_ids):
+                    released[str(token_id)] = TokenStatus.no_show.value
+            except Exception as e:
+                errors[f"no_show_many: {str(e).splitlines()[0][:60]}"] += 1
+            ops["no_show_many"] += 1
+            continue
+        if seated and rng.random() < release_share:
+            token_id = seated.pop(rng.randrange(len(seated)))
+            op, status = rng.choice(
+                [("cancel", TokenStatus.cancelled), ("no_show", TokenStatus.no_show)]
+            )
+            release = service.cancel_token if op == "cancel" else service.mark_no_show
+            try:
+                if release(token_id):
+                    released[str(token_id)] = status.value
+            except Exception as e:
+                errors[f"{op}: {str(e).splitlines()[0][:60]}"] += 1
+            ops[op] += 1
+            continue
+        try:
+            token = service.allocate_token(
+                random_request(rng, doctor_ids, slot_ids, day)
+            )
+            allocated.append(str(token.id))
+            seated.append(token.id)
+        except Exception as e:
+            errors[f"allocate: {str(e).splitlines()[0][:60]}"] += 1
+        ops["allocate"] += 1
+    db.close()
+    return ops, errors, allocated, released
+
+
+def run_process(url, seed, threads, seconds, doctor_ids, slot_ids, day, share):
+    """One worker process: its own engine, clock and thread pool."""
+    clock.freeze(datetime.combine(day, dtime(6, 0), tzinfo=UTC))
+    engine = create_engine(
+        url, connect_args={"check_same_thread": False, "timeout": 30}
+    )
+    Session = sessionmaker(autoflush=False, bind=engine)
+    deadline = time.monotonic() + seconds
+    results = [None] * threads
+
+    def target(n):
+        rng = random.Random(seed * 1000 + n)
+        results[n] = run_thread(
+            Session, rng, deadline, doctor_ids, slot_ids, day, share
+        )
+
+    workers = [threading.Thread(target=target, args=(n,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    engine.dispose()
+    return results, contention.snapshot()
+
+
+def check_invariants(db, allocated: List[str], released: Dict[str, str]):
+    """Violations found in the final state, empty if it is consistent."""
+    violations = []
+    overflow = settings.max_emergency_overflow
+    slots = db.scalars(select(Slot)).all()
+    tokens = db.execute(
+        select(
+            Token.id,
+            Token.doctor_id,
+            Token.slot_id,
+            Token.source,
+            Token.status,
+            Token.priority,
+        )
+    ).all()
+
+    active, emergencies = Counter(), Counter()
+    worst_active: Dict = {}
+    waiting = defaultdict(list)
+    for token in tokens:
+        if token.status == TokenStatus.active:
+            if token.slot_id is None:
+                violations.append(f"active token {token.id} has no slot")
+                continue
+            active[token.slot_id] += 1
+            emergencies[token.slot_id] += token.source == TokenSource.emergency
+            worst_active[token.slot_id] = max(
+                worst_active.get(token.slot_id, 0), token.priority
+            )
+        elif token.status in (TokenStatus.displaced, TokenStatus.waiting):
+            if token.slot_id is not None:
+                violations.append(f"waiting token {token.id} still has a slot")
+            waiting[token.doctor_id].append(token.priority)
+
+    for slot in slots:
+        if (slot.active_count, slot.emergency_count) != (
+            active[slot.id],
+            emergencies[slot.id],
+        ):
+            violations.append(
+                f"slot {slot.id} counts {slot.active_count} active and "
+                f"{slot.emergency_count} emergency, holds {active[slot.id]} "
+                f"and {emergencies[slot.id]}"
+            )
+        seats = slot.capacity + min(emergencies[slot.id], overflow)
+        if active[slot.id] > seats:
+            violations.append(
+                f"slot {slot.id} holds {active[slot.id]} tokens for {seats} seats"
+            )
+        if waiting[slot.doctor_id]:
+            best_waiting = min(waiting[slot.doctor_id])
+            if best_waiting < worst_active.get(slot.id, 0):
+                violations.append(
+                    f"slot {slot.id} seats priority {worst_active[slot.id]} "
+                    f"while priority {best_waiting} is displaced"
+                )
+            if active[slot.id] < seats:
+                violations.append(
+                    f"slot {slot.id} has {seats - active[slot.id]} free seats "
+                    f"while {len(waiting[slot.doctor_id])} tokens wait"
+                )
+
+    statuses = {str(token.id): token.status.value for token in tokens}
+    missing = set(allocated) - set(statuses)
+    if missing:
+        violations.append(f"{len(missing)} allocated tokens are missing")
+    unknown = set(statuses) - set(allocated)
+    if unknown:
+        violations.append(f"{len(unknown)} tokens were never allocated")
+    for token_id, status in released.items():
+        if statuses.get(token_id) != status:
+            violations.append(
+                f"token {token_id} was set {status}, is {statuses.get(token_id)}"
+            )
+    return violations
+
+
+def print_contention(report: Dict) -> None:
+    print("  transaction   count  rolled back  busy   mean ms   p95 ms   max ms")
+    for t in report["transactions"]:
+        print(
+            f"  {t['kind']:<12}{t['count']:7}{t['rolled_back']:13}{t['busy']:6}"
+            f"{t['mean_ms']:10.2f}{t['p95_ms']:9.2f}{t['max_ms']:9.2f}"
+        )
+    for name in ("slots", "doctors"):
+        print(f"  hottest {name}: writes, conflict rate, wait and hold ms (max)")
+        for h in report[name]:
+            print(
+                f"    {str(h['id'])[:8]}  {h['writes']:6}  "
+                f"{h['conflict_rate']:6.1%}  {h['wait_ms']:9.1f} "
+                f"({h['max_wait_ms']:6.1f})  {h['hold_ms']:9.1f} "
+                f"({h['max_hold_ms']:6.1f})  busy {h['busy']}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=15)
+    parser.add_argument("--doctors", type=int, default=6)
+    parser.add_argument("--capacity", type=int, default=4)
+    parser.add_argument("--release-share", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--top", type=int, default=5, help="hotspots listed")
+    parser.add_argument("--contention-out", help="write the contention report")
+    args = parser.parse_args()
+
+    with temp_database() as Session:
+        db = Session()
+        doctors = seed_doctors_and_slots(
+            db,
+            doctors=args.doctors,
+            slots_per_day=1,
+            capacity=args.capacity,
+            specialization=SPECIALIZATION,
+        )
+        slots = db.execute(select(Slot.id, Slot.doctor_id, Slot.date)).all()
+        doctor_ids = [slot.doctor_id for slot in slots]
+        slot_ids = [slot.id for slot in slots]
+        day = slots[0].date.date()
+        url = str(db.get_bind().url)
+        db.close()
+        assert len(doctors) == len(slots)
+
+        started = time.perf_counter()
+        with ProcessPoolExecutor(args.processes) as pool:
+            futures = [
+                pool.submit(
+                    run_process,
+                    url,
+                    args.seed + n,
+                    args.threads,
+                    args.seconds,
+                    doctor_ids,
+                    slot_ids,
+                    day,
+                    args.release_share,
+                )
+                for n in range(args.processes)
+            ]
+            results = []
+            contention.reset()
+            for future in futures:
+                process_results, snapshot = future.result()
+                results += process_results
+                contention.merge(snapshot)
+        elapsed = time.perf_counter() - started
+
+        ops, errors = Counter(), Counter()
+        allocated, released = [], {}
+        for thread_ops, thread_errors, thread_allocated, thread_released in results:
+            ops.update(thread_ops)
+            errors.update(thread_errors)
+            allocated += thread_allocated
+            released.update(thread_released)
+
+        db = Session()
+        violations = check_invariants(db, allocated, released)
+        db.close()
+
+    print(
+        f"{args.processes} processes x {args.threads} threads, {args.doctors} "
+        f"doctors with one slot of {args.capacity}, {elapsed:.1f}s"
+    )
+    print(
+        f"  {sum(ops.values()) / elapsed:8.0f} ops/s, "
+        f"{len(allocated) / elapsed:6.0f} tokens seated/s"
+    )
+    for op, count in sorted(ops.items()):
+        print(f"  {op:<10}{count:8}")
+    for error, count in errors.most_common():
+        print(f"  {count:8}  {error}")
+    report = contention.report(args.top)
+    print_contention(report)
+    if args.contention_out:
+        with open(args.contention_out, "w") as f:
+            json.dump(report, f, default=str, indent=2)
+    print(f"{len(violations)} invariant violations")
+    for violation in violations[:20]:
+        print(f"  {violation}")
+    sys.exit(1 if violations else 0)
+
+
+if __name__ == "__main__":
+    main()
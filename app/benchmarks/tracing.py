@@ -0,0 +1,94 @@
+"""
+Overhead of decision tracing on the allocation path.
+
+    python -m app.benchmarks.tracing [--allocations 500] [--rounds 6]
+
+Books online tokens into a doctor's slots and paid tokens that preempt them,
+until later bookings are rejected, so seated, preempting and rejected decisions
+are all traced. Alternates rounds on a fresh database with tracing off (sample
+rate 0) and on (sample rate 1), and compares the median time per allocation.
+Also times recording one trace on its own, without the database.
+"""
+
+import argparse
+import statistics
+import time
+from datetime import datetime, timedelta, UTC
+from app.benchmarks.common import make_service, seed_doctors_and_slots, temp_database
+from app.models import TokenCreate, TokenSource
+from app.settings import settings
+from app.tracing import tracer
+
+
+def allocate(service, doctor_id, slot_ids, day, allocations: int) -> float:
+    started = time.perf_counter()
+    for n in range(allocations):
+        # every fourth booking is paid and displaces an online one once full
+        source = TokenSource.paid if n % 4 == 3 else TokenSource.online
+        try:
+            service.allocate_token(
+                TokenCreate(
+                    doctor_id=doctor_id,
+                    slot_id=slot_ids[n % len(slot_ids)],
+                    date=datetime.combine(day, datetime.min.time()),
+                    source=source,
+                    patient_name=f"Patient {n}",
+                    patient_contact="0000000000",
+                )
+            )
+        except Exception:
+            pass  # slot full of better tokens
+    return (time.perf_counter() - started) / allocations
+
+
+def record_only(repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        trace = tracer.start("allocate", None, None)
+        trace.step("sql_candidates", slots=3)
+        trace.step("slot", slot_id=1, active_count=1, capacity=2, seats=2)
+        trace.step("seated", slot_id=1, token_id=2)
+        trace.token(2, 3)
+        trace.step("commit")
+        trace.finish("active")
+    return (time.perf_counter() - started) / repeat
+
+
+def run(allocations: int) -> float:
+    with temp_database() as Session:
+        db = Session()
+        doctor = seed_doctors_and_slots(db, slots_per_day=8, capacity=20)[0]
+        doctor_id = doctor.id
+        service = make_service(db)
+        slot_ids = [s.id for s in service.get_slots_for_doctor(doctor_id)]
+        day = datetime.now(UTC).date() + timedelta(days=1)
+        elapsed = allocate(service, doctor_id, slot_ids, day, allocations)
+        db.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--allocations", type=int, default=500)
+    parser.add_argument("--rounds", type=int, default=6)
+    args = parser.parse_args()
+
+    timings = {0.0: [], 1.0: []}
+    run(args.allocations // 5)  # warm up
+    for _ in range(args.rounds):
+        for rate in timings:
+            tracer.sample_rate = rate
+            timings[rate].append(run(args.allocations))
+
+    tracer.sample_rate = settings.trace_sample_rate
+    off = statistics.median(timings[0.0])
+    on = statistics.median(timings[1.0])
+    print(f"{args.rounds} rounds of {args.allocations} allocations per setting")
+    print(f"  {'tracing off':<16}{off * 1e3:8.3f} ms per allocation")
+    print(f"  {'tracing on':<16}{on * 1e3:8.3f} ms per allocation")
+    print(f"  {'overhead':<16}{(on / off - 1) * 100:8.2f} %")
+    print(f"  {'one trace alone':<16}{record_only(20000) * 1e6:8.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Round trips and latency of token status transitions.
+
+    python -m app.benchmarks.transitions [--tokens 600] [--batch 20]
+
+Counts the SQL statements and commits per transition, before and after the
+set-based UPDATE ... RETURNING transitions:
+1. TokenCRUD.update_token_status, against load, assign, commit, refresh
+2. serving one token, against reading it before the conditional update
+3. serving a console batch, against one request per token
+"""
+
+import argparse
+import time
+from sqlalchemy import insert, select, update
+from app.benchmarks.common import (
+    RoundTrips,
+    make_service,
+    seed_doctors_and_slots,
+    temp_database,
+)
+from app.crud.token import TokenCRUD
+from app.models import TokenSource, TokenStatus
+from app.policies import SOURCE_PRIORITY
+from app.schemas import Slot, Token
+
+
+def seed(Session, tokens: int):
+    db = Session()
+    seed_doctors_and_slots(db, slots_per_day=4, capacity=tokens)
+    slot_ids = db.scalars(select(Slot.id)).all()
+    source = TokenSource.walk_in
+    db.execute(
+        insert(Token),
+        [
+            {
+                "doctor_id": db.get(Slot, slot_ids[n % len(slot_ids)]).doctor_id,
+                "slot_id": slot_ids[n % len(slot_ids)],
+                "source": source,
+                "priority": SOURCE_PRIORITY[source],
+                "status": TokenStatus.active,
+                "patient_name": "Bench",
+                "patient_contact": "0000000000",
+            }
+            for n in range(tokens)
+        ],
+    )
+    for slot_id in slot_ids:
+        db.execute(
+            update(Slot)
+            .where(Slot.id == slot_id)
+            .values(active_count=-(-tokens // len(slot_ids)))
+        )
+    db.commit()
+    token_ids = db.scalars(select(Token.id)).all()
+    db.close()
+    return token_ids
+
+
+def legacy_update_token_status(db, token_id, status):
+    """TokenCRUD.update_token_status before UPDATE ... RETURNING."""
+    token = TokenCRUD(db).get_token(token_id)
+    token.status = status
+    db.commit()
+    db.refresh(token)
+    return token
+
+
+def legacy_serve_token(db, token_id):
+    """The release path before UPDATE ... RETURNING, minus its tracing."""
+    token_crud = TokenCRUD(db)
+    service = make_service(db)
+    token = token_crud.get_token(token_id)
+    if not token or token.status != TokenStatus.active:
+        return False
+    token_crud.transition_tokens(
+        [token.id],
+        [TokenStatus.active],
+        from_slot_ids=[token.slot_id],
+        status=TokenStatus.served,
+    )
+    service.slot_crud.release_seats(token.slot_id, 1, 0)
+    db.commit()
+    return True
+
+
+def measure(trips: RoundTrips, run, calls, transitions: int):
+    statements, commits = trips.statements, trips.commits
+    started = time.perf_counter()
+    for args in calls:
+        run(*args)
+    elapsed = time.perf_counter() - started
+    return (
+        (trips.statements - statements) / transitions,
+        (trips.commits - commits) / transitions,
+        elapsed / transitions * 1e6,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--tokens", type=int, default=600)
+    parser.add_argument("--batch", type=int, default=20)
+    args = parser.parse_args()
+
+    with temp_database() as Session:
+        token_ids = seed(Session, args.tokens)
+        trips = RoundTrips(Session.kw["bind"])
+        db = Session()
+        service = make_service(db)
+        part = args.tokens // 6
+        parts = [token_ids[n * part : (n + 1) * part] for n in range(6)]
+        batches = [
+            parts[5][n : n + args.batch] for n in range(0, part, args.batch)
+        ]
+        results = [
+            (
+                "update_token_status, load + commit + refresh",
+                measure(
+                    trips,
+                    legacy_update_token_status,
+                    [(db, t, TokenStatus.served) for t in parts[0]],
+                    part,
+                ),
+            ),
+            (
+                "update_token_status, UPDATE ... RETURNING",
+                measure(
+                    trips,
+                    service.token_crud.update_token_status,
+                    [(t, TokenStatus.served) for t in parts[1]],
+                    part,
+                ),
+            ),
+            (
+                "serve, read then conditional update",
+                measure(trips, legacy_serve_token, [(db, t) for t in parts[2]], part),
+            ),
+            (
+                "serve, UPDATE ... RETURNING",
+                measure(trips, service.serve_token, [(t,) for t in parts[3]], part),
+            ),
+            (
+                f"serve {args.batch}, one request per token",
+                measure(trips, service.serve_token, [(t,) for t in parts[4]], part),
+            ),
+            (
+                f"serve {args.batch}, one bulk request",
+                measure(trips, service.serve_tokens, [(b,) for b in batches], part),
+            ),
+        ]
+        db.close()
+
+    print(f"per transition, {part} transitions each")
+    print(f"  {'':48}statements  commits       µs")
+    for name, (statements, commits, micros) in results:
+        print(f"  {name:<48}{statements:10.2f}{commits:9.2f}{micros:9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+Capture of the allocation request stream for offline replay.
+
+With `capture_file` set the server writes, one JSON object per line:
+- at startup, a snapshot of the doctors, slots and live tokens
+- per allocate, cancel, serve, no-show (single or bulk) and reschedule, its
+  start time on the allocation clock, duration and result, in commit order
+- at shutdown, the final slot counters and token states
+The file is gzip-compressed if its name ends in .gz. Patient names and
+contacts are left out.
+
+Replay it with `python -m app.replay <file>`. Capture from a single worker,
+every process would write its own snapshot and requests.
+"""
+
+import enum
+import functools
+import gzip
+import json
+import threading
+import time
+import uuid
+from datetime import date, datetime, time as dtime
+from typing import IO, Dict, List, Optional, Sequence
+from sqlalchemy import DateTime, Enum, Table, Time, select
+from sqlalchemy.orm import Session
+from app import clock
+from app.db import SessionLocal
+from app.schemas import BinaryUUID, Doctor, Slot, Token
+
+SNAPSHOT_TABLES = (Doctor.__table__, Slot.__table__, Token.__table__)
+FINAL_COLUMNS = {
+    Slot.__table__: ("id", "active_count", "emergency_count"),
+    Token.__table__: ("id", "status", "slot_id"),
+}
+PRIVATE_COLUMNS = ("patient_name", "patient_contact")
+
+
+def open_log(path: str, mode: str) -> IO[str]:
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def encode(value):
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, (datetime, date, dtime)):
+        return value.isoformat()
+    if isinstance(value, enum.Enum):
+        return value.value
+    return value
+
+
+def decode(column, value):
+    if value is None:
+        return None
+    if isinstance(column.type, BinaryUUID):
+        return uuid.UUID(value)
+    if isinstance(column.type, DateTime):
+        return datetime.fromisoformat(value)
+    if isinstance(column.type, Time):
+        return dtime.fromisoformat(value)
+    if isinstance(column.type, Enum) and column.type.enum_class:
+        return column.type.enum_class(value)
+    return value
+
+
+def dump_table(db: Session, table: Table, columns: Sequence[str]) -> Dict:
+    rows = db.connection().execute(select(*[table.c[c] for c in columns]))
+    return {
+        "columns": list(columns),
+        "rows": [
+            [
+                "" if column in PRIVATE_COLUMNS else encode(value)
+                for column, value in zip(columns, row)
+            ]
+            for row in rows
+        ],
+    }
+
+
+def load_rows(table: Table, dumped: Dict) -> List[Dict]:
+    columns = [table.c[c] for c in dumped["columns"]]
+    return [
+        {column.name: decode(column, value) for column, value in zip(columns, row)}
+        for row in dumped["rows"]
+    ]
+
+
+class RequestCapture:
+    def __init__(self):
+        self._file: Optional[IO[str]] = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self._file is not None
+
+    def start(self, path: str) -> None:
+        db = SessionLocal()
+        try:
+            tables = {
+                table.name: dump_table(db, table, table.c.keys())
+                for table in SNAPSHOT_TABLES
+            }
+        finally:
+            db.close()
+        self._file = open_log(path, "a")
+        self._write({"op": "snapshot", "at": encode(clock.now()), "tables": tables})
+
+    def stop(self) -> None:
+        if self._file is None:
+            return
+        db = SessionLocal()
+        try:
+            tables = {
+                table.name: dump_table(db, table, columns)
+                for table, columns in FINAL_COLUMNS.items()
+            }
+        finally:
+            db.close()
+        self._write({"op": "final", "at": encode(clock.now()), "tables": tables})
+        with self._lock:
+            self._file.close()
+            self._file = None
+
+    def record(self, op: str, at: datetime, started: float, argument, result, error):
+        entry = {
+            "op": op,
+            "at": encode(at),
+            "ms": round((time.perf_counter() - started) * 1e3, 3),
+        }
+        if op == "allocate":
+            entry["request"] = argument.model_dump(
+                mode="json", exclude=set(PRIVATE_COLUMNS)
+            )
+            if result is not None:
+                result = {
+                    "id": encode(result.id),
+                    "slot_id": encode(result.slot_id),
+                    "status": encode(result.status),
+                }
+        elif op == "reschedule":
+            entry["request"] = argument.model_dump(mode="json")
+            if result is not None:
+                # tokens in priority order, ids differ on replay
+                result = [encode(token.to_slot_id) for token in result.tokens]
+        elif isinstance(argument, list):
+            entry["token_ids"] = [encode(token_id) for token_id in argument]
+            if result is not None:
+                result = [encode(token_id) for token_id in result]
+        else:
+            entry["token_id"] = encode(argument)
+        if error is not None:
+            entry["error"] = error
+        else:
+            entry["result"] = result
+        self._write(entry)
+
+    def _write(self, entry: Dict) -> None:
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line)
+
+
+capture = RequestCapture()
+
+
+def captured(op: str):
+    """Record calls of a service method taking a request or token id."""
+
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(service, argument):
+            if not capture.enabled:
+                return method(service, argument)
+            at, started = clock.now(), time.perf_counter()
+            try:
+                result = method(service, argument)
+            except Exception as e:
+                capture.record(op, at, started, argument, None, str(e))
+                raise
+            capture.record(op, at, started, argument, result, None)
+            return result
+
+        return wrapper
+
+    return decorate
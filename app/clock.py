@@ -0,0 +1,23 @@
+"""
+Current time as seen by the allocation logic.
+
+Reads the system clock unless frozen. The replay tool freezes it at each
+captured request's time, so "slot already started" checks, slot searches and
+token creation times come out as they did in production.
+"""
+
+from datetime import datetime, UTC
+from typing import Optional
+
+_frozen: Optional[datetime] = None
+
+
+def now() -> datetime:
+    """Timezone-aware UTC now, or the frozen time."""
+    return _frozen if _frozen is not None else datetime.now(UTC)
+
+
+def freeze(at: Optional[datetime]) -> None:
+    """Freeze the clock at `at`, None goes back to the system clock."""
+    global _frozen
+    _frozen = at
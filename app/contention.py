@@ -0,0 +1,160 @@
+"""
+Contention statistics of the slot counter updates.
+
+Seats are claimed with compare-and-swap updates of the slot row, so there is
+no explicit slot lock. What an update waits for is the database write lock
+(SQLite) or the row lock (other databases), held by the transaction that
+wrote last until it commits. Per slot and per doctor this records:
+- wait: time spent inside the counter UPDATE statements
+- hold: time from a transaction's first counter write on the slot until it
+  committed or rolled back
+- conflicts: compare-and-swaps that lost to a concurrent update
+- busy: allocations that gave up after `slot_update_max_retries` conflicts
+and per kind of request the transaction duration and how many rolled back or
+hit a busy database. Served by GET /allocation/contention and dumped by the
+stress benchmark.
+"""
+
+import threading
+from collections import defaultdict, deque
+from datetime import datetime, UTC
+from typing import Dict, List
+
+# attempts, conflicts, wait seconds, max wait, hold seconds, max hold, busy
+ATTEMPTS, CONFLICTS, WAIT, MAX_WAIT, HOLD, MAX_HOLD, BUSY = range(7)
+# recent transaction durations kept per kind for the percentiles
+DURATION_SAMPLES = 10000
+
+
+def _counters() -> List[float]:
+    return [0, 0, 0.0, 0.0, 0.0, 0.0, 0]
+
+
+class ContentionMonitor:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.since = datetime.now(UTC)
+            self._slots: Dict = defaultdict(_counters)
+            self._doctors: Dict = defaultdict(_counters)
+            # kind -> [count, rolled back, busy, total seconds, max seconds]
+            self._transactions: Dict[str, list] = defaultdict(
+                lambda: [0, 0, 0, 0.0, 0.0]
+            )
+            self._durations: Dict[str, deque] = defaultdict(
+                lambda: deque(maxlen=DURATION_SAMPLES)
+            )
+
+    def write(self, slot_id, doctor_id, waited: float, applied: bool) -> None:
+        """A counter UPDATE on the slot that took `waited` seconds."""
+        with self._lock:
+            for stats in (self._slots[slot_id], self._doctors[doctor_id]):
+                stats[ATTEMPTS] += 1
+                stats[CONFLICTS] += not applied
+                stats[WAIT] += waited
+                stats[MAX_WAIT] = max(stats[MAX_WAIT], waited)
+
+    def held(self, slot_id, doctor_id, seconds: float) -> None:
+        with self._lock:
+            for stats in (self._slots[slot_id], self._doctors[doctor_id]):
+                stats[HOLD] += seconds
+                stats[MAX_HOLD] = max(stats[MAX_HOLD], seconds)
+
+    def busy(self, slot_id, doctor_id) -> None:
+        with self._lock:
+            self._slots[slot_id][BUSY] += 1
+            self._doctors[doctor_id][BUSY] += 1
+
+    def transaction(
+        self, kind: str, seconds: float, committed: bool, busy: bool = False
+    ) -> None:
+        with self._lock:
+            stats = self._transactions[kind]
+            stats[0] += 1
+            stats[1] += not committed
+            stats[2] += busy
+            stats[3] += seconds
+            stats[4] = max(stats[4], seconds)
+            self._durations[kind].append(seconds)
+
+    def snapshot(self) -> Dict:
+        """Raw counters, picklable, to merge across processes."""
+        with self._lock:
+            return {
+                "since": self.since,
+                "slots": {k: list(v) for k, v in self._slots.items()},
+                "doctors": {k: list(v) for k, v in self._doctors.items()},
+                "transactions": {k: list(v) for k, v in self._transactions.items()},
+                "durations": {k: list(v) for k, v in self._durations.items()},
+            }
+
+    def merge(self, snapshot: Dict) -> None:
+        with self._lock:
+            self.since = min(self.since, snapshot["since"])
+            for name in ("slots", "doctors"):
+                target = getattr(self, f"_{name}")
+                for key, values in snapshot[name].items():
+                    stats = target[key]
+                    for i, value in enumerate(values):
+                        if i in (MAX_WAIT, MAX_HOLD):
+                            stats[i] = max(stats[i], value)
+                        else:
+                            stats[i] += value
+            for kind, values in snapshot["transactions"].items():
+                stats = self._transactions[kind]
+                for i in range(4):
+                    stats[i] += values[i]
+                stats[4] = max(stats[4], values[4])
+                self._durations[kind].extend(snapshot["durations"][kind])
+
+    def report(self, top: int = 10) -> Dict:
+        """Slots and doctors losing the most time to contention, worst first."""
+        with self._lock:
+            return {
+                "since": self.since,
+                "slots": self._hotspots(self._slots, top),
+                "doctors": self._hotspots(self._doctors, top),
+                "transactions": [
+                    self._transaction_stats(kind, stats)
+                    for kind, stats in sorted(self._transactions.items())
+                ],
+            }
+
+    @staticmethod
+    def _hotspots(table: Dict, top: int) -> List[Dict]:
+        worst = sorted(table.items(), key=lambda kv: -(kv[1][WAIT] + kv[1][HOLD]))
+        return [
+            {
+                "id": key,
+                "writes": stats[ATTEMPTS],
+                "conflicts": stats[CONFLICTS],
+                "conflict_rate": stats[CONFLICTS] / stats[ATTEMPTS]
+                if stats[ATTEMPTS]
+                else 0.0,
+                "wait_ms": stats[WAIT] * 1e3,
+                "max_wait_ms": stats[MAX_WAIT] * 1e3,
+                "hold_ms": stats[HOLD] * 1e3,
+                "max_hold_ms": stats[MAX_HOLD] * 1e3,
+                "busy": stats[BUSY],
+            }
+            for key, stats in worst[:top]
+        ]
+
+    def _transaction_stats(self, kind: str, stats: list) -> Dict:
+        durations = sorted(self._durations[kind])
+        return {
+            "kind": kind,
+            "count": stats[0],
+            "rolled_back": stats[1],
+            "busy": stats[2],
+            "mean_ms": stats[3] / stats[0] * 1e3,
+            "p95_ms": durations[int(len(durations) * 0.95)] * 1e3,
+            "max_ms": stats[4] * 1e3,
+        }
+
+
+contention = ContentionMonitor()
+
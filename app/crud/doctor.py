@@ -1,3 +1,6 @@
+from typing import List, Optional
+from sqlalchemy import select
+from sqlalchemy.engine import Row
 from sqlalchemy.orm import Session
 from app.crud.main import OPDCRUD
 from app.schemas import Doctor
@@ -5,8 +8,8 @@ from app.schemas import Doctor
 
 class DoctorCRUD(OPDCRUD):
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, db_session: Optional[Session] = None):
+        super().__init__(db_session)
 
     def create_doctor(self, name: str, specialization: str) -> Doctor:
         doctor = Doctor(name=name, specialization=specialization)
@@ -50,4 +53,10 @@ class DoctorCRUD(OPDCRUD):
         return True
 
     def get_all_doctors(self) -> list[Doctor]:
-        return self.db_session.query(Doctor).all()
\ No newline at end of file
+        return self.db_session.query(Doctor).all()
+
+    def get_doctor_rows(self) -> List[Row]:
+        """(id, name, specialization) of every doctor."""
+        return self.db_session.execute(
+            select(Doctor.id, Doctor.name, Doctor.specialization)
+        ).all()
@@ -0,0 +1,61 @@
+from datetime import datetime
+from typing import Optional
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from app.crud.main import OPDCRUD
+from app.schemas import IdempotencyRecord
+
+
+class IdempotencyCRUD(OPDCRUD):
+    def __init__(self, db_session: Optional[Session] = None):
+        super().__init__(db_session)
+
+    def get_record(self, key: str) -> Optional[IdempotencyRecord]:
+        """Get an idempotency record by key."""
+        return self.db_session.get(IdempotencyRecord, key)
+
+    def reserve_key(self, key: str, request_hash: str) -> bool:
+        """Insert a pending record. Returns False if the key already exists."""
+        self.db_session.add(IdempotencyRecord(key=key, request_hash=request_hash))
+        try:
+            self.db_session.commit()
+        except IntegrityError:
+            self.db_session.rollback()
+            return False
+        return True
+
+    def complete_key(self, key: str, response: str) -> None:
+        """Store the serialized response for a reserved key."""
+        record = self.get_record(key)
+        if record:
+            record.response = response
+            self.db_session.commit()
+
+    def delete_key(self, key: str) -> None:
+        """Remove a record so the key can be used again."""
+        self.db_session.query(IdempotencyRecord).filter(
+            IdempotencyRecord.key == key
+        ).delete()
+        self.db_session.commit()
+
+    def delete_expired(self, cutoff: datetime, pending_cutoff: datetime) -> int:
+        """
+        Delete records created before the cutoff, and reservations without a
+        response created before the pending cutoff.
+        """
+        deleted = (
+            self.db_session.query(IdempotencyRecord)
+            .filter(
+                or_(
+                    IdempotencyRecord.created_at < cutoff,
+                    and_(
+                        IdempotencyRecord.response.is_(None),
+                        IdempotencyRecord.created_at < pending_cutoff,
+                    ),
+                )
+            )
+            .delete()
+        )
+        self.db_session.commit()
+        return deleted
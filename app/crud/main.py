@@ -1,3 +1,5 @@
+from datetime import date, datetime, time, timedelta
+from typing import Optional, Tuple
 from sqlalchemy.orm import Session
 
 
@@ -8,9 +10,20 @@ class OPDCRUD:
     def set_db_session(cls, db_session: Session):
         cls._db_session = db_session
 
-    def __init__(self):
-        if self._db_session is None:
+    def __init__(self, db_session: Optional[Session] = None):
+        if db_session is None:
+            db_session = self._db_session
+        if db_session is None:
             raise RuntimeError(
                 "DB session not set. Call OPDCRUD.set_db_session(db_session) first."
             )
-        self.db_session = self._db_session
+        self.db_session = db_session
+
+
+def day_bounds(request_date: date) -> Tuple[datetime, datetime]:
+    """
+    Half-open [start, end) datetime range covering a calendar day.
+    Used instead of cast(column, Date), which SQLite evaluates to the year.
+    """
+    start = datetime.combine(request_date, time.min)
+    return start, start + timedelta(days=1)
@@ -0,0 +1,69 @@
+"""
+Change versions of the doctor and slot metadata, see app/metadata_cache.py.
+
+A flush that adds, changes or deletes a Doctor or Slot bumps the version of
+its kind in the same transaction, so a rolled back change bumps nothing.
+Slot counters are written with Core statements that never flush a Slot, so
+claiming and releasing seats leaves the versions alone. Core statements that
+do change metadata, like SlotCRUD.close_slot, call bump themselves. When the
+transaction ends METADATA_CHANGED tells this process's subscribers right away,
+other processes notice the new version on their next check.
+"""
+
+from itertools import chain
+from typing import Dict, Optional
+from sqlalchemy import bindparam, event, select, update
+from sqlalchemy.orm import Session
+from app.crud.main import OPDCRUD
+from app.events import METADATA_CHANGED, event_bus
+from app.schemas import Doctor, MetadataVersion, Slot
+
+VERSIONS = select(MetadataVersion.name, MetadataVersion.version)
+# on the table, so it can run on the connection while the session flushes
+BUMP = (
+    update(MetadataVersion.__table__)
+    .where(MetadataVersion.name.in_(bindparam("names", expanding=True)))
+    .values(version=MetadataVersion.version + 1)
+)
+# session.info key of the kinds changed in the open transaction
+_CHANGED = "metadata_changed"
+_KINDS = {Doctor: "doctors", Slot: "slots"}
+
+
+class MetadataVersionCRUD(OPDCRUD):
+    def __init__(self, db_session: Optional[Session] = None):
+        super().__init__(db_session)
+
+    def get_versions(self) -> Dict[str, int]:
+        """Current version per kind of metadata."""
+        return dict(self.db_session.execute(VERSIONS).all())
+
+    def bump(self, *kinds: str) -> None:
+        """Bump the versions of kinds, in the session's transaction."""
+        _bump(self.db_session, set(kinds))
+
+
+def _bump(session: Session, kinds: set) -> None:
+    session.connection().execute(BUMP, {"names": sorted(kinds)})
+    session.info.setdefault(_CHANGED, set()).update(kinds)
+
+
+@event.listens_for(Session, "after_flush")
+def _bump_flushed(session: Session, flush_context) -> None:
+    kinds = {
+        _KINDS[type(instance)]
+        for instance in chain(session.new, session.dirty, session.deleted)
+        if type(instance) in _KINDS
+        and (instance not in session.dirty or session.is_modified(instance))
+    }
+    if kinds:
+        _bump(session, kinds)
+
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def _publish_changed(session: Session) -> None:
+    # also on rollback: the transaction may have cached what it then undid
+    kinds = session.info.pop(_CHANGED, None)
+    if kinds:
+        event_bus.publish(METADATA_CHANGED, kinds=kinds)
@@ -1,15 +1,73 @@
-from datetime import date
-from typing import List, Optional
-from sqlalchemy import Date, cast
+from datetime import date, datetime, time
+from typing import List, Optional, Sequence, Tuple
+from sqlalchemy import (
+    LargeBinary,
+    String,
+    bindparam,
+    case,
+    exists,
+    or_,
+    select,
+    type_coerce,
+    update,
+)
+from sqlalchemy.engine import Row
 from sqlalchemy.orm import Session
-from app.crud.main import OPDCRUD
-from app.models import SlotCreate
-from app.schemas import Slot
+from app.crud.main import OPDCRUD, day_bounds
+from app.crud.metadata import MetadataVersionCRUD
+from app.models import SlotCreate, TokenStatus
+from app.schemas import Doctor, Slot, Token
+
+COUNTER_COLUMNS = (
+    Slot.id,
+    Slot.doctor_id,
+    Slot.date,
+    Slot.start_time,
+    Slot.capacity,
+    Slot.active_count,
+    Slot.emergency_count,
+    Slot.version,
+)
+# what a slot is, as opposed to how full it is, see app/metadata_cache.py
+METADATA_COLUMNS = (
+    Slot.id,
+    Slot.doctor_id,
+    Slot.date,
+    Slot.start_time,
+    Slot.end_time,
+    Slot.capacity,
+)
+
+# Statements of the allocation hot path, built once with bound parameters.
+# Rebuilding them per call cost more than running them against SQLite.
+SLOT_BY_ID = select(Slot).where(Slot.id == bindparam("slot_id"))
+SLOT_COUNTERS = select(*COUNTER_COLUMNS).where(Slot.id == bindparam("slot_id"))
+COMPARE_AND_SWAP_COUNTERS = (
+    update(Slot)
+    .where(Slot.id == bindparam("slot_id"), Slot.version == bindparam("version"))
+    .values(
+        active_count=Slot.active_count + bindparam("active_delta"),
+        emergency_count=Slot.emergency_count + bindparam("emergency_delta"),
+        version=Slot.version + 1,
+    )
+    .execution_options(synchronize_session=False)
+)
+SLOT_METADATA = select(*METADATA_COLUMNS).where(Slot.id == bindparam("slot_id"))
+RELEASE_SEATS = (
+    update(Slot)
+    .where(Slot.id == bindparam("slot_id"))
+    .values(
+        active_count=Slot.active_count - bindparam("count"),
+        emergency_count=Slot.emergency_count - bindparam("emergencies"),
+        version=Slot.version + 1,
+    )
+    .execution_options(synchronize_session=False)
+)
 
 
 class SlotCRUD(OPDCRUD):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, db_session: Optional[Session] = None):
+        super().__init__(db_session)
 
     def create_slot(self, slot_data: SlotCreate, slot_date: date) -> Slot:
         """Create a new slot."""
@@ -25,9 +83,22 @@ class SlotCRUD(OPDCRUD):
         self.db_session.refresh(slot)
         return slot
 
+    def add_slots(self, slots: Sequence[Tuple[SlotCreate, date]]) -> None:
+        """Add (slot, date) pairs without committing, for batch imports."""
+        self.db_session.add_all(
+            Slot(
+                doctor_id=str(slot_data.doctor_id),
+                start_time=slot_data.start_time,
+                end_time=slot_data.end_time,
+                date=slot_date,
+                capacity=slot_data.capacity,
+            )
+            for slot_data, slot_date in slots
+        )
+
     def get_slot(self, slot_id: str) -> Optional[Slot]:
         """Get a slot by ID."""
-        return self.db_session.query(Slot).filter(Slot.id == slot_id).first()
+        return self.db_session.scalars(SLOT_BY_ID, {"slot_id": slot_id}).first()
 
     def get_slot_with_lock(self, slot_id: str) -> Optional[Slot]:
         """Get a slot by ID with pessimistic lock (SELECT FOR UPDATE)."""
@@ -38,6 +109,115 @@ class SlotCRUD(OPDCRUD):
             .first()
         )
 
+    def get_slot_counters(self, slot_id: str) -> Optional[Row]:
+        """Read the capacity counters of a slot, bypassing the identity map."""
+        return self.db_session.execute(SLOT_COUNTERS, {"slot_id": slot_id}).first()
+
+    def compare_and_swap_counters(
+        self,
+        slot_id: str,
+        expected_version: int,
+        active_delta: int,
+        emergency_delta: int,
+    ) -> bool:
+        """
+        Apply counter deltas only if the slot is still at expected_version.
+        Returns False on a conflicting concurrent update.
+        """
+        result = self.db_session.execute(
+            COMPARE_AND_SWAP_COUNTERS,
+            {
+                "slot_id": slot_id,
+                "version": expected_version,
+                "active_delta": active_delta,
+                "emergency_delta": emergency_delta,
+            },
+        )
+        return result.rowcount == 1
+
+    def release_seats(self, slot_id: str, count: int, emergencies: int) -> bool:
+        """Decrement the counters when active tokens leave the slot."""
+        result = self.db_session.execute(
+            RELEASE_SEATS,
+            {"slot_id": slot_id, "count": count, "emergencies": emergencies},
+        )
+        return result.rowcount == 1
+
+    def close_slot(self, slot_id: str, expected_version: int) -> bool:
+        """
+        Take a slot out of service if it is still at expected_version: no
+        seats and no active tokens, the caller moves them out.
+        """
+        result = self.db_session.execute(
+            update(Slot)
+            .where(Slot.id == slot_id, Slot.version == expected_version)
+            .values(
+                capacity=0,
+                active_count=0,
+                emergency_count=0,
+                version=Slot.version + 1,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount != 1:
+            return False
+        # the capacity is metadata, cached by app.metadata_cache
+        MetadataVersionCRUD(self.db_session).bump("slots")
+        return True
+
+    def get_slot_counters_for_doctor(
+        self,
+        doctor_id: str,
+        request_date: date,
+        slot_ids: Optional[Sequence[str]] = None,
+    ) -> List[Row]:
+        """Counters of a doctor's slots on a date, optionally only the given ones."""
+        day_start, day_end = day_bounds(request_date)
+        query = select(*COUNTER_COLUMNS).where(
+            Slot.doctor_id == doctor_id, Slot.date >= day_start, Slot.date < day_end
+        )
+        if slot_ids is not None:
+            query = query.where(Slot.id.in_(slot_ids))
+        return self.db_session.execute(query.order_by(Slot.start_time)).all()
+
+    def get_reschedule_targets(
+        self,
+        doctor_id: str,
+        specialization: str,
+        first_date: date,
+        last_date: date,
+        not_started_at: datetime,
+        max_emergency_overflow: int,
+        exclude_ids: Sequence[str],
+    ) -> List[Row]:
+        """
+        Counters of the open slots between first_date and last_date with room
+        for at least an emergency, the doctor's own first and then those of
+        the other doctors of the specialization, each in (date, start_time)
+        order. Slots of not_started_at's day that already started are skipped.
+        """
+        range_start, _ = day_bounds(first_date)
+        _, range_end = day_bounds(last_date)
+        today_start, today_end = day_bounds(not_started_at.date())
+        query = (
+            select(*COUNTER_COLUMNS)
+            .where(
+                self._doctor_filter(None, specialization),
+                Slot.date >= range_start,
+                Slot.date < range_end,
+                or_(
+                    Slot.date < today_start,
+                    Slot.date >= today_end,
+                    Slot.start_time > not_started_at.time(),
+                ),
+                Slot.capacity > 0,
+                Slot.active_count < Slot.capacity + max_emergency_overflow,
+                Slot.id.not_in(exclude_ids),
+            )
+            .order_by(Slot.doctor_id != doctor_id, Slot.date, Slot.start_time)
+        )
+        return self.db_session.execute(query).all()
+
     def get_slots_for_doctor(self, doctor_id: str) -> List[Slot]:
         """Get all slots for a doctor."""
         return (
@@ -47,19 +227,166 @@ class SlotCRUD(OPDCRUD):
             .all()
         )
 
+    def get_slot_metadata(self, slot_id: str) -> Optional[Row]:
+        """METADATA_COLUMNS of a slot."""
+        return self.db_session.execute(SLOT_METADATA, {"slot_id": slot_id}).first()
+
+    def get_slot_metadata_for_doctor(
+        self, doctor_id: str, request_date: Optional[date] = None
+    ) -> List[Row]:
+        """METADATA_COLUMNS of a doctor's slots, optionally of one date."""
+        query = select(*METADATA_COLUMNS).where(Slot.doctor_id == doctor_id)
+        if request_date:
+            day_start, day_end = day_bounds(request_date)
+            query = query.where(Slot.date >= day_start, Slot.date < day_end)
+        return self.db_session.execute(
+            query.order_by(Slot.date, Slot.start_time)
+        ).all()
+
     def get_slots_for_doctor_by_date(
         self, doctor_id: str, request_date: date
     ) -> List[Slot]:
         """Get slots for a doctor on a specific date."""
-        from sqlalchemy import func, cast, Date
-
+        day_start, day_end = day_bounds(request_date)
         return (
             self.db_session.query(Slot)
-            .filter(Slot.doctor_id == doctor_id, cast(Slot.date, Date) == request_date)
+            .filter(
+                Slot.doctor_id == doctor_id,
+                Slot.date >= day_start,
+                Slot.date < day_end,
+            )
             .order_by(Slot.start_time)
             .all()
         )
 
+    def find_candidate_slots(
+        self,
+        doctor_id: Optional[str],
+        first_date: date,
+        last_date: date,
+        not_started_at: datetime,
+        incoming_priority: int,
+        max_emergency_overflow: int,
+        earliest_time: Optional[time] = None,
+        latest_time: Optional[time] = None,
+        specialization: Optional[str] = None,
+        limit: Optional[int] = None,
+        preemption: bool = True,
+    ) -> List[Row]:
+        """
+        (id, doctor_id) of the slots of a doctor, or of every doctor of a
+        specialization, between first_date and last_date in (date, start_time)
+        order that have a free seat or, with preemption, hold an active token
+        of worse priority than incoming_priority. Slots of not_started_at's
+        day that already started are skipped. For one doctor this is a single
+        range scan over ix_slots_doctor_date_start, the EXISTS probes
+        ix_tokens_slot_status_priority.
+        """
+        range_start, _ = day_bounds(first_date)
+        _, range_end = day_bounds(last_date)
+        today_start, today_end = day_bounds(not_started_at.date())
+
+        preemptible = exists().where(
+            Token.slot_id == Slot.id,
+            Token.status == TokenStatus.active,
+            Token.priority > incoming_priority,
+        )
+        query = select(Slot.id, Slot.doctor_id).where(
+            self._doctor_filter(doctor_id, specialization),
+            Slot.date >= range_start,
+            Slot.date < range_end,
+            or_(
+                Slot.date < today_start,
+                Slot.date >= today_end,
+                Slot.start_time > not_started_at.time(),
+            ),
+            or_(self._has_free_seat(max_emergency_overflow), preemptible)
+            if preemption
+            else self._has_free_seat(max_emergency_overflow),
+        )
+        if earliest_time:
+            query = query.where(Slot.start_time >= earliest_time)
+        if latest_time:
+            query = query.where(Slot.end_time <= latest_time)
+        query = query.order_by(Slot.date, Slot.start_time).limit(limit)
+        return self.db_session.execute(query).all()
+
+    def get_slot_load_rows(
+        self,
+        specialization: Optional[str] = None,
+        first_date: Optional[date] = None,
+        last_date: Optional[date] = None,
+        slot_ids: Optional[Sequence[str]] = None,
+    ) -> List[Row]:
+        """
+        Slots with their doctor's specialization and counters. Keys come back
+        as raw 16-byte values, decoding them dominated loading large indexes.
+        """
+        query = select(
+            type_coerce(Slot.id, LargeBinary).label("id"),
+            type_coerce(Slot.doctor_id, LargeBinary).label("doctor_id"),
+            Doctor.specialization,
+            Slot.date,
+            Slot.start_time,
+            Slot.end_time,
+            Slot.capacity,
+            Slot.active_count,
+            Slot.emergency_count,
+        ).join(Doctor, Doctor.id == Slot.doctor_id)
+        if specialization is not None:
+            query = query.where(Doctor.specialization == specialization)
+        if first_date:
+            query = query.where(Slot.date >= day_bounds(first_date)[0])
+        if last_date:
+            query = query.where(Slot.date < day_bounds(last_date)[1])
+        if slot_ids is not None:
+            query = query.where(Slot.id.in_(slot_ids))
+        return self.db_session.connection().execute(query).all()
+
+    def get_slot_availability_rows(
+        self,
+        columns: Sequence[str],
+        max_emergency_overflow: int,
+        request_date: Optional[date] = None,
+    ) -> List[Tuple]:
+        """
+        Slots, optionally for one date, as tuples of the given columns. The
+        pseudo column `available` is the number of seats left.
+        """
+        available = (self._seats(max_emergency_overflow) - Slot.active_count).label(
+            "available"
+        )
+        query = select(
+            *[available if c == "available" else getattr(Slot, c) for c in columns]
+        )
+        if request_date:
+            day_start, day_end = day_bounds(request_date)
+            query = query.where(Slot.date >= day_start, Slot.date < day_end)
+        query = query.order_by(Slot.date, Slot.start_time)
+        return self.db_session.connection().execute(query).all()
+
+    @staticmethod
+    def _seats(max_emergency_overflow: int):
+        """Capacity plus the emergency overflow currently in use."""
+        overflow = case(
+            (Slot.capacity == 0, 0),  # closed
+            (Slot.emergency_count < max_emergency_overflow, Slot.emergency_count),
+            else_=max_emergency_overflow,
+        )
+        return Slot.capacity + overflow
+
+    @classmethod
+    def _has_free_seat(cls, max_emergency_overflow: int):
+        return Slot.active_count < cls._seats(max_emergency_overflow)
+
+    @staticmethod
+    def _doctor_filter(doctor_id: Optional[str], specialization: Optional[str]):
+        if doctor_id is not None:
+            return Slot.doctor_id == doctor_id
+        return Slot.doctor_id.in_(
+            select(Doctor.id).where(Doctor.specialization == specialization)
+        )
+
     def delete_slot(self, slot_id: str) -> bool:
         """Delete a slot."""
         slot = self.get_slot(slot_id)
@@ -68,11 +395,45 @@ class SlotCRUD(OPDCRUD):
             self.db_session.commit()
             return True
         return False
+
+    def get_slot_rows(
+        self,
+        columns: Sequence[str],
+        request_date: Optional[date] = None,
+        since: Optional[datetime] = None,
+    ) -> List[Tuple]:
+        """
+        Slots, optionally for one date and updated at or after since, as
+        plain tuples of the given columns.
+        """
+        query = select(*[getattr(Slot, c) for c in columns])
+        if since is not None:
+            query = query.where(Slot.updated_at >= since)
+        if request_date:
+            day_start, day_end = day_bounds(request_date)
+            query = query.where(Slot.date >= day_start, Slot.date < day_end)
+            query = query.order_by(Slot.start_time)
+        return self.db_session.connection().execute(query).all()
+
     def get_slots_by_date(self, request_date: date) -> List[Slot]:
         """Get all slots for a specific date."""
+        day_start, day_end = day_bounds(request_date)
         return (
             self.db_session.query(Slot)
-            .filter(cast(Slot.date, Date) == request_date)
+            .filter(Slot.date >= day_start, Slot.date < day_end)
             .order_by(Slot.start_time)
             .all()
         )
+
+    def get_slot_capacity_columns(
+        self, start: datetime, end: datetime
+    ) -> List[Tuple]:
+        """Raw (slot_id, doctor_id, date, capacity) rows of slots in [start, end)."""
+        return self.db_session.connection().execute(
+            select(
+                type_coerce(Slot.id, LargeBinary),
+                type_coerce(Slot.doctor_id, LargeBinary),
+                type_coerce(Slot.date, String),
+                Slot.capacity,
+            ).where(Slot.date >= start, Slot.date < end)
+        ).all()
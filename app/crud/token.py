@@ -1,13 +1,119 @@
-from datetime import date
-from typing import List, Optional
+from datetime import date, datetime
+from functools import lru_cache
+from typing import Iterable, List, Optional, Sequence, Tuple, Union
+from sqlalchemy import (
+    LargeBinary,
+    String,
+    bindparam,
+    delete,
+    insert,
+    select,
+    type_coerce,
+    update,
+)
+from sqlalchemy.engine import Row
 from sqlalchemy.orm import Session
+from app.crud.main import OPDCRUD, day_bounds
 from app.models import TokenCreate, TokenStatus, TokenSource, TokenPriority
-from app.schemas import Token
+from app.schemas import Token, TokenArchive
 
+ARCHIVED_COLUMNS = [
+    "id",
+    "doctor_id",
+    "slot_id",
+    "source",
+    "status",
+    "priority",
+    "patient_name",
+    "patient_contact",
+    "created_at",
+    "updated_at",
+]
+REALLOCATABLE = [TokenStatus.waiting, TokenStatus.displaced]
 
-class TokenCRUD:
-    def __init__(self, db_session: Session):
-        self.db_session = db_session
+# Statements of the allocation and polling hot paths, built once with bound
+# parameters. Rebuilding them per call cost more than running them.
+TOKEN_BY_ID = select(Token).where(Token.id == bindparam("token_id"))
+ACTIVE_TOKENS_FOR_SLOT = (
+    select(Token)
+    .where(Token.slot_id == bindparam("slot_id"), Token.status == TokenStatus.active)
+    .order_by(Token.priority, Token.created_at)
+)
+REALLOCATABLE_TOKENS_FOR_DOCTOR = (
+    select(Token)
+    .where(
+        Token.doctor_id == bindparam("doctor_id"),
+        Token.status.in_(REALLOCATABLE),
+        Token.created_at >= bindparam("day_start"),
+        Token.created_at < bindparam("day_end"),
+    )
+    .order_by(Token.priority, Token.created_at)
+)
+REALLOCATABLE_TOKENS_FOR_DOCTOR_LIMITED = REALLOCATABLE_TOKENS_FOR_DOCTOR.limit(
+    bindparam("limit")
+)
+WAITING_TOKENS_FOR_DOCTOR = (
+    select(Token)
+    .where(
+        Token.doctor_id == bindparam("doctor_id"),
+        Token.status == TokenStatus.waiting,
+    )
+    .order_by(Token.priority, Token.created_at)
+)
+WAITING_TOKENS_FOR_DOCTOR_BY_DATE = WAITING_TOKENS_FOR_DOCTOR.where(
+    Token.created_at >= bindparam("day_start"), Token.created_at < bindparam("day_end")
+)
+# queue positions: where a token is, and the queues it can be in
+QUEUE_COLUMNS = ("id", "doctor_id", "slot_id", "status", "priority", "created_at")
+TOKEN_QUEUE_ROW = select(*[getattr(Token, c) for c in QUEUE_COLUMNS]).where(
+    Token.id == bindparam("token_id")
+)
+ARCHIVED_TOKEN_QUEUE_ROW = select(
+    *[getattr(TokenArchive, c) for c in QUEUE_COLUMNS]
+).where(TokenArchive.id == bindparam("token_id"))
+SLOT_QUEUE_ROWS = select(*[getattr(Token, c) for c in QUEUE_COLUMNS]).where(
+    Token.slot_id == bindparam("slot_id"), Token.status == TokenStatus.active
+)
+WAITING_QUEUE_ROWS = select(*[getattr(Token, c) for c in QUEUE_COLUMNS]).where(
+    Token.doctor_id == bindparam("doctor_id"),
+    Token.status.in_(REALLOCATABLE),
+    Token.created_at >= bindparam("day_start"),
+    Token.created_at < bindparam("day_end"),
+)
+SERVED_TIMES_FOR_SLOT = (
+    select(Token.updated_at)
+    .where(Token.slot_id == bindparam("slot_id"), Token.status == TokenStatus.served)
+    .order_by(Token.updated_at)
+)
+TRANSITION_TOKEN_ROWS = (
+    update(Token)
+    .where(
+        Token.id.in_(bindparam("token_ids", expanding=True)),
+        Token.status.in_(bindparam("from_statuses", expanding=True)),
+    )
+    .values(status=bindparam("new_status"))
+    .returning(Token.id, Token.doctor_id, Token.slot_id, Token.source)
+    .execution_options(synchronize_session=False)
+)
+
+
+@lru_cache(maxsize=None)
+def waiting_rows_statement(columns: Tuple[str, ...], dated: bool):
+    """Waiting tokens of a doctor as the given columns, optionally for a day."""
+    query = select(*[getattr(Token, c) for c in columns]).where(
+        Token.doctor_id == bindparam("doctor_id"), Token.status == TokenStatus.waiting
+    )
+    if dated:
+        query = query.where(
+            Token.created_at >= bindparam("day_start"),
+            Token.created_at < bindparam("day_end"),
+        )
+    return query.order_by(Token.priority, Token.created_at)
+
+
+class TokenCRUD(OPDCRUD):
+    def __init__(self, db_session: Optional[Session] = None):
+        super().__init__(db_session)
 
     def create_token(self, token_data: TokenCreate) -> Token:
         """Create a new token."""
@@ -36,60 +142,278 @@ class TokenCRUD:
 
     def get_token(self, token_id: str) -> Optional[Token]:
         """Get a token by ID."""
-        return self.db_session.query(Token).filter(Token.id == token_id).first()
+        return self.db_session.scalars(TOKEN_BY_ID, {"token_id": token_id}).first()
+
+    def transition_tokens(
+        self,
+        token_ids: Sequence[str],
+        from_statuses: Sequence[TokenStatus],
+        from_slot_ids: Optional[Sequence[str]] = None,
+        **values,
+    ) -> int:
+        """
+        Set values on the tokens that are still in one of from_statuses, and
+        in one of from_slot_ids if given, and return how many changed. A
+        status read earlier may be stale, so callers check the count instead
+        of assigning to loaded tokens.
+        """
+        query = update(Token).where(
+            Token.id.in_(token_ids), Token.status.in_(from_statuses)
+        )
+        if from_slot_ids is not None:
+            query = query.where(Token.slot_id.in_(from_slot_ids))
+        result = self.db_session.execute(query.values(**values))
+        return result.rowcount
+
+    def transition_token_rows(
+        self,
+        token_ids: Sequence[str],
+        from_statuses: Sequence[TokenStatus],
+        status: TokenStatus,
+    ) -> List[Row]:
+        """
+        Set the status of the tokens still in one of from_statuses in a single
+        UPDATE ... RETURNING: (id, doctor_id, slot_id, source) of the tokens
+        that changed. Replaces a read of the tokens before the update.
+        """
+        return self.db_session.execute(
+            TRANSITION_TOKEN_ROWS,
+            {
+                "token_ids": list(token_ids),
+                "from_statuses": list(from_statuses),
+                "new_status": status,
+            },
+        ).all()
 
     def get_tokens_for_slot(self, slot_id: str) -> List[Token]:
         """Get all active tokens for a slot."""
-        return (
-            self.db_session.query(Token)
-            .filter(Token.slot_id == slot_id, Token.status == TokenStatus.active)
+        return self.db_session.scalars(
+            ACTIVE_TOKENS_FOR_SLOT, {"slot_id": slot_id}
+        ).all()
+
+    def get_active_tokens_for_slot_ordered(self, slot_id: str) -> List[Token]:
+        """Get active tokens for a slot, best priority first."""
+        return self.get_tokens_for_slot(slot_id)
+
+    def get_active_token_rows_for_slots(self, slot_ids: Sequence[str]) -> List[Tuple]:
+        """(id, slot_id, source, priority, created_at) of active tokens, best first."""
+        return self.db_session.execute(
+            select(
+                Token.id, Token.slot_id, Token.source, Token.priority, Token.created_at
+            )
+            .where(Token.slot_id.in_(slot_ids), Token.status == TokenStatus.active)
             .order_by(Token.priority, Token.created_at)
-            .all()
-        )
+        ).all()
+
+    def get_reallocatable_tokens_for_doctor_by_date(
+        self, doctor_id: str, request_date: date, limit: Optional[int] = None
+    ) -> List[Token]:
+        """Get waiting and displaced tokens for a doctor on a date, by priority."""
+        day_start, day_end = day_bounds(request_date)
+        params = {"doctor_id": doctor_id, "day_start": day_start, "day_end": day_end}
+        query = REALLOCATABLE_TOKENS_FOR_DOCTOR
+        if limit is not None:
+            query = REALLOCATABLE_TOKENS_FOR_DOCTOR_LIMITED
+            params["limit"] = limit
+        return self.db_session.scalars(query, params).all()
+
+    # ---------- Queue positions ----------
+
+    def get_token_queue_row(self, token_id: str) -> Optional[Row]:
+        """QUEUE_COLUMNS of a token, falling back to the archive."""
+        for query in (TOKEN_QUEUE_ROW, ARCHIVED_TOKEN_QUEUE_ROW):
+            row = self.db_session.execute(query, {"token_id": token_id}).first()
+            if row is not None:
+                return row
+        return None
+
+    def get_queue_rows_for_slot(self, slot_id: str) -> List[Row]:
+        """QUEUE_COLUMNS of the active tokens of a slot, unordered."""
+        return self.db_session.execute(SLOT_QUEUE_ROWS, {"slot_id": slot_id}).all()
+
+    def get_queue_rows_for_doctor_by_date(
+        self, doctor_id: str, request_date: date
+    ) -> List[Row]:
+        """QUEUE_COLUMNS of a doctor's waiting and displaced tokens of a day."""
+        day_start, day_end = day_bounds(request_date)
+        return self.db_session.execute(
+            WAITING_QUEUE_ROWS,
+            {"doctor_id": doctor_id, "day_start": day_start, "day_end": day_end},
+        ).all()
+
+    def get_served_times_for_slot(self, slot_id: str) -> List[datetime]:
+        """When each served token of a slot was served, earliest first."""
+        return self.db_session.scalars(
+            SERVED_TIMES_FOR_SLOT, {"slot_id": slot_id}
+        ).all()
 
     def get_waiting_tokens_for_doctor(self, doctor_id: str) -> List[Token]:
         """Get all waiting tokens for a doctor."""
-        return (
-            self.db_session.query(Token)
-            .filter(Token.doctor_id == doctor_id, Token.status == TokenStatus.waiting)
+        return self.db_session.scalars(
+            WAITING_TOKENS_FOR_DOCTOR, {"doctor_id": doctor_id}
+        ).all()
+
+    def get_waiting_token_rows_for_doctor(
+        self,
+        doctor_id: str,
+        columns: Sequence[str],
+        request_date: Optional[date] = None,
+    ) -> List[Tuple]:
+        """Waiting tokens for a doctor as plain tuples of the given columns."""
+        params = {"doctor_id": doctor_id}
+        if request_date:
+            params["day_start"], params["day_end"] = day_bounds(request_date)
+        query = waiting_rows_statement(tuple(columns), bool(request_date))
+        return self.db_session.connection().execute(query, params).all()
+
+    def get_changed_token_rows_for_doctor(
+        self, doctor_id, since: datetime, columns: Sequence[str]
+    ) -> List[Tuple]:
+        """A doctor's tokens updated at or after since, as tuples of the columns."""
+        query = (
+            select(*[getattr(Token, c) for c in columns])
+            .where(Token.doctor_id == doctor_id, Token.updated_at >= since)
             .order_by(Token.priority, Token.created_at)
-            .all()
         )
+        return self.db_session.connection().execute(query).all()
 
     def get_waiting_tokens_for_doctor_by_date(
         self, doctor_id: str, request_date: date
     ) -> List[Token]:
         """Get waiting tokens for a doctor on a specific date."""
-        from sqlalchemy import func, cast, Date
+        day_start, day_end = day_bounds(request_date)
+        return self.db_session.scalars(
+            WAITING_TOKENS_FOR_DOCTOR_BY_DATE,
+            {"doctor_id": doctor_id, "day_start": day_start, "day_end": day_end},
+        ).all()
 
-        return (
-            self.db_session.query(Token)
-            .filter(
-                Token.doctor_id == doctor_id,
-                Token.status == TokenStatus.waiting,
-                cast(Token.created_at, Date) == request_date,
-            )
-            .order_by(Token.priority, Token.created_at)
-            .all()
-        )
-
-    def assign_slot_to_token(self, token_id: str, slot_id: str) -> Token:
+    def assign_slot_to_token(self, token_id: str, slot_id: str) -> Optional[Token]:
         """Assign a slot to a token."""
-        token = self.get_token(token_id)
-        if token:
-            token.slot_id = slot_id
-            token.status = TokenStatus.active
-            self.db_session.commit()
-            self.db_session.refresh(token)
-        return token
+        return self._update_token(token_id, slot_id=slot_id, status=TokenStatus.active)
 
     def update_token_status(
         self, token_id: str, status: TokenStatus
     ) -> Optional[Token]:
         """Update token status."""
+        return self._update_token(token_id, status=status)
+
+    def _update_token(self, token_id: str, **values) -> Optional[Token]:
+        """
+        Update and reload a token in one UPDATE ... RETURNING, then commit.
+        The token is detached so the commit does not expire what was loaded.
+        """
+        token = self.db_session.scalars(
+            update(Token)
+            .where(Token.id == token_id)
+            .values(**values)
+            .returning(Token)
+            .execution_options(populate_existing=True)
+        ).first()
+        if token is not None:
+            self.db_session.expunge(token)
+        self.db_session.commit()
+        return token
+
+    # ---------- Archive ----------
+
+    def archive_tokens(
+        self, cutoff: datetime, statuses: Iterable[TokenStatus], batch_size: int
+    ) -> int:
+        """
+        Move one batch of tokens created before the cutoff in the given
+        statuses into tokens_archive. Returns the number of tokens moved.
+        """
+        statuses = list(statuses)
+        ids = self.db_session.scalars(
+            select(Token.id)
+            .where(Token.status.in_(statuses), Token.created_at < cutoff)
+            .limit(batch_size)
+        ).all()
+        if not ids:
+            return 0
+
+        condition = (
+            Token.id.in_(ids),
+            Token.status.in_(statuses),
+            Token.created_at < cutoff,
+        )
+        self.db_session.execute(
+            insert(TokenArchive).from_select(
+                ARCHIVED_COLUMNS,
+                select(*[getattr(Token, c) for c in ARCHIVED_COLUMNS]).where(
+                    *condition
+                ),
+            )
+        )
+        self.db_session.execute(
+            delete(Token).where(*condition).execution_options(synchronize_session=False)
+        )
+        self.db_session.commit()
+        return len(ids)
+
+    def get_token_including_archive(
+        self, token_id: str
+    ) -> Optional[Union[Token, TokenArchive]]:
+        """Get a token by ID, falling back to the archive."""
         token = self.get_token(token_id)
         if token:
-            token.status = status
-            self.db_session.commit()
-            self.db_session.refresh(token)
-        return token
+            return token
+        return (
+            self.db_session.query(TokenArchive)
+            .filter(TokenArchive.id == token_id)
+            .first()
+        )
+
+    def get_token_ids_page(
+        self, status: TokenStatus, after: Optional[str], limit: int
+    ) -> List:
+        """
+        Ids of up to limit tokens in a status, in id order after `after`.
+        Batch jobs page with it where they write between reads.
+        """
+        query = select(Token.id).where(Token.status == status)
+        if after is not None:
+            query = query.where(Token.id > after)
+        return self.db_session.scalars(query.order_by(Token.id).limit(limit)).all()
+
+    def get_token_history_for_doctor_by_date(
+        self, doctor_id: str, request_date: date
+    ) -> List[Union[Token, TokenArchive]]:
+        """Get all tokens of a doctor created on a date, live and archived."""
+        day_start, day_end = day_bounds(request_date)
+        history = []
+        for model in (Token, TokenArchive):
+            history.extend(
+                self.db_session.query(model)
+                .filter(
+                    model.doctor_id == doctor_id,
+                    model.created_at >= day_start,
+                    model.created_at < day_end,
+                )
+                .all()
+            )
+        return sorted(history, key=lambda t: t.created_at)
+
+    def get_token_columns(self, start: datetime, end: datetime) -> List[Tuple]:
+        """
+        Raw (doctor_id, slot_id, source, status, created_at, updated_at) rows of
+        live and archived tokens created in [start, end). Keys are returned as
+        raw bytes and enums as names, skipping per-row type conversion.
+        """
+        # Core execution on the session's connection skips ORM row wrapping
+        connection = self.db_session.connection()
+        rows = []
+        for model in (Token, TokenArchive):
+            rows.extend(
+                connection.execute(
+                    select(
+                        type_coerce(model.doctor_id, LargeBinary),
+                        type_coerce(model.slot_id, LargeBinary),
+                        type_coerce(model.source, String),
+                        type_coerce(model.status, String),
+                        type_coerce(model.created_at, String),
+                        type_coerce(model.updated_at, String),
+                    ).where(model.created_at >= start, model.created_at < end)
+                ).all()
+            )
+        return rows
@@ -1,14 +1,34 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+from typing import Optional
+from sqlalchemy import Engine, create_engine
+from sqlalchemy.orm import Session, sessionmaker, declarative_base
 from .settings import settings
 
 DATABASE_URL = settings.database_url
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+Base = declarative_base()
 
-SessionLocal = sessionmaker(autoflush=False, bind=engine)
+_engine: Optional[Engine] = None
+_session_factory = sessionmaker(autoflush=False)
+
+
+def get_engine() -> Engine:
+    """Create the engine on first use instead of at import time."""
+    global _engine
+    if _engine is None:
+        _engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+    return _engine
+
+
+def SessionLocal() -> Session:
+    return _session_factory(bind=get_engine())
+
+
+def init_db() -> None:
+    """Create missing tables. Production databases are managed by Alembic."""
+    from app import schemas  # noqa: F401 registers the models on Base
+
+    Base.metadata.create_all(bind=get_engine())
 
-Base = declarative_base()
 
 def get_db():
     db = SessionLocal()
@@ -0,0 +1,52 @@
+"""
+In-process publish/subscribe for allocation events.
+
+The service publishes after its transaction commits, so subscribers never see
+changes that were rolled back. Handlers run synchronously on the publishing
+thread and should only update in-memory state.
+"""
+
+import logging
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, List
+
+logger = logging.getLogger(__name__)
+
+# payload: slot_id. The slot's counters (and so its free seats) changed.
+SLOT_CHANGED = "slot_changed"
+# payload: doctor_id. A token of the doctor was added or changed status.
+QUEUE_CHANGED = "queue_changed"
+# payload: tokens, (id, doctor_id, slot_id, status, priority, created_at) of
+# every token added or changed, as it is after the commit. priority and
+# created_at may be None for tokens leaving the queues (served, cancelled).
+TOKENS_CHANGED = "tokens_changed"
+# payload: kinds, a set of METADATA_KINDS. Doctors or slot definitions changed.
+METADATA_CHANGED = "metadata_changed"
+
+
+class EventBus:
+    def __init__(self):
+        self._handlers: Dict[str, List[Callable]] = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def subscribe(self, event: str, handler: Callable) -> None:
+        with self._lock:
+            self._handlers[event].append(handler)
+
+    def unsubscribe(self, event: str, handler: Callable) -> None:
+        with self._lock:
+            self._handlers[event].remove(handler)
+
+    def publish(self, event: str, **payload) -> None:
+        with self._lock:
+            handlers = list(self._handlers[event])
+        for handler in handlers:
+            try:
+                handler(**payload)
+            except Exception:
+                # a broken subscriber must not fail an already committed request
+                logger.exception("Handler for %s failed", event)
+
+
+event_bus = EventBus()
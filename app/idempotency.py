@@ -0,0 +1,195 @@
+"""
+Idempotency-Key support for token creation.
+
+Responses are kept in a bounded in-process LRU (with TTL) and persisted in the
+`idempotency_keys` table so retries are recognised across restarts and workers.
+
+A reservation whose request never finished, because its worker died, holds
+the key for `idempotency_lease_seconds` only. After that a retry claims the
+key again. Expired records are purged every
+`idempotency_purge_interval_minutes`.
+"""
+
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, UTC
+from typing import Callable, Optional, Tuple
+from sqlalchemy.orm import Session
+from app.crud.idempotency import IdempotencyCRUD
+from app.db import SessionLocal
+from app.models import TokenCreate, TokenResponse
+from app.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+class IdempotencyKeyInProgress(Exception):
+    """The original request for this key has not finished yet."""
+
+
+class IdempotencyKeyMismatch(Exception):
+    """The key was already used with a different request body."""
+
+
+class IdempotencyStore:
+    def __init__(
+        self,
+        max_entries: int,
+        ttl_seconds: int,
+        lease_seconds: int,
+        session_factory: Callable[[], Session] = SessionLocal,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.lease_seconds = lease_seconds
+        self.session_factory = session_factory
+        # key -> (expires_at monotonic, request hash, response)
+        self._entries: "OrderedDict[str, Tuple[float, str, TokenResponse]]" = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def request_hash(token_request: TokenCreate) -> str:
+        return hashlib.sha256(token_request.model_dump_json().encode()).hexdigest()
+
+    def reserve(self, key: str, token_request: TokenCreate) -> Optional[TokenResponse]:
+        """
+        Claim a key before allocating.
+        Returns the stored response for a repeated key, or None if the caller
+        now owns the key and must call `complete` or `release`.
+        """
+        request_hash = self.request_hash(token_request)
+
+        cached = self._get_cached(key)
+        if cached is not None:
+            stored_hash, response = cached
+            self._check_hash(stored_hash, request_hash)
+            return response
+
+        db = self.session_factory()
+        try:
+            crud = IdempotencyCRUD(db)
+            if crud.reserve_key(key, request_hash):
+                return None
+
+            record = crud.get_record(key)
+            if (
+                record is None
+                or self._is_expired(record.created_at, self.ttl_seconds)
+                or (
+                    record.response is None
+                    and self._is_expired(record.created_at, self.lease_seconds)
+                )
+            ):
+                # Released concurrently, stale or abandoned, claim it again
+                if record is not None:
+                    crud.delete_key(key)
+                if crud.reserve_key(key, request_hash):
+                    return None
+                self._in_progress()
+
+            self._check_hash(record.request_hash, request_hash)
+            if record.response is None:
+                self._in_progress()
+
+            response = TokenResponse.model_validate_json(record.response)
+            self._put_cached(key, request_hash, response)
+            return response
+        finally:
+            db.close()
+
+    def complete(
+        self, key: str, token_request: TokenCreate, response: TokenResponse
+    ) -> None:
+        """Persist the response for a reserved key."""
+        self._put_cached(key, self.request_hash(token_request), response)
+        db = self.session_factory()
+        try:
+            IdempotencyCRUD(db).complete_key(key, response.model_dump_json())
+        finally:
+            db.close()
+
+    def release(self, key: str) -> None:
+        """Drop a reservation after a failed request so the client may retry."""
+        db = self.session_factory()
+        try:
+            IdempotencyCRUD(db).delete_key(key)
+        finally:
+            db.close()
+
+    def purge_expired(self) -> int:
+        """Delete expired records and abandoned reservations from the database."""
+        now = datetime.now(UTC).replace(tzinfo=None)
+        db = self.session_factory()
+        try:
+            return IdempotencyCRUD(db).delete_expired(
+                now - timedelta(seconds=self.ttl_seconds),
+                now - timedelta(seconds=self.lease_seconds),
+            )
+        finally:
+            db.close()
+
+    def _get_cached(self, key: str) -> Optional[Tuple[str, TokenResponse]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, request_hash, response = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return request_hash, response
+
+    def _put_cached(self, key: str, request_hash: str, response: TokenResponse) -> None:
+        with self._lock:
+            self._entries[key] = (
+                time.monotonic() + self.ttl_seconds,
+                request_hash,
+                response,
+            )
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    @staticmethod
+    def _is_expired(created_at: datetime, seconds: int) -> bool:
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=UTC)
+        return created_at + timedelta(seconds=seconds) < datetime.now(UTC)
+
+    @staticmethod
+    def _check_hash(stored_hash: str, request_hash: str) -> None:
+        if stored_hash != request_hash:
+            raise IdempotencyKeyMismatch(
+                "Idempotency-Key was already used with a different request"
+            )
+
+    @staticmethod
+    def _in_progress() -> None:
+        raise IdempotencyKeyInProgress(
+            "A request with this Idempotency-Key is still being processed"
+        )
+
+
+async def run_periodically(interval_minutes: int) -> None:
+    """Purge expired keys on a fixed interval, off the event loop."""
+    while True:
+        try:
+            purged = await asyncio.to_thread(idempotency_store.purge_expired)
+            logger.info("Purged %d idempotency keys", purged)
+        except Exception:
+            logger.exception("Idempotency key purge failed")
+        await asyncio.sleep(interval_minutes * 60)
+
+
+idempotency_store = IdempotencyStore(
+    max_entries=settings.idempotency_cache_size,
+    ttl_seconds=settings.idempotency_ttl_seconds,
+    lease_seconds=settings.idempotency_lease_seconds,
+)
@@ -1,8 +1,48 @@
+import asyncio
+from contextlib import asynccontextmanager
 import fastapi
-from app import schemas, settings  # noqa: F401 to ensure models are registered
+from starlette.middleware.gzip import GZipMiddleware
+from app import archival, db, idempotency, settings
+from app.capture import capture
 from app.routers import allocation
 
-server = fastapi.FastAPI(version=settings.settings.version)
+
+@asynccontextmanager
+async def lifespan(app: fastapi.FastAPI):
+    if settings.settings.create_schema_on_startup:
+        db.init_db()
+    if settings.settings.capture_file:
+        capture.start(settings.settings.capture_file)
+
+    background = []
+    if settings.settings.archive_interval_minutes > 0:
+        background.append(
+            asyncio.create_task(
+                archival.run_periodically(settings.settings.archive_interval_minutes)
+            )
+        )
+    if settings.settings.idempotency_purge_interval_minutes > 0:
+        background.append(
+            asyncio.create_task(
+                idempotency.run_periodically(
+                    settings.settings.idempotency_purge_interval_minutes
+                )
+            )
+        )
+    yield
+    for task in background:
+        task.cancel()
+    capture.stop()
+
+
+server = fastapi.FastAPI(version=settings.settings.version, lifespan=lifespan)
+if settings.settings.compression_enabled:
+    # every other route; read model responses come compressed and pass through
+    server.add_middleware(
+        GZipMiddleware,
+        minimum_size=settings.settings.compression_minimum_size,
+        compresslevel=settings.settings.compression_level,
+    )
 
 server.include_router(allocation.router)
 
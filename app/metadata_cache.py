@@ -0,0 +1,201 @@
+"""
+Process-local cache of doctor and slot metadata.
+
+Doctors and slot definitions (date, times, capacity) change rarely, yet the
+allocation path and the read endpoints looked them up on every request. The
+cache keeps them as immutable rows:
+- every doctor, by id and by specialization, loaded in one query
+- slots by id, and a doctor's slots of a date (or of all dates), loaded on
+  first use
+Slot counters are not metadata and are always read from the slot row.
+
+Staleness bound: every change bumps a version in `metadata_versions` (see
+app/crud/metadata.py) in its own transaction.
+- changes committed by this process drop the cached kind right away, through
+  METADATA_CHANGED
+- changes by other processes are noticed within `metadata_cache_check_ms`,
+  when a lookup reads the versions again (one primary key scan of two rows)
+Setting it to 0 checks the versions on every lookup, and
+`metadata_cache_enabled` off reads through to the database every time.
+"""
+
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import date
+from typing import Dict, Hashable, List, Optional, Tuple
+from sqlalchemy.engine import Row
+from sqlalchemy.orm import Session
+from app.crud.doctor import DoctorCRUD
+from app.crud.metadata import MetadataVersionCRUD
+from app.crud.slot import SlotCRUD
+from app.events import METADATA_CHANGED, event_bus
+from app.schemas import METADATA_KINDS
+from app.settings import settings
+
+
+class MetadataCache:
+    def __init__(self, check_ms: int, max_slots: int, enabled: bool = True):
+        self.check_interval = check_ms / 1000
+        self.max_slots = max_slots
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._bind = None
+            self._versions: Dict[str, int] = {}
+            self._checked_at = float("-inf")
+            # bumped whenever a kind is dropped, compared across a load
+            self._generations = {kind: 0 for kind in METADATA_KINDS}
+            # ({id: doctor}, {specialization: doctors}), None until loaded
+            self._doctors: Optional[Tuple[Dict, Dict]] = None
+            self._slots: Dict[uuid.UUID, Row] = {}
+            # (doctor_id, date or None for every date) -> slots in time order
+            self._doctor_slots: Dict[Hashable, Tuple[Row, ...]] = {}
+            self.hits = self.misses = self.checks = self.invalidations = 0
+
+    # ---------- Doctors ----------
+
+    def doctor(self, db: Session, doctor_id) -> Optional[Row]:
+        return self._all_doctors(db)[0].get(_as_uuid(doctor_id))
+
+    def doctors(
+        self, db: Session, specialization: Optional[str] = None
+    ) -> List[Row]:
+        by_id, by_specialization = self._all_doctors(db)
+        if specialization is None:
+            return list(by_id.values())
+        return list(by_specialization.get(specialization, ()))
+
+    def _all_doctors(self, db: Session) -> Tuple[Dict, Dict]:
+        """Doctors by id, and by specialization."""
+        self._check(db)
+        doctors = self._doctors
+        if doctors is not None:
+            self.hits += 1
+            return doctors
+        self.misses += 1
+        generation = self._generations["doctors"]
+        rows = DoctorCRUD(db).get_doctor_rows()
+        by_specialization = defaultdict(list)
+        for row in rows:
+            by_specialization[row.specialization].append(row)
+        doctors = (
+            {row.id: row for row in rows},
+            {name: tuple(rows) for name, rows in by_specialization.items()},
+        )
+        with self._lock:
+            if self.enabled and self._generations["doctors"] == generation:
+                self._doctors = doctors
+        return doctors
+
+    # ---------- Slots ----------
+
+    def slot(self, db: Session, slot_id) -> Optional[Row]:
+        self._check(db)
+        slot_id = _as_uuid(slot_id)
+        row = self._slots.get(slot_id)
+        if row is not None:
+            self.hits += 1
+            return row
+        self.misses += 1
+        generation = self._generations["slots"]
+        row = SlotCRUD(db).get_slot_metadata(slot_id)
+        if row is not None:
+            # a missing slot is not remembered, another worker may add it
+            self._store_slots(generation, [row])
+        return row
+
+    def slots_for_doctor(
+        self, db: Session, doctor_id, request_date: Optional[date] = None
+    ) -> List[Row]:
+        """A doctor's slots of request_date, or of every date, in time order."""
+        self._check(db)
+        key = (_as_uuid(doctor_id), request_date)
+        rows = self._doctor_slots.get(key)
+        if rows is not None:
+            self.hits += 1
+            return list(rows)
+        self.misses += 1
+        generation = self._generations["slots"]
+        rows = SlotCRUD(db).get_slot_metadata_for_doctor(doctor_id, request_date)
+        self._store_slots(generation, rows, key)
+        return list(rows)
+
+    def _store_slots(self, generation: int, rows, key: Hashable = None) -> None:
+        with self._lock:
+            if not self.enabled or self._generations["slots"] != generation:
+                return  # changed while loading, the rows may be stale
+            if len(self._slots) + len(rows) > self.max_slots:
+                self._slots, self._doctor_slots = {}, {}
+            for row in rows:
+                self._slots[row.id] = row
+            if key is not None:
+                self._doctor_slots[key] = tuple(rows)
+
+    # ---------- Invalidation ----------
+
+    def expire(self, kinds) -> None:
+        """Drop the cached metadata of kinds."""
+        with self._lock:
+            for kind in kinds:
+                self._generations[kind] += 1
+                self.invalidations += 1
+                if kind == "doctors":
+                    self._doctors = None
+                elif kind == "slots":
+                    self._slots, self._doctor_slots = {}, {}
+
+    def _check(self, db: Session) -> None:
+        """Drop what other processes changed, at most once per check interval."""
+        if not self.enabled:
+            return
+        bind = db.get_bind()
+        if bind is not self._bind:
+            # another database, like a benchmark's fresh one
+            self.clear()
+            self._bind = bind
+        if time.monotonic() - self._checked_at < self.check_interval:
+            return
+        versions = MetadataVersionCRUD(db).get_versions()
+        self.checks += 1
+        with self._lock:
+            changed = [
+                kind
+                for kind, version in versions.items()
+                if self._versions.get(kind, version) != version
+            ]
+            self._versions = versions
+            self._checked_at = time.monotonic()
+        if changed:
+            self.expire(changed)
+
+    def _on_metadata_changed(self, kinds) -> None:
+        self.expire(kinds)
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "version_checks": self.checks,
+            "invalidations": self.invalidations,
+            "doctors": len(self._doctors[0]) if self._doctors else 0,
+            "slots": len(self._slots),
+        }
+
+
+def _as_uuid(value) -> uuid.UUID:
+    return value if isinstance(value, uuid.UUID) else uuid.UUID(str(value))
+
+
+metadata_cache = MetadataCache(
+    check_ms=settings.metadata_cache_check_ms,
+    max_slots=settings.metadata_cache_max_slots,
+    enabled=settings.metadata_cache_enabled,
+)
+event_bus.subscribe(METADATA_CHANGED, metadata_cache._on_metadata_changed)
@@ -1,9 +1,9 @@
 import enum
 import uuid
-from pydantic import BaseModel, ConfigDict
-from datetime import datetime, time
+from pydantic import BaseModel, ConfigDict, Field
+from datetime import date, datetime, time
 from enum import Enum, IntEnum
-from typing import Optional
+from typing import Any, Dict, List, Optional
 
 
 class TokenSource(str, enum.Enum):
@@ -63,16 +63,35 @@ class SlotResponse(SlotCreate):
         from_attributes = True
 
 
+class SlotAvailability(BaseModel):
+    id: uuid.UUID
+    doctor_id: uuid.UUID
+    date: datetime
+    start_time: time
+    end_time: time
+    capacity: int
+    active_count: int
+    # seats left, including emergency overflow already in use
+    available: int
+
+
 # ---------- Token ----------
 
 
 class TokenCreate(BaseModel):
-    doctor_id: uuid.UUID
-    slot_id: Optional[uuid.UUID]
+    # Either a doctor, or a specialization to pick any doctor of
+    doctor_id: Optional[uuid.UUID] = None
+    specialization: Optional[str] = None
+    slot_id: Optional[uuid.UUID] = None
     date: datetime
     source: TokenSource
     patient_name: str
     patient_contact: str
+    # Auto-assign only: days searched from `date` onwards and the time of day
+    # the slot has to fall into
+    search_days: int = Field(1, ge=1)
+    earliest_time: Optional[time] = None
+    latest_time: Optional[time] = None
 
 
 class TokenResponse(BaseModel):
@@ -84,3 +103,160 @@ class TokenResponse(BaseModel):
     status: TokenStatus
     created_at: datetime
     model_config = ConfigDict(from_attributes=True)
+
+
+class TokenIdsRequest(BaseModel):
+    token_ids: List[uuid.UUID] = Field(..., min_length=1, max_length=1000)
+
+
+class BulkTransitionResponse(BaseModel):
+    updated: List[uuid.UUID]
+    # unknown, or no longer active
+    skipped: List[uuid.UUID]
+
+
+class RescheduleRequest(BaseModel):
+    doctor_id: uuid.UUID
+    date: date
+    # only these slots of the doctor's day, default all of them
+    slot_ids: Optional[List[uuid.UUID]] = None
+    # days searched from `date` onwards for new slots
+    search_days: int = Field(1, ge=1)
+
+
+class RescheduledToken(BaseModel):
+    token_id: uuid.UUID
+    priority: int
+    from_slot_id: uuid.UUID
+    # None if no seat was left: the token is on the doctor's waiting list if
+    # booked on the day, else cancelled and to be booked again
+    to_slot_id: Optional[uuid.UUID]
+    doctor_id: uuid.UUID
+    status: TokenStatus
+
+
+class RescheduleResponse(BaseModel):
+    closed_slot_ids: List[uuid.UUID]
+    tokens: List[RescheduledToken]
+
+
+# ---------- Analytics ----------
+
+
+class UtilizationStats(BaseModel):
+    key: str
+    tokens: int
+    served: int
+    no_show: int
+    cancelled: int
+    displaced: int
+    capacity: int
+    no_show_rate: float
+    preemption_rate: float
+    avg_wait_minutes: Optional[float]
+    utilization: Optional[float]
+
+
+class AnalyticsResponse(BaseModel):
+    start: date
+    end: date
+    by_doctor: List[UtilizationStats]
+    by_slot: List[UtilizationStats]
+    by_source: List[UtilizationStats]
+
+
+# ---------- Admission ----------
+
+
+class AdmissionStats(BaseModel):
+    in_flight: int
+    max_in_flight: int
+    queue_size: int
+    queued: Dict[str, int]
+    admitted: Dict[str, int]
+    shed: Dict[str, int]
+    rate_limited: Dict[str, int]
+
+
+# ---------- Metadata cache ----------
+
+
+class MetadataCacheStats(BaseModel):
+    hits: int
+    misses: int
+    hit_ratio: float
+    version_checks: int
+    invalidations: int
+    doctors: int
+    slots: int
+
+
+# ---------- Queue position ----------
+
+
+class QueuePosition(BaseModel):
+    token_id: uuid.UUID
+    doctor_id: uuid.UUID
+    slot_id: Optional[uuid.UUID] = None
+    status: TokenStatus
+    # 1 = next, None once the token is served, cancelled or a no-show
+    position: Optional[int] = None
+    ahead: Optional[int] = None
+    queue_length: Optional[int] = None
+    # slot queues only: tokens of the slot served so far and the estimate
+    served: Optional[int] = None
+    consult_minutes: Optional[float] = None
+    estimated_time: Optional[datetime] = None
+
+
+# ---------- Tracing ----------
+
+
+class TraceStep(BaseModel):
+    name: str
+    at_ms: float
+    detail: Dict[str, Any]
+
+
+class DecisionTraceResponse(BaseModel):
+    kind: str
+    started_at: datetime
+    duration_ms: float
+    doctor_id: Optional[uuid.UUID]
+    token_ids: List[uuid.UUID]
+    request: Dict[str, Any]
+    steps: List[TraceStep]
+    outcome: Optional[str]
+    error: Optional[str]
+
+
+# ---------- Contention ----------
+
+
+class HotspotStats(BaseModel):
+    id: uuid.UUID
+    writes: int
+    conflicts: int
+    conflict_rate: float
+    wait_ms: float
+    max_wait_ms: float
+    hold_ms: float
+    max_hold_ms: float
+    busy: int
+
+
+class TransactionStats(BaseModel):
+    kind: str
+    count: int
+    rolled_back: int
+    busy: int
+    mean_ms: float
+    p95_ms: float
+    max_ms: float
+
+
+class ContentionReport(BaseModel):
+    since: datetime
+    slots: List[HotspotStats]
+    doctors: List[HotspotStats]
+    transactions: List[TransactionStats]
@@ -0,0 +1,157 @@
+"""
+Allocation policies: the rules AllocationService applies when it seats,
+preempts and promotes tokens.
+
+- admission: the priority a token source is allocated with, and whether a
+  slot's counters leave a seat for an incoming token
+- overflow: seats of a slot, capacity plus the emergency overflow allowed
+- victim selection: which active token, if any, a better one displaces
+- waiting-list ordering: which waiting or displaced tokens a freed seat goes
+  to, optionally aged so long waits are not starved by later, better tokens
+
+`AllocationPolicy` is the behaviour the service always had. The deployment
+picks one with `allocation_policy` (a name in POLICIES), `allow_preemption`,
+`max_emergency_overflow` and `policy_aging_minutes`. Compare them with
+`python -m app.benchmarks.policies`.
+
+The slot search prefilters candidates in SQL on capacity plus
+max_emergency_overflow and on strictly worse active priorities, so `seats`
+must not go above that and `victim` should only pick a worse token.
+"""
+
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence, Type
+from app.models import TokenPriority, TokenSource
+from app.settings import settings
+
+SOURCE_PRIORITY = {
+    TokenSource.emergency: TokenPriority.EMERGENCY,
+    TokenSource.paid: TokenPriority.PAID,
+    TokenSource.follow_up: TokenPriority.FOLLOW_UP,
+    TokenSource.walk_in: TokenPriority.WALK_IN,
+    TokenSource.online: TokenPriority.ONLINE,
+}
+
+
+class AllocationPolicy:
+    """Fixed source priorities, the worst active token is displaced."""
+
+    name = "default"
+
+    def __init__(
+        self,
+        max_emergency_overflow: int = 2,
+        allow_preemption: bool = True,
+        aging_minutes: int = 0,
+    ):
+        self.max_emergency_overflow = max_emergency_overflow
+        self.allow_preemption = allow_preemption
+        # waiting this long improves a token by one priority level, 0 = never
+        self.aging_minutes = aging_minutes
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.name}(overflow={self.max_emergency_overflow}, "
+            f"preemption={self.allow_preemption}, aging={self.aging_minutes})"
+        )
+
+    # ---------- Admission ----------
+
+    def priority(self, source: TokenSource) -> int:
+        """Priority a token is allocated with, lower is better."""
+        return SOURCE_PRIORITY[source]
+
+    def admits(self, counters, incoming_emergency: bool) -> bool:
+        """Whether a slot has a free seat for the incoming token."""
+        return counters.active_count < self.seats(counters, incoming_emergency)
+
+    # ---------- Overflow ----------
+
+    def seats(self, counters, incoming_emergency: bool = False) -> int:
+        """
+        Capacity plus the emergency overflow in use, counting the incoming
+        token if it is an emergency. A closed slot (capacity 0) has none.
+        """
+        if not counters.capacity:
+            return 0
+        return counters.capacity + min(
+            counters.emergency_count + incoming_emergency,
+            self.max_emergency_overflow,
+        )
+
+    # ---------- Victim selection ----------
+
+    def victim(self, active_tokens: Sequence, incoming_priority: int):
+        """
+        Active token of a full slot to displace for the incoming one, None to
+        turn it away. active_tokens come best first.
+        """
+        if not self.allow_preemption or not active_tokens:
+            return None
+        lowest = active_tokens[-1]
+        return lowest if incoming_priority < lowest.priority else None
+
+    # ---------- Waiting list ----------
+
+    @property
+    def reorders_waiting(self) -> bool:
+        """False if (priority, created_at), as the database sorts, is the order."""
+        return self.aging_minutes > 0
+
+    def waiting_order(self, tokens: Sequence, now: datetime) -> List:
+        """Waiting and displaced tokens in the order they get freed seats."""
+        if not self.reorders_waiting:
+            return list(tokens)
+        return sorted(tokens, key=lambda token: self._aged_key(token, now))
+
+    def _aged_key(self, token, now: datetime):
+        # updated_at is when the token was displaced or put on the list
+        waited = (now - token.updated_at).total_seconds() / 60
+        return (token.priority - int(waited // self.aging_minutes), token.created_at)
+
+
+class FifoPolicy(AllocationPolicy):
+    """
+    First come, first served: every source has the same priority and nobody
+    is displaced. Emergencies still take the overflow seats.
+    """
+
+    name = "fifo"
+
+    def priority(self, source: TokenSource) -> int:
+        return TokenPriority.ONLINE
+
+    def victim(self, active_tokens: Sequence, incoming_priority: int):
+        return None
+
+
+POLICIES: Dict[str, Type[AllocationPolicy]] = {
+    policy.name: policy for policy in (AllocationPolicy, FifoPolicy)
+}
+
+
+def make_policy(
+    name: str = "default",
+    max_emergency_overflow: Optional[int] = None,
+    allow_preemption: Optional[bool] = None,
+    aging_minutes: Optional[int] = None,
+) -> AllocationPolicy:
+    """A policy by name, options missing are taken from the settings."""
+    if name not in POLICIES:
+        raise ValueError(
+            f"Unknown allocation policy {name!r}, use one of {sorted(POLICIES)}"
+        )
+    return POLICIES[name](
+        max_emergency_overflow=settings.max_emergency_overflow
+        if max_emergency_overflow is None
+        else max_emergency_overflow,
+        allow_preemption=settings.allow_preemption
+        if allow_preemption is None
+        else allow_preemption,
+        aging_minutes=settings.policy_aging_minutes
+        if aging_minutes is None
+        else aging_minutes,
+    )
+
+
+allocation_policy = make_policy(settings.allocation_policy)
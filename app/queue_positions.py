@@ -0,0 +1,299 @@
+"""
+Live position and expected consultation time of a token.
+
+A token queues in its slot while it is active, and in its doctor's waiting
+list of the day it was booked while it is waiting or displaced. Each queue is
+held in memory as a sorted list of (priority, created_at, id) keys, the order
+patients are seen in and freed seats are handed out in, so a position is one
+bisect: O(log n) per poll however long the queue.
+
+Queues are loaded from the database when one of their tokens is first polled,
+then kept up to date from the service's TOKENS_CHANGED events: a token that
+changes state leaves one queue and is inserted into another, nothing is
+recomputed. Serves also time the doctor's consultations.
+
+Expected time of an active token, `ahead` tokens before it:
+
+    max(now, slot start, doctor's last serve + consult) + ahead * consult
+
+consult being the doctor's average time between serves, exponentially
+weighted and skipping gaps over `queue_consult_max_minutes` (breaks), or the
+slot length over its capacity until the doctor has served someone. Waiting
+and displaced tokens get a position but no time, they have no seat yet. With
+`policy_aging_minutes` seats go to waiting tokens in aged order, positions
+stay in plain priority order.
+
+Staleness bound: changes committed by this process apply at once. Other
+processes send no events, so a queue is reloaded when polled
+`queue_positions_max_age_ms` after it was loaded.
+"""
+
+import bisect
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta, UTC
+from itertools import groupby
+from typing import Dict, Hashable, List, Optional, Tuple
+from sqlalchemy.orm import Session
+from app import clock
+from app.crud.token import TokenCRUD
+from app.events import TOKENS_CHANGED, event_bus
+from app.metadata_cache import metadata_cache
+from app.models import TokenStatus
+from app.settings import settings
+
+# weight of the latest consultation in a doctor's average
+CONSULT_SMOOTHING = 0.2
+
+
+class _Queue:
+    """The keys of one queue in order, and each token's key and status."""
+
+    def __init__(self, doctor_id: uuid.UUID):
+        self.doctor_id = doctor_id
+        self.keys: List[Tuple] = []
+        self.tokens: Dict[uuid.UUID, Tuple[Tuple, TokenStatus]] = {}
+        # tokens of the slot served so far, slot queues only
+        self.served = 0
+        self.loaded_at = time.monotonic()
+
+    def add(self, token_id: uuid.UUID, key: Tuple, status: TokenStatus) -> None:
+        self.remove(token_id)
+        bisect.insort(self.keys, key)
+        self.tokens[token_id] = (key, status)
+
+    def remove(self, token_id: uuid.UUID) -> None:
+        entry = self.tokens.pop(token_id, None)
+        if entry is not None:
+            del self.keys[bisect.bisect_left(self.keys, entry[0])]
+
+
+class _Consult:
+    def __init__(self):
+        # seconds per consultation, None until two serves were seen
+        self.average: Optional[float] = None
+        self.last_served: Optional[datetime] = None
+
+
+class QueuePositions:
+    def __init__(self, max_age_ms: int, max_queues: int, consult_max_minutes: int):
+        self.max_age = max_age_ms / 1000
+        self.max_queues = max_queues
+        self.consult_max = timedelta(minutes=consult_max_minutes)
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._bind = None
+            self._queues: Dict[Hashable, _Queue] = {}
+            # token id -> key of its queue, for the loaded queues
+            self._token_queues: Dict[uuid.UUID, Hashable] = {}
+            self._consults: Dict[uuid.UUID, _Consult] = defaultdict(_Consult)
+            # bumped by every event, compared across a load
+            self._changes = 0
+            self.hits = self.loads = 0
+
+    def position(self, db: Session, token_id) -> Optional[Dict]:
+        """A token's place in its queue and expected time, None if unknown."""
+        token_id = _as_uuid(token_id)
+        self._check(db)
+        # a second try if the token moved while it was being looked up
+        for _ in range(2):
+            with self._lock:
+                queue_key = self._token_queues.get(token_id)
+                queue = self._queues.get(queue_key)
+            if queue is not None and time.monotonic() - queue.loaded_at < self.max_age:
+                self.hits += 1
+            else:
+                row = TokenCRUD(db).get_token_queue_row(token_id)
+                if row is None:
+                    return None
+                queue_key = _queue_key(
+                    row.status, row.slot_id, row.doctor_id, row.created_at
+                )
+                if queue_key is None:
+                    # served, cancelled or no-show: out of every queue
+                    return {
+                        "token_id": token_id,
+                        "doctor_id": row.doctor_id,
+                        "slot_id": row.slot_id,
+                        "status": row.status,
+                    }
+                queue = self._load(db, queue_key, row.doctor_id)
+            with self._lock:
+                entry = queue.tokens.get(token_id)
+                if entry is not None:
+                    key, status = entry
+                    ahead = bisect.bisect_left(queue.keys, key)
+                    queue_length, served = len(queue.keys), queue.served
+                    break
+        else:
+            raise Exception("Token is busy, please retry")
+
+        position = {
+            "token_id": token_id,
+            "doctor_id": queue.doctor_id,
+            "status": status,
+            "position": ahead + 1,
+            "ahead": ahead,
+            "queue_length": queue_length,
+        }
+        if queue_key[0] == "slot":
+            consult, expected = self._estimate(db, queue_key[1], queue.doctor_id, ahead)
+            position.update(
+                slot_id=queue_key[1],
+                served=served,
+                consult_minutes=consult,
+                estimated_time=expected,
+            )
+        return position
+
+    def _estimate(
+        self, db: Session, slot_id: uuid.UUID, doctor_id: uuid.UUID, ahead: int
+    ) -> Tuple[Optional[float], Optional[datetime]]:
+        """Minutes per consultation and when a token is expected to be seen."""
+        slot = metadata_cache.slot(db, slot_id)
+        if slot is None:
+            return None, None
+        day = slot.date.date() if isinstance(slot.date, datetime) else slot.date
+        start = datetime.combine(day, slot.start_time)
+        consult_info = self._consults.get(doctor_id) or _Consult()
+        if consult_info.average is not None:
+            consult = timedelta(seconds=consult_info.average)
+        else:
+            end = datetime.combine(day, slot.end_time)
+            consult = (end - start) / max(slot.capacity, 1)
+        begin = max(clock.now().replace(tzinfo=None), start)
+        if consult_info.last_served is not None:
+            begin = max(begin, consult_info.last_served + consult)
+        expected = begin + ahead * consult
+        return consult.total_seconds() / 60, expected.replace(tzinfo=UTC)
+
+    # ---------- Loading ----------
+
+    def _load(
+        self, db: Session, queue_key: Hashable, doctor_id: uuid.UUID
+    ) -> _Queue:
+        changes = self._changes
+        crud = TokenCRUD(db)
+        served = []
+        if queue_key[0] == "slot":
+            rows = crud.get_queue_rows_for_slot(queue_key[1])
+            served = crud.get_served_times_for_slot(queue_key[1])
+        else:
+            rows = crud.get_queue_rows_for_doctor_by_date(doctor_id, queue_key[2])
+        queue = _Queue(doctor_id)
+        for row in rows:
+            queue.add(row.id, _key(row.priority, row.created_at, row.id), row.status)
+        queue.served = len(served)
+        self.loads += 1
+
+        with self._lock:
+            if self._changes != changes:
+                # a change committed while loading may be missing from it
+                return queue
+            old = self._queues.pop(queue_key, None)
+            if old is not None:
+                for token_id in old.tokens:
+                    self._token_queues.pop(token_id, None)
+            if len(self._queues) >= self.max_queues:
+                self._queues, self._token_queues = {}, {}
+            self._queues[queue_key] = queue
+            for token_id in queue.tokens:
+                self._token_queues[token_id] = queue_key
+            if served and self._consults[doctor_id].last_served is None:
+                # served by other processes, or before this one started
+                for served_at, group in groupby(served):
+                    self._served(doctor_id, len(list(group)), served_at)
+        return queue
+
+    def _check(self, db: Session) -> None:
+        bind = db.get_bind()
+        if bind is not self._bind:
+            # another database, like a benchmark's fresh one
+            self.clear()
+            self._bind = bind
+
+    # ---------- Events ----------
+
+    def _on_tokens_changed(self, tokens) -> None:
+        served = defaultdict(int)
+        with self._lock:
+            self._changes += 1
+            for token_id, doctor_id, slot_id, status, priority, created_at in tokens:
+                token_id = _as_uuid(token_id)
+                doctor_id = _as_uuid(doctor_id)
+                slot_id = slot_id and _as_uuid(slot_id)
+                old_key = self._token_queues.pop(token_id, None)
+                if old_key is not None:
+                    self._queues[old_key].remove(token_id)
+                queue_key = _queue_key(status, slot_id, doctor_id, created_at)
+                queue = self._queues.get(queue_key)
+                if queue is not None:
+                    queue.add(token_id, _key(priority, created_at, token_id), status)
+                    self._token_queues[token_id] = queue_key
+                if status == TokenStatus.served:
+                    served[doctor_id] += 1
+                    slot_queue = self._queues.get(("slot", slot_id))
+                    if slot_queue is not None:
+                        slot_queue.served += 1
+            now = clock.now().replace(tzinfo=None)
+            for doctor_id, count in served.items():
+                self._served(doctor_id, count, now)
+
+    def _served(self, doctor_id: uuid.UUID, count: int, at: datetime) -> None:
+        """Time the consultations ended by count serves of a doctor at `at`."""
+        consult = self._consults[doctor_id]
+        if consult.last_served is not None:
+            # a bulk serve ends several consultations at once
+            gap = (at - consult.last_served) / count
+            if timedelta(0) < gap <= self.consult_max:
+                seconds = gap.total_seconds()
+                if consult.average is None:
+                    consult.average = seconds
+                else:
+                    consult.average += CONSULT_SMOOTHING * (seconds - consult.average)
+            if at < consult.last_served:
+                return
+        consult.last_served = at
+
+    def stats(self) -> Dict:
+        return {
+            "hits": self.hits,
+            "loads": self.loads,
+            "queues": len(self._queues),
+            "tokens": len(self._token_queues),
+        }
+
+
+def _queue_key(status, slot_id, doctor_id, created_at) -> Optional[Hashable]:
+    """The queue a token in this state is in, None for final statuses."""
+    if status == TokenStatus.active and slot_id is not None:
+        return ("slot", _as_uuid(slot_id))
+    if status in (TokenStatus.waiting, TokenStatus.displaced):
+        return ("waiting", _as_uuid(doctor_id), _naive(created_at).date())
+    return None
+
+
+def _key(priority: int, created_at: datetime, token_id: uuid.UUID) -> Tuple:
+    return (priority, _naive(created_at), token_id.bytes)
+
+
+def _naive(value: datetime) -> datetime:
+    # the database returns naive UTC, the service's clock is aware
+    return value.replace(tzinfo=None) if value.tzinfo else value
+
+
+def _as_uuid(value) -> uuid.UUID:
+    return value if isinstance(value, uuid.UUID) else uuid.UUID(str(value))
+
+
+queue_positions = QueuePositions(
+    max_age_ms=settings.queue_positions_max_age_ms,
+    max_queues=settings.queue_positions_max_queues,
+    consult_max_minutes=settings.queue_consult_max_minutes,
+)
+event_bus.subscribe(TOKENS_CHANGED, queue_positions._on_tokens_changed)
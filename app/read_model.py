@@ -0,0 +1,309 @@
+"""
+Read model for the polling endpoints (CQRS).
+
+Waiting lists, slot lists and slot availability are served as pre-serialized
+JSON snapshots held in memory, so reception polling does not query the tables
+the allocation path is writing. Snapshots are invalidated by the service's
+QUEUE_CHANGED and SLOT_CHANGED events and rebuilt from the database on the next
+read, at most once per staleness window.
+
+Staleness bound:
+- writes committed by this process show up within `read_model_staleness_ms`
+- writes from other processes, which send no events, within
+  `read_model_max_age_ms`
+Setting both to 0 reads through to the database on every request.
+
+A snapshot holds the rows of its view, and the JSON of each `fields=`
+selection and encoding asked for, serialized and gzipped once per build
+(app/serialization.py). Changes since a cursor read through to the database,
+every client has its own cursor.
+
+Snapshots are kept for at most `read_model_max_snapshots` views and slot dates
+for `read_model_max_slots` slots; past either everything held is dropped and
+rebuilt on demand.
+"""
+
+import threading
+import time
+import uuid
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, Hashable, List, Optional, Tuple, Type
+from pydantic import BaseModel
+from sqlalchemy.orm import Session
+from app import clock
+from app.crud.slot import SlotCRUD
+from app.crud.token import TokenCRUD
+from app.db import SessionLocal
+from app.events import QUEUE_CHANGED, SLOT_CHANGED, event_bus
+from app.models import SlotAvailability, SlotResponse, TokenResponse
+from app.serialization import (
+    AVAILABILITY_FIELDS,
+    SLOT_FIELDS,
+    TOKEN_FIELDS,
+    Payload,
+    dump_fields,
+    encode,
+)
+from app.settings import settings
+
+# bodies kept per snapshot, one per fields= selection and encoding
+MAX_BODIES = 16
+
+
+class _Snapshot:
+    def __init__(self, rows: List[Tuple], cursor: datetime):
+        self.rows = rows
+        self.cursor = cursor
+        self.built_at = time.monotonic()
+        self.dirty = False
+        # (fields, gzip) -> body and its encoding
+        self.bodies: Dict[Tuple, Tuple[bytes, Optional[str]]] = {}
+
+
+class ReadModel:
+    def __init__(
+        self,
+        staleness_ms: int,
+        max_age_ms: int,
+        cursor_lag_ms: int,
+        max_snapshots: int,
+        max_slots: int,
+        session_factory: Callable[[], Session] = SessionLocal,
+    ):
+        self.staleness = staleness_ms / 1000
+        self.max_age = max_age_ms / 1000
+        self.cursor_lag = timedelta(milliseconds=cursor_lag_ms)
+        self.max_snapshots = max_snapshots
+        self.max_slots = max_slots
+        self.session_factory = session_factory
+        self._snapshots: Dict[Hashable, _Snapshot] = {}
+        # slot id -> date of the slot, to find the dated views it is in
+        self._slot_dates: Dict[uuid.UUID, date] = {}
+        self._build_locks: Dict[Hashable, threading.Lock] = {}
+        # bumped on every change event, compared across a build
+        self._generations: Dict[Hashable, int] = {}
+        # bumped when everything is dropped, generations start over
+        self._resets = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.builds = 0
+
+    def waiting_list(
+        self,
+        doctor_id: uuid.UUID,
+        fields: Tuple[str, ...] = TOKEN_FIELDS,
+        gzip: bool = False,
+    ) -> Payload:
+        def build(db: Session) -> List[Tuple]:
+            return TokenCRUD(db).get_waiting_token_rows_for_doctor(
+                doctor_id, TOKEN_FIELDS
+            )
+
+        key = ("waiting", doctor_id)
+        return self._get(key, build, TokenResponse, fields, gzip)
+
+    def slots(
+        self,
+        request_date: Optional[date],
+        fields: Tuple[str, ...] = SLOT_FIELDS,
+        gzip: bool = False,
+    ) -> Payload:
+        def build(db: Session) -> List[Tuple]:
+            rows = SlotCRUD(db).get_slot_rows(SLOT_FIELDS, request_date)
+            if request_date:
+                self._remember_slots(SLOT_FIELDS, rows, request_date)
+            return rows
+
+        key = ("slots", request_date)
+        return self._get(key, build, SlotResponse, fields, gzip)
+
+    def availability(
+        self,
+        request_date: Optional[date],
+        fields: Tuple[str, ...] = AVAILABILITY_FIELDS,
+        gzip: bool = False,
+    ) -> Payload:
+        def build(db: Session) -> List[Tuple]:
+            rows = SlotCRUD(db).get_slot_availability_rows(
+                AVAILABILITY_FIELDS, settings.max_emergency_overflow, request_date
+            )
+            self._remember_slots(AVAILABILITY_FIELDS, rows)
+            return rows
+
+        key = ("availability", request_date)
+        return self._get(key, build, SlotAvailability, fields, gzip)
+
+    # ---------- Changes since a cursor ----------
+
+    def waiting_list_changes(
+        self,
+        doctor_id: uuid.UUID,
+        since: datetime,
+        fields: Tuple[str, ...] = TOKEN_FIELDS,
+        gzip: bool = False,
+    ) -> Payload:
+        """
+        The doctor's tokens changed since the cursor, whatever their status:
+        those no longer waiting left the list.
+        """
+
+        def read(db: Session) -> List[Tuple]:
+            return TokenCRUD(db).get_changed_token_rows_for_doctor(
+                doctor_id, since, TOKEN_FIELDS
+            )
+
+        return self._changes(since, read, TokenResponse, fields, gzip)
+
+    def slot_changes(
+        self,
+        request_date: Optional[date],
+        since: datetime,
+        fields: Tuple[str, ...] = SLOT_FIELDS,
+        gzip: bool = False,
+    ) -> Payload:
+        def read(db: Session) -> List[Tuple]:
+            return SlotCRUD(db).get_slot_rows(SLOT_FIELDS, request_date, since)
+
+        return self._changes(since, read, SlotResponse, fields, gzip)
+
+    def _changes(
+        self,
+        since: datetime,
+        read: Callable[[Session], List[Tuple]],
+        model: Type[BaseModel],
+        fields: Tuple[str, ...],
+        gzip: bool,
+    ) -> Payload:
+        # taken before reading, a change committed meanwhile is at or after it
+        cursor = max(since, self._cursor())
+        db = self.session_factory()
+        try:
+            rows = read(db)
+        finally:
+            db.close()
+        return Payload(*encode(dump_fields(model, fields, rows), gzip), cursor)
+
+    def _cursor(self) -> datetime:
+        """
+        Changes at or after this are not committed yet or are read now. It
+        lags the clock, a transaction stamps its rows before it commits.
+        """
+        return clock.now().replace(tzinfo=None) - self.cursor_lag
+
+    def clear(self) -> None:
+        with self._lock:
+            self._reset()
+
+    def _reset(self) -> None:
+        """Drop everything held, called with the lock."""
+        self._snapshots = {}
+        self._slot_dates = {}
+        self._build_locks = {}
+        self._generations = {}
+        self._resets += 1
+
+    def _get(
+        self,
+        key: Hashable,
+        build: Callable[[Session], List[Tuple]],
+        model: Type[BaseModel],
+        fields: Tuple[str, ...],
+        gzip: bool,
+    ) -> Payload:
+        snapshot = self._snapshot(key, build)
+        body = snapshot.bodies.get((fields, gzip))
+        if body is None:
+            body = encode(dump_fields(model, fields, snapshot.rows), gzip)
+            if len(snapshot.bodies) < MAX_BODIES:
+                snapshot.bodies[fields, gzip] = body
+        return Payload(*body, snapshot.cursor)
+
+    def _snapshot(
+        self, key: Hashable, build: Callable[[Session], List[Tuple]]
+    ) -> _Snapshot:
+        snapshot = self._snapshots.get(key)
+        if snapshot is not None and self._fresh(snapshot):
+            self.hits += 1
+            return snapshot
+
+        with self._lock:
+            if (
+                key not in self._build_locks
+                and len(self._build_locks) >= self.max_snapshots
+            ):
+                self._reset()
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
+        # one reader rebuilds, the others wait for its result
+        with build_lock:
+            snapshot = self._snapshots.get(key)
+            if snapshot is not None and self._fresh(snapshot):
+                self.hits += 1
+                return snapshot
+            generation = self._resets, self._generations.get(key, 0)
+            cursor = self._cursor()
+            db = self.session_factory()
+            try:
+                fresh = _Snapshot(build(db), cursor)
+            finally:
+                db.close()
+            with self._lock:
+                # a change committed while building may be missing from it
+                fresh.dirty = (
+                    self._resets,
+                    self._generations.get(key, 0),
+                ) != generation
+                self._snapshots[key] = fresh
+            self.builds += 1
+            return fresh
+
+    def _fresh(self, snapshot: _Snapshot) -> bool:
+        age = time.monotonic() - snapshot.built_at
+        limit = self.staleness if snapshot.dirty else self.max_age
+        return age < limit
+
+    def _mark_dirty(self, key: Hashable) -> None:
+        with self._lock:
+            # only views read since the last reset can be building
+            if key not in self._build_locks:
+                return
+            self._generations[key] = self._generations.get(key, 0) + 1
+            snapshot = self._snapshots.get(key)
+            if snapshot is not None:
+                snapshot.dirty = True
+
+    def _on_queue_changed(self, doctor_id) -> None:
+        self._mark_dirty(("waiting", _as_uuid(doctor_id)))
+
+    def _on_slot_changed(self, slot_id) -> None:
+        slot_date = self._slot_dates.get(_as_uuid(slot_id))
+        # the slot list has no counters, but closing a slot changes its capacity
+        for view in ("availability", "slots"):
+            self._mark_dirty((view, None))
+            if slot_date is not None:
+                self._mark_dirty((view, slot_date))
+
+    def _remember_slots(self, columns, rows, slot_date: Optional[date] = None):
+        """Dates of the slots, from a date column unless they share slot_date."""
+        id_index = columns.index("id")
+        date_index = None if slot_date else columns.index("date")
+        with self._lock:
+            if len(self._slot_dates) + len(rows) > self.max_slots:
+                # the dated views would miss changes of the slots forgotten
+                self._reset()
+            for row in rows:
+                self._slot_dates[row[id_index]] = slot_date or row[date_index].date()
+
+
+def _as_uuid(value) -> uuid.UUID:
+    return value if isinstance(value, uuid.UUID) else uuid.UUID(str(value))
+
+
+read_model = ReadModel(
+    staleness_ms=settings.read_model_staleness_ms,
+    max_age_ms=settings.read_model_max_age_ms,
+    cursor_lag_ms=settings.delta_cursor_lag_ms,
+    max_snapshots=settings.read_model_max_snapshots,
+    max_slots=settings.read_model_max_slots,
+)
+event_bus.subscribe(QUEUE_CHANGED, read_model._on_queue_changed)
+event_bus.subscribe(SLOT_CHANGED, read_model._on_slot_changed)
@@ -0,0 +1,230 @@
+"""
+Replay a captured request stream against a fresh database.
+
+    python -m app.replay capture.jsonl.gz [--state-out state.json] [--show 10]
+
+Loads the capture's snapshot into a throwaway SQLite database and feeds every
+request through AllocationService in capture order, with the allocation clock
+frozen at each request's captured time. Reports the requests whose result
+differs from the captured one, the final token and slot state against the
+capture's final state (or against --compare, a state written by an earlier
+replay with --state-out), and the replayed against the captured time per
+operation. Requests are replayed one at a time, captured times also include
+the queueing and concurrency of the live server.
+
+Use it to check that an allocator change keeps decisions identical, or to see
+how it changes them and what it costs, on real traffic.
+"""
+
+import argparse
+import json
+import statistics
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+from sqlalchemy import insert, select
+from app import clock
+from app.batch import make_service, temp_database
+from app.capture import SNAPSHOT_TABLES, encode, load_rows, open_log
+from app.models import RescheduleRequest, TokenCreate
+from app.schemas import Slot, Token
+from app.specialization_index import specialization_index
+
+OPERATIONS = {
+    "cancel": "cancel_token",
+    "serve": "serve_token",
+    "no_show": "mark_no_show",
+    "serve_many": "serve_tokens",
+    "no_show_many": "mark_no_shows",
+}
+
+
+def read_log(path: str) -> Iterator[Dict]:
+    with open_log(path, "r") as f:
+        try:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        except EOFError:
+            pass  # gzip cut off by a crash, keep what was written
+
+
+class Replay:
+    def __init__(self, Session):
+        self.Session = Session
+        # captured token id -> token id in the replay database
+        self.token_ids: Dict[str, str] = {}
+        self.diffs: List[str] = []
+        self.timings: Dict[str, List[float]] = defaultdict(list)
+        self.captured_ms: Dict[str, List[float]] = defaultdict(list)
+
+    def load_snapshot(self, entry: Dict) -> None:
+        db = self.Session()
+        for table in SNAPSHOT_TABLES:
+            rows = load_rows(table, entry["tables"][table.name])
+            if rows:
+                db.execute(insert(table), rows)
+            if table is Token.__table__:
+                self.token_ids.update((str(r["id"]),) * 2 for r in rows)
+        db.commit()
+        db.close()
+
+    def replay_id(self, captured_id: str) -> uuid.UUID:
+        return uuid.UUID(self.token_ids.get(captured_id, captured_id))
+
+    def run(self, n: int, entry: Dict) -> None:
+        op = entry["op"]
+        clock.freeze(datetime.fromisoformat(entry["at"]))
+        db = self.Session()
+        service = make_service(db)
+        started = time.perf_counter()
+        error = result = None
+        try:
+            if op == "allocate":
+                token = service.allocate_token(
+                    TokenCreate(
+                        **entry["request"],
+                        patient_name="Replay",
+                        patient_contact="0000000000",
+                    )
+                )
+                result = {
+                    "id": encode(token.id),
+                    "slot_id": encode(token.slot_id),
+                    "status": encode(token.status),
+                }
+            elif op == "reschedule":
+                response = service.reschedule(RescheduleRequest(**entry["request"]))
+                result = [encode(token.to_slot_id) for token in response.tokens]
+            elif "token_ids" in entry:
+                token_ids = [self.replay_id(t) for t in entry["token_ids"]]
+                released = getattr(service, OPERATIONS[op])(token_ids)
+                result = [encode(token_id) for token_id in released]
+            else:
+                token_id = self.replay_id(entry["token_id"])
+                result = getattr(service, OPERATIONS[op])(token_id)
+        except Exception as e:
+            error = str(e)
+        finally:
+            elapsed = time.perf_counter() - started
+            db.close()
+        self.timings[op].append(elapsed * 1e3)
+        self.captured_ms[op].append(entry["ms"])
+
+        expected = entry.get("result")
+        if "token_ids" in entry and expected is not None:
+            expected = [str(self.replay_id(token_id)) for token_id in expected]
+        if op == "allocate" and result is not None and expected is not None:
+            self.token_ids[expected["id"]] = result["id"]
+            expected = {k: v for k, v in expected.items() if k != "id"}
+            result = {k: v for k, v in result.items() if k != "id"}
+        if (error, result) != (entry.get("error"), expected):
+            got = error if error is not None else result
+            want = entry.get("error", expected)
+            self.diffs.append(f"#{n} {op}: captured {want!r}, replayed {got!r}")
+
+    def state(self) -> Dict[str, Dict[str, list]]:
+        """Final token and slot state, tokens under their captured ids."""
+        captured_ids = {v: k for k, v in self.token_ids.items()}
+        db = self.Session()
+        tokens = {
+            captured_ids.get(str(row.id), f"replay:{row.id}"): [
+                encode(row.status),
+                encode(row.slot_id),
+            ]
+            for row in db.execute(select(Token.id, Token.status, Token.slot_id))
+        }
+        slots = {
+            str(row.id): [row.active_count, row.emergency_count]
+            for row in db.execute(
+                select(Slot.id, Slot.active_count, Slot.emergency_count)
+            )
+        }
+        db.close()
+        return {"tokens": tokens, "slots": slots}
+
+
+def final_state(entry: Dict) -> Dict[str, Dict[str, list]]:
+    tokens = entry["tables"]["tokens"]
+    slots = entry["tables"]["slots"]
+    return {
+        "tokens": {row[0]: [row[1], row[2]] for row in tokens["rows"]},
+        "slots": {row[0]: [row[1], row[2]] for row in slots["rows"]},
+    }
+
+
+def state_diffs(expected: Dict, actual: Dict) -> List[str]:
+    diffs = []
+    for kind in ("tokens", "slots"):
+        for key in sorted(set(expected[kind]) | set(actual[kind])):
+            want, got = expected[kind].get(key), actual[kind].get(key)
+            if want != got:
+                diffs.append(f"{kind[:-1]} {key}: expected {want}, replayed {got}")
+    return diffs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("capture", help="file written with capture_file")
+    parser.add_argument("--compare", help="state written by --state-out")
+    parser.add_argument("--state-out", help="write the final state here")
+    parser.add_argument("--show", type=int, default=10, help="differences listed")
+    args = parser.parse_args()
+
+    specialization_index.clear()
+    final: Optional[Dict] = None
+    requests = 0
+    with temp_database() as Session:
+        replay = Replay(Session)
+        started = time.perf_counter()
+        for entry in read_log(args.capture):
+            if entry["op"] == "snapshot":
+                if requests or final:
+                    print("second snapshot found, replaying the first run only")
+                    break
+                replay.load_snapshot(entry)
+            elif entry["op"] == "final":
+                final = final_state(entry)
+            else:
+                requests += 1
+                replay.run(requests, entry)
+        elapsed = time.perf_counter() - started
+        clock.freeze(None)
+        state = replay.state()
+
+    if args.state_out:
+        with open(args.state_out, "w") as f:
+            json.dump(state, f)
+
+    print(f"{requests} requests replayed in {elapsed:.2f}s")
+    for op, timings in sorted(replay.timings.items()):
+        timings.sort()
+        print(
+            f"  {op:<10}{len(timings):7} x  replayed mean "
+            f"{statistics.mean(timings):7.2f} ms  p95 "
+            f"{timings[int(len(timings) * 0.95)]:7.2f} ms  captured mean "
+            f"{statistics.mean(replay.captured_ms[op]):7.2f} ms"
+        )
+
+    print(f"{len(replay.diffs)} requests with a different result")
+    for diff in replay.diffs[: args.show]:
+        print(f"  {diff}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            expected, against = json.load(f), args.compare
+    else:
+        expected, against = final, "the captured final state"
+    if expected is None:
+        print("no final state captured, the server did not shut down cleanly")
+        return
+    diffs = state_diffs(expected, state)
+    print(f"{len(diffs)} differences in final state against {against}")
+    for diff in diffs[: args.show]:
+        print(f"  {diff}")
+
+
+if __name__ == "__main__":
+    main()
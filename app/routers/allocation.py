@@ -1,40 +1,185 @@
-from fastapi import APIRouter, Depends, HTTPException
+import uuid
+import anyio
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
-from typing import List
+from datetime import date as date_type, datetime, timedelta, UTC
+from typing import List, Optional
 from app import db
+from app.admission import AdmissionRejected, admission_controller
 from app.allocation_service import AllocationService
+from app.contention import contention
 from app.crud.doctor import DoctorCRUD
 from app.crud.slot import SlotCRUD
 from app.crud.token import TokenCRUD
-from app.models import SlotResponse, TokenCreate, TokenResponse
-from app.schemas import Doctor
+from app.idempotency import (
+    IdempotencyKeyInProgress,
+    IdempotencyKeyMismatch,
+    idempotency_store,
+)
+from app.metadata_cache import metadata_cache
+from app.models import (
+    AdmissionStats,
+    AnalyticsResponse,
+    BulkTransitionResponse,
+    ContentionReport,
+    DecisionTraceResponse,
+    DoctorResponse,
+    MetadataCacheStats,
+    QueuePosition,
+    RescheduleRequest,
+    RescheduleResponse,
+    SlotAvailability,
+    SlotResponse,
+    TokenCreate,
+    TokenIdsRequest,
+    TokenResponse,
+)
+from app.queue_positions import queue_positions
+from app.read_model import read_model
+from app.serialization import (
+    AVAILABILITY_FIELDS,
+    SLOT_FIELDS,
+    TOKEN_FIELDS,
+    accepts_gzip,
+    payload_response,
+    select_fields,
+)
+from app.tracing import tracer
 
 router = APIRouter(prefix="/allocation", tags=["allocation"])
 
 
 def get_allocation_service(db_session: Session = Depends(db.get_db)):
-    DoctorCRUD.set_db_session(db_session)
-    SlotCRUD.set_db_session(db_session)
-    TokenCRUD.set_db_session(db_session)
-    return AllocationService(DoctorCRUD(), SlotCRUD(), TokenCRUD())
+    # Sessions are passed per request, the class-level default is shared by
+    # every concurrent request
+    return AllocationService(
+        DoctorCRUD(db_session), SlotCRUD(db_session), TokenCRUD(db_session)
+    )
+
+
+def get_analytics_service(db_session: Session = Depends(db.get_db)):
+    # Imported on first use so workers do not load NumPy at startup
+    from app.analytics import AnalyticsService
+
+    return AnalyticsService(SlotCRUD(db_session), TokenCRUD(db_session))
+
+
+def parse_date(date_str: Optional[str]) -> Optional[date_type]:
+    if not date_str:
+        return None
+    try:
+        return datetime.strptime(date_str, "%Y-%m-%d").date()
+    except ValueError:
+        raise HTTPException(
+            status_code=400, detail="Invalid date format. Use YYYY-MM-DD."
+        )
+
+
+def parse_fields(fields: Optional[str], all_fields):
+    try:
+        return select_fields(fields, all_fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def parse_since(since: Optional[str]) -> Optional[datetime]:
+    """A since= cursor as naive UTC, like the database columns."""
+    if not since:
+        return None
+    try:
+        cursor = datetime.fromisoformat(since)
+    except ValueError:
+        raise HTTPException(
+            status_code=400, detail="Invalid since. Use the X-Since of a response."
+        )
+    if cursor.tzinfo is not None:
+        cursor = cursor.astimezone(UTC).replace(tzinfo=None)
+    return cursor
 
 
 @router.post("/tokens", response_model=TokenResponse)
 async def allocate_token(
     token_request: TokenCreate,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
     service: AllocationService = Depends(get_allocation_service),
 ):
     """Allocate a token to a slot or waiting list."""
+    if idempotency_key:
+        try:
+            stored = await run_in_threadpool(
+                idempotency_store.reserve, idempotency_key, token_request
+            )
+        except IdempotencyKeyInProgress as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        except IdempotencyKeyMismatch as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        if stored is not None:
+            return stored
+
+    response = None
+    try:
+        async with admission_controller.admit(token_request.source):
+            response = await run_in_threadpool(_allocate, service, token_request)
+    except AdmissionRejected as e:
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        if idempotency_key:
+            # also when the client went away and the request is cancelled
+            with anyio.CancelScope(shield=True):
+                await _settle_key(idempotency_key, token_request, response)
+    return response
+
+
+async def _settle_key(key: str, token_request: TokenCreate, response) -> None:
+    """Store the response for a reserved key, or free it for a retry."""
+    if response is not None:
+        await run_in_threadpool(
+            idempotency_store.complete, key, token_request, response
+        )
+    else:
+        await run_in_threadpool(idempotency_store.release, key)
+
+
+def _allocate(service: AllocationService, token_request: TokenCreate) -> TokenResponse:
+    # Runs in the thread pool, building the response reloads the committed token
+    return TokenResponse.model_validate(service.allocate_token(token_request))
+
+
+@router.get("/tokens/{token_id}", response_model=TokenResponse)
+async def get_token(
+    token_id: uuid.UUID, service: AllocationService = Depends(get_allocation_service)
+):
+    """Get a token, including archived ones."""
+    token = service.get_token(token_id)
+    if not token:
+        raise HTTPException(status_code=404, detail="Token not found")
+    return TokenResponse.model_validate(token)
+
+
+@router.get("/tokens/{token_id}/position", response_model=QueuePosition)
+async def get_queue_position(
+    token_id: uuid.UUID, db_session: Session = Depends(db.get_db)
+):
+    """Place of a token in its slot or waiting list, and when it is expected."""
     try:
-        token = service.allocate_token(token_request)
-        return TokenResponse.model_validate(token)
+        position = queue_positions.position(db_session, token_id)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
+    if position is None:
+        raise HTTPException(status_code=404, detail="Token not found")
+    return position
 
 
 @router.put("/tokens/{token_id}/cancel")
 async def cancel_token(
-    token_id: str, service: AllocationService = Depends(get_allocation_service)
+    token_id: uuid.UUID, service: AllocationService = Depends(get_allocation_service)
 ):
     """Cancel a token and reallocate if possible."""
     if not service.cancel_token(token_id):
@@ -44,7 +189,7 @@ async def cancel_token(
 
 @router.put("/tokens/{token_id}/serve")
 async def serve_token(
-    token_id: str, service: AllocationService = Depends(get_allocation_service)
+    token_id: uuid.UUID, service: AllocationService = Depends(get_allocation_service)
 ):
     """Mark token as served."""
     if not service.serve_token(token_id):
@@ -54,7 +199,7 @@ async def serve_token(
 
 @router.put("/tokens/{token_id}/no_show")
 async def mark_no_show(
-    token_id: str, service: AllocationService = Depends(get_allocation_service)
+    token_id: uuid.UUID, service: AllocationService = Depends(get_allocation_service)
 ):
     """Mark token as no-show and reallocate."""
     if not service.mark_no_show(token_id):
@@ -62,18 +207,86 @@ async def mark_no_show(
     return {"message": "Token marked as no-show"}
 
 
+@router.put("/tokens/serve", response_model=BulkTransitionResponse)
+async def serve_tokens(
+    request: TokenIdsRequest,
+    service: AllocationService = Depends(get_allocation_service),
+):
+    """Mark several tokens as served at once, for the doctor's console."""
+    return await _bulk_transition(service.serve_tokens, request.token_ids)
+
+
+@router.put("/tokens/no_show", response_model=BulkTransitionResponse)
+async def mark_no_shows(
+    request: TokenIdsRequest,
+    service: AllocationService = Depends(get_allocation_service),
+):
+    """Mark several tokens as no-show at once and reallocate."""
+    return await _bulk_transition(service.mark_no_shows, request.token_ids)
+
+
+async def _bulk_transition(transition, token_ids: List[uuid.UUID]):
+    try:
+        updated = await run_in_threadpool(transition, token_ids)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    done = set(updated)
+    return BulkTransitionResponse(
+        updated=updated, skipped=[t for t in token_ids if t not in done]
+    )
+
+
+@router.post("/reschedule", response_model=RescheduleResponse)
+async def reschedule(
+    request: RescheduleRequest,
+    service: AllocationService = Depends(get_allocation_service),
+):
+    """Close a doctor's slots of a day and move their tokens elsewhere."""
+    try:
+        return await run_in_threadpool(service.reschedule, request)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 @router.get("/doctors/{doctor_id}/waiting", response_model=List[TokenResponse])
 async def get_waiting_list(
-    doctor_id: str, service: AllocationService = Depends(get_allocation_service)
+    doctor_id: uuid.UUID,
+    fields: Optional[str] = None,
+    since: Optional[str] = None,
+    accept_encoding: Optional[str] = Header(None),
 ):
-    """Get waiting list for a doctor."""
-    tokens = service.get_waiting_list(doctor_id)
+    """Get waiting list for a doctor, or its changes since a cursor."""
+    selected = parse_fields(fields, TOKEN_FIELDS)
+    cursor = parse_since(since)
+    gzip = accepts_gzip(accept_encoding)
+    if cursor is None:
+        view = read_model.waiting_list
+        payload = await run_in_threadpool(view, doctor_id, selected, gzip)
+    else:
+        # with status, the only way to tell a token left the list
+        selected = tuple(f for f in TOKEN_FIELDS if f in selected or f == "status")
+        view = read_model.waiting_list_changes
+        payload = await run_in_threadpool(view, doctor_id, cursor, selected, gzip)
+    return payload_response(payload)
+
+
+@router.get("/doctors/{doctor_id}/history", response_model=List[TokenResponse])
+async def get_token_history(
+    doctor_id: uuid.UUID,
+    date: str = None,
+    service: AllocationService = Depends(get_allocation_service),
+):
+    """Get all tokens of a doctor for a date, including archived ones."""
+    try:
+        tokens = service.get_token_history(doctor_id, date)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return [TokenResponse.model_validate(t) for t in tokens]
 
 
 @router.get("/slots/{doctor_id}", response_model=List[SlotResponse])
 async def get_slots_for_doctor(
-    doctor_id: str, service: AllocationService = Depends(get_allocation_service)
+    doctor_id: uuid.UUID, service: AllocationService = Depends(get_allocation_service)
 ):
     """Get slots for a doctor."""
     slots = service.get_slots_for_doctor(doctor_id)
@@ -82,16 +295,105 @@ async def get_slots_for_doctor(
 
 @router.get("/slots", response_model=List[SlotResponse])
 async def get_all_slots_for_date(
-    date: str = None, service: AllocationService = Depends(get_allocation_service)
+    date: str = None,
+    fields: Optional[str] = None,
+    since: Optional[str] = None,
+    accept_encoding: Optional[str] = Header(None),
 ):
-    """Get all slots, optionally filtered by date."""
-    slots = service.get_all_slots_for_date(date)
-    return [SlotResponse.model_validate(s) for s in slots]
+    """Get all slots, optionally filtered by date, or those changed since."""
+    request_date = parse_date(date)
+    selected = parse_fields(fields, SLOT_FIELDS)
+    cursor = parse_since(since)
+    gzip = accepts_gzip(accept_encoding)
+    if cursor is None:
+        view = read_model.slots
+        payload = await run_in_threadpool(view, request_date, selected, gzip)
+    else:
+        view = read_model.slot_changes
+        payload = await run_in_threadpool(view, request_date, cursor, selected, gzip)
+    return payload_response(payload)
+
+
+@router.get("/availability", response_model=List[SlotAvailability])
+async def get_availability(
+    date: str = None,
+    fields: Optional[str] = None,
+    accept_encoding: Optional[str] = Header(None),
+):
+    """Free seats per slot, optionally filtered by date, from the read model."""
+    request_date = parse_date(date)
+    selected = parse_fields(fields, AVAILABILITY_FIELDS)
+    gzip = accepts_gzip(accept_encoding)
+    view = read_model.availability
+    return payload_response(
+        await run_in_threadpool(view, request_date, selected, gzip)
+    )
+
 
-@router.get("/doctors", response_model=List[Doctor])
+@router.get("/doctors", response_model=List[DoctorResponse])
 async def get_all_doctors(
+    specialization: Optional[str] = None,
     service: AllocationService = Depends(get_allocation_service),
 ):
-    """Get all doctors."""
-    doctors = service.get_all_doctors()
-    return [Doctor.model_validate(d) for d in doctors]
+    """Get all doctors, or those of a specialization."""
+    doctors = service.get_all_doctors(specialization)
+    return [DoctorResponse.model_validate(d) for d in doctors]
+
+
+@router.get("/analytics", response_model=AnalyticsResponse)
+async def get_analytics(
+    start: str = None,
+    end: str = None,
+    service=Depends(get_analytics_service),
+):
+    """Utilization per doctor, slot and source, default the last 30 days."""
+    try:
+        end_date = (
+            datetime.strptime(end, "%Y-%m-%d").date()
+            if end
+            else datetime.now(UTC).date()
+        )
+        start_date = (
+            datetime.strptime(start, "%Y-%m-%d").date()
+            if start
+            else end_date - timedelta(days=29)
+        )
+    except ValueError:
+        raise HTTPException(
+            status_code=400, detail="Invalid date format. Use YYYY-MM-DD."
+        )
+    if start_date > end_date:
+        raise HTTPException(status_code=400, detail="start must not be after end")
+    # NumPy over every token of the range, seconds with a cold cache
+    return await run_in_threadpool(service.utilization, start_date, end_date)
+
+
+@router.get("/admission", response_model=AdmissionStats)
+async def get_admission_stats():
+    """In-flight allocations, queue depths and shed counts per source."""
+    return admission_controller.stats()
+
+
+@router.get("/metadata_cache", response_model=MetadataCacheStats)
+async def get_metadata_cache_stats():
+    """Hit ratio of the doctor and slot metadata cache."""
+    return metadata_cache.stats()
+
+
+@router.get("/contention", response_model=ContentionReport)
+async def get_contention(top: int = Query(10, ge=1, le=100), reset: bool = False):
+    """Slots and doctors losing the most time on slot counter updates."""
+    report = contention.report(top)
+    if reset:
+        contention.reset()
+    return report
+
+
+@router.get("/traces", response_model=List[DecisionTraceResponse])
+async def get_traces(
+    token_id: Optional[uuid.UUID] = None,
+    doctor_id: Optional[uuid.UUID] = None,
+    limit: int = Query(50, ge=1, le=1000),
+):
+    """Recent allocation decisions involving a token and/or a doctor."""
+    return tracer.find(token_id, doctor_id, limit)
@@ -6,15 +6,52 @@ from datetime import datetime, UTC
 import enum
 import uuid
 
-from sqlalchemy import Column, DateTime, Enum, ForeignKey, Integer, String, Time
+from sqlalchemy import (
+    DDL,
+    Column,
+    DateTime,
+    Enum,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    String,
+    Text,
+    Time,
+    event,
+)
+from sqlalchemy.types import TypeDecorator
 
-from app.db import Base, engine
+from app import clock
+from app.db import Base
 from app.models import TokenSource, TokenStatus
 
 
+class BinaryUUID(TypeDecorator):
+    """
+    UUID stored as 16 raw bytes instead of a 36-char string.
+    Accepts uuid.UUID or its string form, always returns uuid.UUID.
+    """
+
+    impl = LargeBinary(16)
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if not isinstance(value, uuid.UUID):
+            value = uuid.UUID(str(value))
+        return value.bytes
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return uuid.UUID(bytes=value)
+
+
 class Doctor(Base):
     __tablename__ = "doctors"
-    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = Column(BinaryUUID, primary_key=True, default=uuid.uuid4)
     name = Column(String, nullable=False)
     specialization = Column(String, nullable=False)
     created_at = Column(DateTime, nullable=False, default=lambda: datetime.now(UTC))
@@ -28,40 +65,105 @@ class Doctor(Base):
 
 class Slot(Base):
     __tablename__ = "slots"
+    __table_args__ = (
+        # Covers the earliest-available-slot search: a doctor's slots in
+        # (date, start_time) order with the columns of the capacity check
+        Index(
+            "ix_slots_doctor_date_start",
+            "doctor_id",
+            "date",
+            "start_time",
+            "capacity",
+            "active_count",
+            "emergency_count",
+            "id",
+        ),
+    )
 
-    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    doctor_id = Column(String(36), ForeignKey("doctors.id"), nullable=False)
+    id = Column(BinaryUUID, primary_key=True, default=uuid.uuid4)
+    doctor_id = Column(BinaryUUID, ForeignKey("doctors.id"), nullable=False)
     start_time = Column(Time, nullable=False)
     end_time = Column(Time, nullable=False)
     date = Column(DateTime, nullable=False)
     capacity = Column(Integer, nullable=False, default=0)
+    # Denormalized counters, only changed through SlotCRUD compare-and-swap updates
+    active_count = Column(Integer, nullable=False, default=0)
+    emergency_count = Column(Integer, nullable=False, default=0)
+    version = Column(Integer, nullable=False, default=0)
     created_at = Column(DateTime, nullable=False, default=lambda: datetime.now(UTC))
+    # from the allocation clock like the tokens', since= cursors are read on it
     updated_at = Column(
-        DateTime,
-        nullable=False,
-        default=lambda: datetime.now(UTC),
-        onupdate=lambda: datetime.now(UTC),
+        DateTime, nullable=False, default=clock.now, onupdate=clock.now
     )
 
 
 class Token(Base):
     __tablename__ = "tokens"
+    __table_args__ = (
+        # Active tokens of a slot by priority, answers "is anyone preemptible"
+        Index("ix_tokens_slot_status_priority", "slot_id", "status", "priority"),
+    )
 
-    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    doctor_id = Column(String(36), ForeignKey("doctors.id"), nullable=False)
-    slot_id = Column(String(36), ForeignKey("slots.id"), nullable=True)
+    id = Column(BinaryUUID, primary_key=True, default=uuid.uuid4)
+    doctor_id = Column(BinaryUUID, ForeignKey("doctors.id"), nullable=False, index=True)
+    slot_id = Column(BinaryUUID, ForeignKey("slots.id"), nullable=True)
     source = Column(Enum(TokenSource), nullable=False)
     status = Column(Enum(TokenStatus), nullable=False, default=TokenStatus.active)
     priority = Column(Integer)
     patient_name = Column(String, nullable=False)
     patient_contact = Column(String, nullable=False)
-    created_at = Column(DateTime, nullable=False, default=lambda: datetime.now(UTC))
+    # from the allocation clock, so replayed tokens keep their production order
+    created_at = Column(DateTime, nullable=False, default=clock.now)
     updated_at = Column(
-        DateTime,
-        nullable=False,
-        default=lambda: datetime.now(UTC),
-        onupdate=lambda: datetime.now(UTC),
+        DateTime, nullable=False, default=clock.now, onupdate=clock.now
     )
 
 
-Base.metadata.create_all(bind=engine)
+class TokenArchive(Base):
+    """Finished tokens moved out of `tokens` by the archival job."""
+
+    __tablename__ = "tokens_archive"
+
+    id = Column(BinaryUUID, primary_key=True)
+    doctor_id = Column(BinaryUUID, nullable=False, index=True)
+    slot_id = Column(BinaryUUID, nullable=True)
+    source = Column(Enum(TokenSource), nullable=False)
+    status = Column(Enum(TokenStatus), nullable=False)
+    priority = Column(Integer)
+    patient_name = Column(String, nullable=False)
+    patient_contact = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False, index=True)
+    updated_at = Column(DateTime, nullable=False)
+    archived_at = Column(DateTime, nullable=False, default=lambda: datetime.now(UTC))
+
+
+class IdempotencyRecord(Base):
+    __tablename__ = "idempotency_keys"
+
+    key = Column(String(255), primary_key=True)
+    request_hash = Column(String(64), nullable=False)
+    # NULL while the original request is still being processed
+    response = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=False, default=lambda: datetime.now(UTC))
+
+
+# kinds of metadata with a change version, see app/crud/metadata.py
+METADATA_KINDS = ("doctors", "slots")
+
+
+class MetadataVersion(Base):
+    __tablename__ = "metadata_versions"
+
+    name = Column(String(32), primary_key=True)
+    # bumped in every transaction that changes metadata of this kind
+    version = Column(Integer, nullable=False, default=0)
+
+
+event.listen(
+    MetadataVersion.__table__,
+    "after_create",
+    DDL(
+        "INSERT INTO metadata_versions (name, version) VALUES "
+        + ", ".join(f"('{kind}', 0)" for kind in METADATA_KINDS)
+    ),
+)
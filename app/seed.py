@@ -1,66 +1,140 @@
-from datetime import datetime, time, timedelta, UTC
-from typing import List
+"""
+Seed doctors and slots.
+
+    python -m app.seed [--doctors 6] [--days 30 --slots-per-day 8] [--capacity 10]
+
+By default six doctors get four slots each, on four consecutive days starting
+today, an hour later every day. With --days, every doctor gets
+--slots-per-day hourly slots from 9:00 on each day, for large simulations.
+Slots are added in chunks of --chunk-size with a commit and an empty session
+after each (app/batch.py), so memory does not grow with the number of slots.
+"""
+
+import argparse
+from datetime import date, datetime, time, timedelta
+from itertools import product
+from typing import Iterator, List, Optional, Tuple
+from app.batch import MemoryProfile, chunks, end_chunk
 from app.crud.doctor import DoctorCRUD
 from app.crud.slot import SlotCRUD
-from app.db import SessionLocal
+from app.db import SessionLocal, init_db
 from app.models import SlotCreate
 from app.schemas import Doctor
 
+DOCTORS = [
+    ("Dr. Shukla", "Cardiology"),
+    ("Dr. Verma", "Dermatology"),
+    ("Dr. Iyer", "Orthopedics"),
+    ("Dr. Rao", "Pediatrics"),
+    ("Dr. Nair", "Neurology"),
+    ("Dr. Arjuna", "Gynecology"),
+]
+
 
-def seed_data():
+def seed_data(
+    doctors: int = len(DOCTORS),
+    days: Optional[int] = None,
+    slots_per_day: int = 4,
+    capacity: int = 10,
+    chunk_size: int = 1000,
+    profile: Optional[MemoryProfile] = None,
+):
+    init_db()
     db = SessionLocal()
     try:
-        DoctorCRUD.set_db_session(db)
-        SlotCRUD.set_db_session(db)
-
-        doctor_crud = DoctorCRUD()
-        slot_crud = SlotCRUD()
-
-        doctors = seed_doctors(doctor_crud)
-        seed_slots(slot_crud, doctors)
+        created = seed_doctors(DoctorCRUD(db), doctors)
+        seed_slots(
+            SlotCRUD(db), created, days, slots_per_day, capacity, chunk_size, profile
+        )
         print("Seed data created successfully")
 
     finally:
         db.close()
 
 
-def seed_doctors(doctor_crud: DoctorCRUD):
-
-    # Create doctors
-    doctors = [
-        doctor_crud.create_doctor("Dr. Shukla", "Cardiology"),
-        doctor_crud.create_doctor("Dr. Verma", "Dermatology"),
-        doctor_crud.create_doctor("Dr. Iyer", "Orthopedics"),
-        doctor_crud.create_doctor("Dr. Rao", "Pediatrics"),
-        doctor_crud.create_doctor("Dr. Nair", "Neurology"),
-        doctor_crud.create_doctor("Dr. Arjuna", "Gynecology"),
-    ]
+def seed_doctors(doctor_crud: DoctorCRUD, count: int = len(DOCTORS)) -> List[Doctor]:
+    # Create doctors, past the named ones in turns of their specializations
+    doctors = []
+    for n in range(count):
+        if n < len(DOCTORS):
+            name, specialization = DOCTORS[n]
+        else:
+            name, specialization = f"Dr. Seed {n}", DOCTORS[n % len(DOCTORS)][1]
+        doctors.append(doctor_crud.create_doctor(name, specialization))
     print(f"Created {len(doctors)} doctors.")
     return doctors
 
 
-def seed_slots(slot_crud: SlotCRUD, doctors: List[Doctor]):
-    # Create slots for today
+def slot_layout(days: Optional[int], slots_per_day: int) -> List[Tuple[int, int]]:
+    """(day offset, hour offset) of each doctor's slots."""
+    if days is None:
+        return [(i, i) for i in range(4)]
+    return list(product(range(days), range(slots_per_day)))
+
+
+def seed_slots(
+    slot_crud: SlotCRUD,
+    doctors: List[Doctor],
+    days: Optional[int] = None,
+    slots_per_day: int = 4,
+    capacity: int = 10,
+    chunk_size: int = 1000,
+    profile: Optional[MemoryProfile] = None,
+):
     base_time = time(9, 0)  # 9 AM
+    today = datetime.today().date()
+    # read now, every chunk's commit expires the doctors
+    doctor_ids = [doctor.id for doctor in doctors]
 
-    for doctor in doctors:
-        for i in range(4):  # 4 slots per doctor
-            start = (
-                datetime.combine(datetime.today(), base_time) + timedelta(hours=i)
-            ).time()
-            end = (
-                datetime.combine(datetime.today(), start) + timedelta(hours=1)
-            ).time()
-            slot_crud.create_slot(
-                slot_data=SlotCreate(
-                    capacity=10,
-                    doctor_id=doctor.id,
+    def slots() -> Iterator[Tuple[SlotCreate, date]]:
+        for doctor_id in doctor_ids:
+            for day, hour in slot_layout(days, slots_per_day):
+                start = (
+                    datetime.combine(today, base_time) + timedelta(hours=hour)
+                ).time()
+                end = (datetime.combine(today, start) + timedelta(hours=1)).time()
+                slot = SlotCreate(
+                    capacity=capacity,
+                    doctor_id=doctor_id,
                     start_time=start,
                     end_time=end,
-                ),
-                slot_date=datetime.today().date() + timedelta(days=i),
-            )
-    print(f"Created slots for {len(doctors)} doctors.")
+                )
+                yield slot, today + timedelta(days=day)
+
+    created = 0
+    for chunk in chunks(slots(), chunk_size):
+        slot_crud.add_slots(chunk)
+        end_chunk(slot_crud.db_session)
+        created += len(chunk)
+        if profile is not None:
+            print(f"  {created} slots, {profile.sample()}")
+    print(f"Created {created} slots for {len(doctor_ids)} doctors.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--doctors", type=int, default=len(DOCTORS))
+    parser.add_argument("--days", type=int)
+    parser.add_argument("--slots-per-day", type=int, default=4)
+    parser.add_argument("--capacity", type=int, default=10)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument(
+        "--profile", action="store_true", help="trace memory with tracemalloc"
+    )
+    args = parser.parse_args()
+
+    with MemoryProfile(trace=args.profile) as profile:
+        seed_data(
+            args.doctors,
+            args.days,
+            args.slots_per_day,
+            args.capacity,
+            args.chunk_size,
+            profile if args.profile else None,
+        )
+        if args.profile:
+            print(profile.report())
+
 
 if __name__ == "__main__":
-    seed_data()
+    main()
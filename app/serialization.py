@@ -0,0 +1,147 @@
+"""
+Fast JSON path for list routes.
+
+Rows are selected as plain column tuples and serialized in one pass by a
+pydantic TypeAdapter over a TypedDict that mirrors the response model, so
+there is no ORM hydration, no per-item model_validate and no second
+response_model validation by FastAPI.
+
+Payload trimming and compression:
+- `fields=` keeps the listed fields of every item (`id` always), through an
+  adapter over just those fields
+- gzip when the client accepts it and the body has at least
+  `compression_minimum_size` bytes. The read model compresses a snapshot once
+  and serves the compressed bytes to every poll until it changes
+- `since=` asks for the items changed at or after a cursor. Every list
+  response carries the cursor of its data in `X-Since`, to pass back as the
+  next since=. Changes are read at or after it, so an item may come twice,
+  clients merge items by id
+"""
+
+import gzip
+from datetime import datetime
+from functools import lru_cache
+from typing import Iterable, List, NamedTuple, Optional, Sequence, Tuple, Type
+from fastapi import Response
+from pydantic import BaseModel, TypeAdapter
+from typing_extensions import TypedDict
+from app.models import SlotAvailability, SlotResponse, TokenResponse
+from app.settings import settings
+
+
+class Payload(NamedTuple):
+    body: bytes
+    # "gzip", or None for plain JSON
+    encoding: Optional[str]
+    # naive UTC, the since= of the changes after this payload
+    cursor: datetime
+
+
+@lru_cache(maxsize=None)
+def list_adapter(
+    model: Type[BaseModel], names: Optional[Tuple[str, ...]] = None
+) -> Tuple[Tuple[str, ...], TypeAdapter]:
+    """
+    Field names of a response model and an adapter serializing lists of it,
+    or of only the given fields of it.
+    """
+    fields = {
+        name: field.annotation
+        for name, field in model.model_fields.items()
+        if names is None or name in names
+    }
+    row = TypedDict(f"{model.__name__}Row", fields)
+    return tuple(fields), TypeAdapter(List[row])
+
+
+TOKEN_FIELDS, TOKEN_LIST = list_adapter(TokenResponse)
+SLOT_FIELDS, SLOT_LIST = list_adapter(SlotResponse)
+AVAILABILITY_FIELDS, AVAILABILITY_LIST = list_adapter(SlotAvailability)
+
+
+def dump_list(
+    adapter: TypeAdapter, fields: Sequence[str], rows: Iterable[tuple]
+) -> bytes:
+    """Serialize column tuples ordered like fields to JSON bytes."""
+    return adapter.dump_json([dict(zip(fields, row)) for row in rows])
+
+
+def dump_fields(
+    model: Type[BaseModel], fields: Sequence[str], rows: Sequence[tuple]
+) -> bytes:
+    """Serialize full column tuples of a model, keeping the given fields."""
+    all_fields, adapter = list_adapter(model)
+    if tuple(fields) != all_fields:
+        indices = [all_fields.index(name) for name in fields]
+        rows = [[row[i] for i in indices] for row in rows]
+        adapter = list_adapter(model, tuple(fields))[1]
+    return dump_list(adapter, fields, rows)
+
+
+def select_fields(requested: Optional[str], fields: Tuple[str, ...]) -> Tuple[str, ...]:
+    """
+    The fields of a comma separated `fields=` value, in response order, with
+    `id`. All fields if none are asked for, ValueError on unknown ones.
+    """
+    if not requested:
+        return fields
+    names = {name.strip() for name in requested.split(",")} - {""}
+    unknown = names.difference(fields)
+    if unknown:
+        raise ValueError(
+            f"Unknown fields: {', '.join(sorted(unknown))}. "
+            f"Use {', '.join(fields)}."
+        )
+    names.add("id")
+    return tuple(name for name in fields if name in names)
+
+
+def accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    """
+    Whether an Accept-Encoding header takes gzip: its own entry if it has one,
+    else `*`, q=0 refusing it.
+    """
+    if not settings.compression_enabled or not accept_encoding:
+        return False
+    qualities = {}
+    for coding in accept_encoding.lower().split(","):
+        name, *params = (part.strip() for part in coding.split(";"))
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                quality = _quality(value.strip())
+        qualities[name] = quality
+    return qualities.get("gzip", qualities.get("*", 0)) > 0
+
+
+def _quality(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        return 1.0
+
+
+def encode(body: bytes, compress: bool) -> Tuple[bytes, Optional[str]]:
+    """A body gzipped if asked and large enough, and its Content-Encoding."""
+    if compress and len(body) >= settings.compression_minimum_size:
+        return gzip.compress(body, settings.compression_level, mtime=0), "gzip"
+    return body, None
+
+
+def format_cursor(cursor: datetime) -> str:
+    return cursor.isoformat(timespec="microseconds") + "Z"
+
+
+def json_response(content: bytes) -> Response:
+    return Response(content=content, media_type="application/json")
+
+
+def payload_response(payload: Payload) -> Response:
+    headers = {"Vary": "Accept-Encoding", "X-Since": format_cursor(payload.cursor)}
+    if payload.encoding:
+        headers["Content-Encoding"] = payload.encoding
+    return Response(
+        content=payload.body, media_type="application/json", headers=headers
+    )
+
@@ -1,11 +1,70 @@
 from enum import IntEnum
+from typing import Dict, List, Optional
 from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
     database_url: str = "sqlite:///./opd.db"
     no_show_timeout_minutes: int = 15
+    # allocation rules, see app/policies.py: a policy name, and minutes of
+    # waiting that improve a displaced token by one priority level (0 = off)
+    allocation_policy: str = "default"
     allow_preemption: bool = True
     max_emergency_overflow: int = 2
+    policy_aging_minutes: int = 0
+    max_search_days: int = 90
+    specialization_strategy: str = "earliest"
+    specialization_index_ttl_seconds: int = 60
+    specialization_index_days: int = 14
+    create_schema_on_startup: bool = True
+    slot_update_max_retries: int = 10
+    archive_after_days: int = 1
+    archive_batch_size: int = 1000
+    archive_interval_minutes: int = 0
+    idempotency_cache_size: int = 10000
+    idempotency_ttl_seconds: int = 24 * 60 * 60
+    # how long a reservation whose request never finished blocks retries
+    idempotency_lease_seconds: int = 60
+    idempotency_purge_interval_minutes: int = 60
+    admission_max_in_flight: int = 8
+    admission_queue_size: int = 200
+    # requests per second by token source, missing or 0 = unlimited
+    admission_rate_limits: Dict[str, float] = {"online": 50.0, "walk_in": 50.0}
+    # how stale the polled views may be after a change in this process, and
+    # without one (changes by other processes); the most views and slots held
+    read_model_staleness_ms: int = 1000
+    read_model_max_age_ms: int = 5000
+    read_model_max_snapshots: int = 10000
+    read_model_max_slots: int = 100000
+    # how long doctor and slot changes by other processes may go unnoticed
+    # by the metadata cache, and the most slots it holds
+    metadata_cache_enabled: bool = True
+    metadata_cache_check_ms: int = 1000
+    metadata_cache_max_slots: int = 100000
+    # how long queue positions may miss changes made by other processes, the
+    # most queues held, and the longest gap between serves taken for a
+    # consultation rather than a break
+    queue_positions_max_age_ms: int = 5000
+    queue_positions_max_queues: int = 10000
+    queue_consult_max_minutes: int = 60
+    # gzip for clients that accept it, on responses of at least the minimum
+    # size; and how far `since=` cursors stay behind the clock, longer than
+    # any write transaction so none commits behind a cursor
+    compression_enabled: bool = True
+    compression_minimum_size: int = 1000
+    compression_level: int = 6
+    delta_cursor_lag_ms: int = 2000
+    # decision traces kept in memory, share of requests traced, optional
+    # JSON lines file every trace is appended to
+    trace_buffer_size: int = 10000
+    trace_sample_rate: float = 0.1
+    trace_file: Optional[str] = None
+    # sharded deployment (app/sharding.py): base URLs of the shard servers in
+    # shard order, read by the router, and token ids it remembers the shard of
+    shard_urls: List[str] = []
+    shard_router_token_cache_size: int = 100000
+    shard_request_timeout_seconds: float = 30.0
+    # request stream written for app.replay, .gz compresses (default off)
+    capture_file: Optional[str] = None
     version: str = "1.0.1"
 
     class Config:
@@ -0,0 +1,301 @@
+"""
+Router of the doctor-sharded deployment, see app/sharding.py.
+
+    SHARD_URLS='["http://127.0.0.1:8001", ...]' uvicorn app.shard_router:server
+
+Clients talk to the router as to a single server. It forwards each request:
+- doctor in the path or body (allocation by doctor, reschedule, waiting list,
+  history, slots of a doctor): to the doctor's shard
+- token in the path: to the shard that allocated it, remembered from the
+  responses that went through this router, else to every shard at once; only
+  the owner knows the token
+- explicit slot without a doctor: to every shard, only the owner has the slot
+- specialization: shard by shard, starting at one picked by the patient's
+  contact, until one has a seat. The earliest slot wins within a shard, not
+  across shards
+- bulk serve and no-show: to every shard, each updates the tokens it owns
+- doctor, slot, availability and trace lists: to every shard, merged
+- per-process stats (admission, contention, metadata cache, analytics): to the
+  shard given by ?shard=, default 0
+Idempotency-Key is passed on, and works as long as a retry goes to the same
+shard, which it does for everything but explicit slots. Shards answer the
+router uncompressed, the router compresses for its clients; the X-Since of a
+merged list is the earliest of the shards'.
+"""
+
+import asyncio
+import json
+import re
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+import fastapi
+import httpx
+from fastapi import Request, Response
+from starlette.middleware.gzip import GZipMiddleware
+from app.settings import settings
+from app.sharding import HashRing
+
+UUID = r"[0-9a-fA-F]{8}-(?:[0-9a-fA-F]{4}-){3}[0-9a-fA-F]{12}"
+DOCTOR_PATH = re.compile(rf"^/allocation/(?:doctors|slots)/(?P<id>{UUID})(?:/|$)")
+TOKEN_PATH = re.compile(rf"^/allocation/tokens/(?P<id>{UUID})(?:/|$)")
+BULK_PATHS = {"/allocation/tokens/serve", "/allocation/tokens/no_show"}
+# merged lists: sort key of an item, reversed or not. Slot lists have no
+# date, a single shard orders them by start time too.
+MERGED_LISTS = {
+    "/allocation/doctors": None,
+    "/allocation/slots": (lambda item: item["start_time"], False),
+    "/allocation/availability": (
+        lambda item: (item["date"], item["start_time"]),
+        False,
+    ),
+    "/allocation/traces": (lambda item: item["started_at"], True),
+}
+PER_SHARD_PATHS = {
+    "/allocation/admission",
+    "/allocation/contention",
+    "/allocation/metadata_cache",
+    "/allocation/analytics",
+}
+# response headers worth passing on
+FORWARDED_HEADERS = ("content-type", "retry-after", "x-since")
+
+
+class ShardRouter:
+    def __init__(self, shard_urls: List[str], token_cache_size: int):
+        self.shard_urls = shard_urls
+        self.ring = HashRing(len(shard_urls)) if shard_urls else None
+        self.token_cache_size = token_cache_size
+        # token id -> shard, least recently used first
+        self._token_shards: OrderedDict = OrderedDict()
+        self.client: Optional[httpx.AsyncClient] = None
+
+    async def route(self, request: Request) -> Response:
+        path = request.url.path
+        body = await request.body()
+
+        match = DOCTOR_PATH.match(path)
+        if match:
+            return await self._one(self.ring.shard(match["id"]), request, body)
+        match = TOKEN_PATH.match(path)
+        if match:
+            return await self._token(match["id"].lower(), request, body)
+        if path == "/allocation/tokens" and request.method == "POST":
+            return await self._allocate(request, body)
+        if path == "/allocation/reschedule":
+            doctor_id = _json(body).get("doctor_id")
+            return await self._one(self.ring.shard(doctor_id), request, body)
+        if path in BULK_PATHS:
+            return await self._bulk(request, body)
+        if path in MERGED_LISTS and request.method == "GET":
+            return await self._merged(request, MERGED_LISTS[path])
+        if path in PER_SHARD_PATHS:
+            shard = request.query_params.get("shard", "0")
+            if not shard.isdigit() or int(shard) >= len(self.shard_urls):
+                return _error(400, f"shard must be 0 to {len(self.shard_urls) - 1}")
+            return await self._one(int(shard), request, body)
+        return _error(404, "Not Found")
+
+    # ---------- Routing ----------
+
+    async def _allocate(self, request: Request, body: bytes) -> Response:
+        token_request = _json(body)
+        if token_request.get("doctor_id"):
+            shard = self.ring.shard(token_request["doctor_id"])
+            return self._learn(await self._one(shard, request, body), shard)
+        if token_request.get("slot_id"):
+            return await self._first_known(request, body, "Slot not found")
+        # specialization: the shards in turn, from one spread by patient
+        start = self.ring.shard(str(token_request.get("patient_contact")))
+        response = None
+        for n in range(len(self.shard_urls)):
+            shard = (start + n) % len(self.shard_urls)
+            response = await self._one(shard, request, body)
+            if response.status_code != 400:
+                return self._learn(response, shard)
+        return response
+
+    async def _token(self, token_id: str, request: Request, body: bytes):
+        shard = self._token_shards.get(token_id)
+        if shard is not None:
+            self._token_shards.move_to_end(token_id)
+            return await self._one(shard, request, body)
+        return await self._first_known(request, body, None, token_id)
+
+    async def _first_known(
+        self,
+        request: Request,
+        body: bytes,
+        unknown_detail: Optional[str],
+        token_id: Optional[str] = None,
+    ) -> Response:
+        """
+        Send to every shard, answer with the one that knows the slot or
+        token: not a 404 and not a 400 with unknown_detail.
+        """
+        responses = await self._all(request, body)
+        for shard, response in enumerate(responses):
+            unknown = response.status_code == 404 or (
+                response.status_code == 400
+                and _json(response.body).get("detail") == unknown_detail
+            )
+            if not unknown:
+                if token_id:
+                    self._remember(token_id, shard)
+                return self._learn(response, shard)
+        return responses[0]
+
+    async def _bulk(self, request: Request, body: bytes) -> Response:
+        responses = await self._all(request, body)
+        updated = []
+        for shard, response in enumerate(responses):
+            if response.status_code != 200:
+                return response
+            for token_id in _json(response.body)["updated"]:
+                self._remember(token_id, shard)
+                updated.append(token_id)
+        done = set(updated)
+        token_ids = _json(body).get("token_ids", [])
+        return _json_response(
+            {"updated": updated, "skipped": [t for t in token_ids if t not in done]}
+        )
+
+    async def _merged(self, request: Request, order) -> Response:
+        responses = await self._all(request, b"")
+        items = []
+        for response in responses:
+            if response.status_code != 200:
+                return response
+            items.extend(_json(response.body))
+        if order is not None:
+            key, reverse = order
+            try:
+                items.sort(key=key, reverse=reverse)
+            except KeyError:
+                pass  # fields= left the sort key out, shard by shard
+        if "limit" in request.query_params:
+            items = items[: int(request.query_params["limit"])]
+        merged = _json_response(items)
+        cursors = [r.headers["x-since"] for r in responses if "x-since" in r.headers]
+        if cursors:
+            # ISO timestamps of one format sort as text
+            merged.headers["X-Since"] = min(cursors)
+        return merged
+
+    # ---------- Forwarding ----------
+
+    async def _one(self, shard: int, request: Request, body: bytes) -> Response:
+        url = self.shard_urls[shard] + request.url.path
+        params = [(k, v) for k, v in request.query_params.multi_items() if k != "shard"]
+        headers = {
+            name: value
+            for name, value in request.headers.items()
+            if name in ("content-type", "idempotency-key")
+        }
+        try:
+            upstream = await self.client.request(
+                request.method, url, params=params, content=body, headers=headers
+            )
+        except httpx.HTTPError as e:
+            return _error(503, f"Shard {shard} unavailable: {e}")
+        return Response(
+            content=upstream.content,
+            status_code=upstream.status_code,
+            headers={
+                name: upstream.headers[name]
+                for name in FORWARDED_HEADERS
+                if name in upstream.headers
+            },
+        )
+
+    async def _all(self, request: Request, body: bytes) -> List[Response]:
+        return await asyncio.gather(
+            *[self._one(shard, request, body) for shard in range(len(self.shard_urls))]
+        )
+
+    def _learn(self, response: Response, shard: int) -> Response:
+        """Remember the shard of a token in a successful response."""
+        if response.status_code == 200:
+            token_id = _json(response.body).get("id")
+            if token_id:
+                self._remember(token_id, shard)
+        return response
+
+    def _remember(self, token_id: str, shard: int) -> None:
+        self._token_shards[token_id] = shard
+        self._token_shards.move_to_end(token_id)
+        if len(self._token_shards) > self.token_cache_size:
+            self._token_shards.popitem(last=False)
+
+    async def health(self) -> Dict:
+        responses = await asyncio.gather(
+            *[self.client.get(f"{url}/health") for url in self.shard_urls],
+            return_exceptions=True,
+        )
+        healthy = [
+            not isinstance(r, Exception) and r.status_code == 200 for r in responses
+        ]
+        return {"shards": len(healthy), "healthy": sum(healthy)}
+
+
+def _json(body: bytes):
+    try:
+        value = json.loads(body) if body else {}
+    except ValueError:
+        return {}
+    return value
+
+
+def _json_response(value) -> Response:
+    return Response(content=json.dumps(value), media_type="application/json")
+
+
+def _error(status_code: int, detail: str) -> Response:
+    return Response(
+        content=json.dumps({"detail": detail}),
+        status_code=status_code,
+        media_type="application/json",
+    )
+
+
+shard_router = ShardRouter(
+    settings.shard_urls, settings.shard_router_token_cache_size
+)
+
+
+@asynccontextmanager
+async def lifespan(app: fastapi.FastAPI):
+    if not shard_router.shard_urls:
+        raise RuntimeError("shard_urls is empty, set SHARD_URLS")
+    shard_router.client = httpx.AsyncClient(
+        headers={"Accept-Encoding": "identity"},
+        timeout=settings.shard_request_timeout_seconds,
+        limits=httpx.Limits(max_connections=None, max_keepalive_connections=100),
+    )
+    yield
+    await shard_router.client.aclose()
+
+
+server = fastapi.FastAPI(version=settings.version, lifespan=lifespan)
+if settings.compression_enabled:
+    server.add_middleware(
+        GZipMiddleware,
+        minimum_size=settings.compression_minimum_size,
+        compresslevel=settings.compression_level,
+    )
+
+
+@server.get("/health")
+async def health_check():
+    health = await shard_router.health()
+    status = 200 if health["healthy"] == health["shards"] else 503
+    return Response(
+        content=json.dumps({"status": status, **health}),
+        status_code=status,
+        media_type="application/json",
+    )
+
+
+@server.api_route("/allocation/{path:path}", methods=["GET", "POST", "PUT"])
+async def forward(request: Request):
+    return await shard_router.route(request)
@@ -0,0 +1,222 @@
+"""
+Doctor-sharded deployment: one worker process per shard, each with its own
+database, behind a router process (app/shard_router.py).
+
+    python -m app.sharding split opd.db --shards 4 [--dir shards]
+    python -m app.sharding serve --shards 4 [--dir shards] [--port 8000]
+
+Doctors are assigned to shards by consistent hashing of their id, and a shard
+holds everything of its doctors: slots, live and archived tokens. Every
+allocation, cancellation and reschedule touches a single doctor's rows (or
+other doctors of the same shard), so shards never wait on each other's write
+locks, and each SQLite file has one writer process. `split` partitions an
+existing database into shard files, `serve` starts a shard server per file on
+the ports after --port and the router on --port.
+
+Shards are named by index, so the same --shards always gives the same
+partition. Changing the count moves about 1/n of the doctors; re-run `split`
+on the merged data, there is no online rebalancing.
+"""
+
+import argparse
+import bisect
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+import httpx
+from sqlalchemy import create_engine, insert, select
+from app.db import Base
+from app.schemas import Doctor, Slot, Token, TokenArchive
+
+# points per shard on the ring, more even out the share of doctors
+RING_REPLICAS = 128
+
+
+def _point(key: bytes) -> int:
+    # stable across processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hashing of doctor ids onto shards 0 .. shards - 1."""
+
+    def __init__(self, shards: int, replicas: int = RING_REPLICAS):
+        if shards < 1:
+            raise ValueError("At least one shard is required")
+        self.shards = shards
+        ring = sorted(
+            (_point(f"shard-{shard}#{replica}".encode()), shard)
+            for shard in range(shards)
+            for replica in range(replicas)
+        )
+        self._points = [point for point, _ in ring]
+        self._owners = [shard for _, shard in ring]
+
+    def shard(self, key) -> int:
+        """Shard owning a doctor id (UUID or its string form) or any string."""
+        if isinstance(key, uuid.UUID):
+            data = key.bytes
+        else:
+            try:
+                data = uuid.UUID(str(key)).bytes
+            except ValueError:
+                data = str(key).encode()
+        index = bisect.bisect(self._points, _point(data))
+        return self._owners[index % len(self._owners)]
+
+
+def shard_database_urls(directory: str, shards: int) -> List[str]:
+    return [f"sqlite:///{Path(directory) / f'shard-{n}.db'}" for n in range(shards)]
+
+
+def split_database(
+    source_url: str, shard_urls: Sequence[str], batch_size: int = 1000
+) -> List[int]:
+    """
+    Copy every doctor, with its slots and tokens, into the database of the
+    shard owning it. Returns the number of doctors per shard.
+    """
+    ring = HashRing(len(shard_urls))
+    source = create_engine(source_url)
+    targets = [create_engine(url) for url in shard_urls]
+    for engine in targets:
+        Base.metadata.create_all(bind=engine)
+
+    doctors = [0] * len(shard_urls)
+    with source.connect() as connection:
+        for table, key in (
+            (Doctor.__table__, "id"),
+            (Slot.__table__, "doctor_id"),
+            (Token.__table__, "doctor_id"),
+            (TokenArchive.__table__, "doctor_id"),
+        ):
+            result = connection.execution_options(yield_per=batch_size).execute(
+                select(table)
+            )
+            for rows in result.mappings().partitions():
+                batches: Dict[int, list] = {}
+                for row in rows:
+                    shard = ring.shard(row[key])
+                    doctors[shard] += table is Doctor.__table__
+                    batches.setdefault(shard, []).append(dict(row))
+                for shard, batch in batches.items():
+                    with targets[shard].begin() as target:
+                        target.execute(insert(table), batch)
+    for engine in (source, *targets):
+        engine.dispose()
+    return doctors
+
+
+class Cluster:
+    """Shard servers and the router, as child processes."""
+
+    def __init__(
+        self,
+        shards: int,
+        directory: str,
+        port: int = 8000,
+        router_workers: int = 1,
+        env: Optional[Dict[str, str]] = None,
+    ):
+        self.router_url = f"http://127.0.0.1:{port}"
+        self.shard_urls = [f"http://127.0.0.1:{port + 1 + n}" for n in range(shards)]
+        base_env = {**os.environ, **(env or {})}
+        self.processes = [
+            _uvicorn(
+                "app.main:server", port + 1 + n, 1, {**base_env, "DATABASE_URL": url}
+            )
+            for n, url in enumerate(shard_database_urls(directory, shards))
+        ]
+        self.processes.append(
+            _uvicorn(
+                "app.shard_router:server",
+                port,
+                router_workers,
+                {**base_env, "SHARD_URLS": json.dumps(self.shard_urls)},
+            )
+        )
+
+    def wait_ready(self, timeout: float = 30) -> None:
+        deadline = time.monotonic() + timeout
+        for url in [*self.shard_urls, self.router_url]:
+            while True:
+                try:
+                    if httpx.get(f"{url}/health").status_code == 200:
+                        break
+                except httpx.HTTPError:
+                    pass
+                if time.monotonic() > deadline:
+                    self.stop()
+                    raise RuntimeError(f"{url} did not start")
+                time.sleep(0.1)
+
+    def stop(self) -> None:
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.wait()
+
+
+def _uvicorn(app: str, port: int, workers: int, env: Dict[str, str]):
+    return subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            app,
+            "--host",
+            "127.0.0.1",
+            "--port",
+            str(port),
+            "--workers",
+            str(workers),
+            "--log-level",
+            "warning",
+        ],
+        env=env,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    commands = parser.add_subparsers(dest="command", required=True)
+    split = commands.add_parser("split", help="partition a database into shards")
+    split.add_argument("database", help="SQLite file or database URL")
+    serve = commands.add_parser("serve", help="start the shards and the router")
+    serve.add_argument("--port", type=int, default=8000)
+    serve.add_argument("--router-workers", type=int, default=1)
+    for command in (split, serve):
+        command.add_argument("--shards", type=int, required=True)
+        command.add_argument("--dir", default="shards")
+    args = parser.parse_args()
+
+    if args.command == "split":
+        Path(args.dir).mkdir(parents=True, exist_ok=True)
+        source = args.database
+        if "://" not in source:
+            source = f"sqlite:///{source}"
+        counts = split_database(source, shard_database_urls(args.dir, args.shards))
+        for shard, count in enumerate(counts):
+            print(f"shard {shard}: {count} doctors")
+        return
+
+    cluster = Cluster(args.shards, args.dir, args.port, args.router_workers)
+    try:
+        cluster.wait_ready()
+        print(f"router on {cluster.router_url}, shards on {cluster.shard_urls}")
+        for process in cluster.processes:
+            process.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        cluster.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,76 +1,117 @@
+"""
+Simulate OPD days, from a handful of tokens to millions.
+
+    python -m app.simulation [--tokens 50] [--days 7] [--chunk-size 1000] [--profile]
+
+Books --tokens tokens for random doctors from random sources over the next
+--days days, cancels and no-shows a share of the active ones, then reports
+every doctor's tokens by status. Runs against the doctors and slots already
+in the database, see app.seed.
+
+The run goes in chunks of --chunk-size (app/batch.py): every chunk ends with
+a commit and an empty session, active tokens are paged by id and the report
+streams the tokens with yield_per, so only counters outlive a chunk and
+memory stays flat however many tokens are simulated. A progress line per
+chunk shows the resident memory; --profile also traces allocations with
+tracemalloc, which makes the run about 3x slower, and ends with the peak
+and the top allocation sites.
+"""
+
+import argparse
 import random
-import time
-from datetime import datetime, timedelta, UTC
-from app.allocation_service import AllocationService
+from collections import Counter
+from datetime import datetime, time, timedelta, UTC
+from typing import Optional
+from sqlalchemy import select
+from app.batch import MemoryProfile, chunks, end_chunk, make_service, stream
 from app.crud.doctor import DoctorCRUD
-from app.crud.slot import SlotCRUD
-from app.crud.token import TokenCRUD
 from app.db import SessionLocal
-from app.models import TokenCreate, TokenSource
+from app.models import TokenCreate, TokenSource, TokenStatus
 from app.schemas import Token
 
 
-def simulate_opd_day():
+def simulate_opd_day(
+    tokens: int = 50,
+    days: int = 7,
+    cancel_rate: float = 0.05,
+    no_show_rate: float = 0.03,
+    chunk_size: int = 1000,
+    seed: Optional[int] = None,
+    profile: Optional[MemoryProfile] = None,
+):
+    rng = random.Random(seed)
+    profile = profile or MemoryProfile()
     db = SessionLocal()
     try:
-        DoctorCRUD.set_db_session(db)
-        SlotCRUD.set_db_session(db)
-        TokenCRUD.set_db_session(db)
+        service = make_service(db)
 
-        service = AllocationService(DoctorCRUD(), SlotCRUD(), TokenCRUD())
-
-        doctors = DoctorCRUD().list_doctors()
+        doctors = DoctorCRUD(db).get_doctor_rows()
+        if not doctors:
+            raise SystemExit("No doctors, run python -m app.seed first")
+        doctor_ids = [doctor.id for doctor in doctors]
         sources = list(TokenSource)
+        today = datetime.now(UTC).date()
 
         print("Starting OPD day simulation...")
 
         # Simulate token requests
-        for i in range(50):  # 50 token requests
-            doctor = random.choice(doctors)
-            source = random.choice(sources)
-            # Random date between today and next 7 days
-            days_ahead = random.randint(0, 7)
-            token_date = datetime.now(UTC) + timedelta(days=days_ahead)
-
-            token_request = TokenCreate(
-                doctor_id=doctor.id,
-                source=source,
-                date=token_date,
-                patient_name=f"Patient {i+1}",
-                patient_contact=f"123456789{i%10}",
+        outcomes = Counter()
+        for chunk in chunks(range(tokens), chunk_size):
+            for i in chunk:
+                # Random date between today and the last simulated day
+                token_date = today + timedelta(days=rng.randrange(days))
+                token_request = TokenCreate(
+                    doctor_id=rng.choice(doctor_ids),
+                    slot_id=None,
+                    source=rng.choice(sources),
+                    date=datetime.combine(token_date, time.min),
+                    patient_name=f"Patient {i+1}",
+                    patient_contact=f"123456789{i%10}",
+                )
+                try:
+                    service.allocate_token(token_request)
+                    outcomes["allocated"] += 1
+                except Exception as e:
+                    outcomes[str(e)] += 1
+            end_chunk(db)
+            done = chunk[-1] + 1
+            print(f"  {done} requests, {_counts(outcomes)}, {profile.sample()}")
+
+        # Simulate some cancellations and no-shows, a page of active tokens
+        # at a time: they change status while the job goes through them
+        released = Counter()
+        after = None
+        while True:
+            page = service.token_crud.get_token_ids_page(
+                TokenStatus.active, after, chunk_size
             )
-
-            token = service.allocate_token(token_request)
-            status = "allocated" if token.status == "active" else "waiting"
-            print(f"Token {token.id} for {source.value} - {status}")
-
-            time.sleep(0.1)  # Simulate time
-
-        # Simulate some cancellations and no-shows
-        active_tokens = []
+            if not page:
+                break
+            after = page[-1]
+            no_shows = []
+            for token_id in page:
+                roll = rng.random()
+                if roll < cancel_rate:
+                    released["cancelled"] += service.cancel_token(token_id)
+                elif roll < cancel_rate + no_show_rate:
+                    no_shows.append(token_id)
+            if no_shows:
+                released["no_show"] += len(service.mark_no_shows(no_shows))
+            end_chunk(db)
+        print(f"Released {_counts(released)}, {profile.sample()}")
+
+        # Tokens by doctor and status, streamed
+        statuses = Counter()
+        query = select(Token.doctor_id, Token.status)
+        for rows in stream(db, query, chunk_size):
+            statuses.update((row.doctor_id, row.status) for row in rows)
         for doctor in doctors:
-            tokens = (
-                db.query(Token)
-                .filter(Token.doctor_id == str(doctor.id), Token.status == "active")
-                .all()
-            )
-            active_tokens.extend(tokens)
-
-        cancel_tokens = random.sample(active_tokens, min(5, len(active_tokens)))
-        for token in cancel_tokens:
-            service.cancel_token(str(token.id))
-            print(f"Cancelled token {token.id}")
-
-        no_show_tokens = random.sample(active_tokens, min(3, len(active_tokens)))
-        for token in no_show_tokens:
-            service.mark_no_show(str(token.id))
-            print(f"No-show token {token.id}")
-
-        # Check waiting lists
-        for doctor in doctors:
-            today = datetime.now(UTC).date()
-            waiting = service.get_waiting_list(str(doctor.id), today)
-            print(f"Doctor {doctor.name} has {len(waiting)} waiting tokens for today")
+            counts = {
+                status.value: statuses[doctor.id, status]
+                for status in TokenStatus
+                if statuses[doctor.id, status]
+            }
+            print(f"Doctor {doctor.name}: {_counts(counts) or 'no tokens'}")
 
         print("Simulation completed")
 
@@ -78,5 +119,35 @@ def simulate_opd_day():
         db.close()
 
 
+def _counts(counts) -> str:
+    return ", ".join(f"{count} {name}" for name, count in counts.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--tokens", type=int, default=50)
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--cancel-rate", type=float, default=0.05)
+    parser.add_argument("--no-show-rate", type=float, default=0.03)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument(
+        "--profile", action="store_true", help="trace memory with tracemalloc"
+    )
+    args = parser.parse_args()
+
+    with MemoryProfile(trace=args.profile) as profile:
+        simulate_opd_day(
+            args.tokens,
+            args.days,
+            args.cancel_rate,
+            args.no_show_rate,
+            args.chunk_size,
+            args.seed,
+            profile,
+        )
+        print(profile.report())
+
+
 if __name__ == "__main__":
-    simulate_opd_day()
+    main()
@@ -0,0 +1,181 @@
+"""
+In-memory index of slots with free seats per specialization.
+
+Each specialization keeps a heap of its open slots ordered by date and then by
+start time or load, depending on `specialization_strategy`, so choosing a
+doctor and slot is a heap peek instead of a scan over every doctor. The heap
+uses lazy deletion: a slot's current key is kept in `keys` and any other
+entry popped off the heap is stale.
+
+The index is only a hint. The service still claims the seat with the slot's
+compare-and-swap, and a failed claim just moves on to the next candidate.
+Slots changed by this process are refreshed through SLOT_CHANGED events.
+Changes made by other processes show up when the heap is rebuilt every
+`specialization_index_ttl_seconds`. Only the next `specialization_index_days`
+days are indexed, later dates fall back to the SQL candidate search. Keys are
+held as raw 16-byte values and only the chosen ones are turned into UUIDs.
+"""
+
+import heapq
+import threading
+import time as clock
+import uuid
+from datetime import date, datetime, time, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+from app import clock as app_clock
+from app.crud.slot import SlotCRUD
+from app.events import SLOT_CHANGED, event_bus
+from app.settings import settings
+
+STRATEGIES = ("earliest", "least_loaded")
+
+# (sort key, slot_id, doctor_id, end_time); the sort key starts with the date
+Entry = Tuple[tuple, bytes, bytes, time]
+
+
+class _Specialization:
+    def __init__(self):
+        self.heap: List[Entry] = []
+        self.keys: Dict[bytes, tuple] = {}
+        # every indexed slot, open or full, so a freed seat is noticed
+        self.members: Set[bytes] = set()
+        self.dirty: Set[bytes] = set()
+        self.loaded_at = 0.0
+
+
+class SpecializationIndex:
+    def __init__(self, strategy: str, ttl_seconds: int, days: int):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown specialization strategy {strategy!r}")
+        self.strategy = strategy
+        self.ttl_seconds = ttl_seconds
+        self.days = days
+        self._specializations: Dict[str, _Specialization] = {}
+        self._slot_specialization: Dict[bytes, str] = {}
+        self._lock = threading.Lock()
+
+    def candidates(
+        self,
+        slot_crud: SlotCRUD,
+        specialization: str,
+        first_date: date,
+        last_date: date,
+        not_started_at: datetime,
+        earliest_time: Optional[time] = None,
+        latest_time: Optional[time] = None,
+        limit: int = 5,
+    ) -> List[Tuple[uuid.UUID, uuid.UUID]]:
+        """Up to `limit` (slot_id, doctor_id) pairs in preference order."""
+        with self._lock:
+            state = self._specializations.get(specialization)
+        if state is None or clock.monotonic() - state.loaded_at > self.ttl_seconds:
+            # built outside the lock so allocations keep using the old heap
+            fresh = self._build(slot_crud, specialization)
+            with self._lock:
+                if state is not None:
+                    fresh.dirty |= state.dirty
+                self._specializations[specialization] = fresh
+                for slot_id in fresh.members:
+                    self._slot_specialization[slot_id] = specialization
+
+        with self._lock:
+            state = self._specializations[specialization]
+            if state.dirty:
+                self._refresh(slot_crud, state)
+            chosen, kept = [], []
+            while state.heap and len(chosen) < limit:
+                entry = heapq.heappop(state.heap)
+                key, slot_id, doctor_id, end_time = entry
+                if state.keys.get(slot_id) != key:
+                    continue  # stale
+                slot_date, start_time = key[0], self._start_time(key)
+                if slot_date < not_started_at.date() or (
+                    slot_date == not_started_at.date()
+                    and start_time <= not_started_at.time()
+                ):
+                    del state.keys[slot_id]  # started, never open again
+                    continue
+                kept.append(entry)
+                if slot_date > last_date:
+                    break
+                if (
+                    slot_date < first_date
+                    or (earliest_time and start_time < earliest_time)
+                    or (latest_time and end_time > latest_time)
+                ):
+                    continue
+                chosen.append(
+                    (uuid.UUID(bytes=slot_id), uuid.UUID(bytes=doctor_id))
+                )
+            for entry in kept:
+                heapq.heappush(state.heap, entry)
+            return chosen
+
+    def mark_dirty(self, slot_id) -> None:
+        """Re-read this slot before the next choice in its specialization."""
+        if not isinstance(slot_id, uuid.UUID):
+            slot_id = uuid.UUID(str(slot_id))
+        with self._lock:
+            specialization = self._slot_specialization.get(slot_id.bytes)
+            if specialization in self._specializations:
+                self._specializations[specialization].dirty.add(slot_id.bytes)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._specializations.clear()
+            self._slot_specialization.clear()
+
+    def _build(self, slot_crud: SlotCRUD, specialization: str) -> _Specialization:
+        state = _Specialization()
+        state.loaded_at = clock.monotonic()
+        today = app_clock.now().date()
+        rows = slot_crud.get_slot_load_rows(
+            specialization=specialization,
+            first_date=today,
+            last_date=today + timedelta(days=self.days - 1),
+        )
+        for row in rows:
+            state.members.add(row.id)
+            key = self._key(row)
+            if key is not None:
+                state.keys[row.id] = key
+                state.heap.append((key, row.id, row.doctor_id, row.end_time))
+        heapq.heapify(state.heap)
+        return state
+
+    def _refresh(self, slot_crud: SlotCRUD, state: _Specialization) -> None:
+        rows = slot_crud.get_slot_load_rows(
+            slot_ids=[uuid.UUID(bytes=slot_id) for slot_id in state.dirty]
+        )
+        state.dirty.clear()
+        for row in rows:
+            key = self._key(row)
+            if key is None:
+                state.keys.pop(row.id, None)
+            elif state.keys.get(row.id) != key:
+                state.keys[row.id] = key
+                heapq.heappush(state.heap, (key, row.id, row.doctor_id, row.end_time))
+
+    def _key(self, row) -> Optional[tuple]:
+        """Sort key of an open slot, None if it has no free seat."""
+        if not row.capacity:
+            return None  # closed
+        seats = row.capacity + min(row.emergency_count, settings.max_emergency_overflow)
+        if row.active_count >= seats:
+            return None
+        slot_date = row.date.date() if isinstance(row.date, datetime) else row.date
+        load = row.active_count / seats
+        if self.strategy == "earliest":
+            return (slot_date, row.start_time, load)
+        return (slot_date, load, row.start_time)
+
+    def _start_time(self, key: tuple) -> time:
+        return key[1] if self.strategy == "earliest" else key[2]
+
+
+specialization_index = SpecializationIndex(
+    strategy=settings.specialization_strategy,
+    ttl_seconds=settings.specialization_index_ttl_seconds,
+    days=settings.specialization_index_days,
+)
+event_bus.subscribe(SLOT_CHANGED, specialization_index.mark_dirty)
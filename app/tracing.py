@@ -0,0 +1,199 @@
+"""
+Decision traces for token allocation.
+
+A sampled allocation, cancellation or no-show records what the service saw and
+did: the candidate slots, the counters and seats of every slot it tried, which
+token it displaced or promoted, and the time of each step since the start.
+Finished traces go to a fixed-size ring buffer, queried by token or doctor
+through GET /allocation/traces, and optionally appended as JSON lines to
+`trace_file` by a background thread.
+
+An unsampled request gets NULL_TRACE, whose methods do nothing, so the service
+calls the trace unconditionally. Step details are stored as passed and only
+converted when a trace is read or written out, without the patient's name
+and contact.
+"""
+
+import json
+import logging
+import queue
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime, UTC
+from typing import Any, Dict, List, Optional
+from pydantic import BaseModel
+from app.capture import PRIVATE_COLUMNS
+from app.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+class Trace:
+    __slots__ = (
+        "tracer",
+        "kind",
+        "request",
+        "doctor_id",
+        "token_ids",
+        "steps",
+        "started_at",
+        "started",
+        "duration_ms",
+        "outcome",
+        "error",
+    )
+
+    def __init__(self, tracer: "DecisionTracer", kind: str, doctor_id, request):
+        self.tracer = tracer
+        self.kind = kind
+        self.request = request
+        self.doctor_id = doctor_id
+        self.token_ids: List = []
+        self.steps: List[tuple] = []
+        self.started_at = datetime.now(UTC)
+        self.started = time.perf_counter()
+        self.duration_ms = 0.0
+        self.outcome: Optional[str] = None
+        self.error: Optional[str] = None
+
+    def step(self, name: str, **detail) -> None:
+        self.steps.append((name, time.perf_counter() - self.started, detail))
+
+    def token(self, token_id, doctor_id=None) -> None:
+        """A token this decision created, displaced or moved."""
+        self.token_ids.append(token_id)
+        if doctor_id is not None:
+            self.doctor_id = doctor_id
+
+    def finish(self, outcome: Optional[str] = None, error: Optional[str] = None):
+        self.duration_ms = (time.perf_counter() - self.started) * 1e3
+        self.outcome = outcome
+        self.error = error
+        self.tracer.record(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        request = self.request
+        if isinstance(request, BaseModel):
+            request = request.model_dump(
+                mode="json", exclude=set(PRIVATE_COLUMNS), exclude_none=True
+            )
+        return {
+            "kind": self.kind,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration_ms, 3),
+            "doctor_id": _as_uuid(self.doctor_id),
+            "token_ids": [_as_uuid(t) for t in self.token_ids],
+            "request": request or {},
+            "steps": [
+                {"name": name, "at_ms": round(at * 1e3, 3), "detail": detail}
+                for name, at, detail in self.steps
+            ],
+            "outcome": self.outcome,
+            "error": self.error,
+        }
+
+
+class _NullTrace:
+    """Stands in for an unsampled request."""
+
+    def step(self, name: str, **detail) -> None:
+        pass
+
+    def token(self, token_id, doctor_id=None) -> None:
+        pass
+
+    def finish(self, outcome: Optional[str] = None, error: Optional[str] = None):
+        pass
+
+
+NULL_TRACE = _NullTrace()
+
+
+class DecisionTracer:
+    def __init__(
+        self, buffer_size: int, sample_rate: float, path: Optional[str] = None
+    ):
+        self.sample_rate = sample_rate
+        self.path = path
+        # deque appends are atomic, the buffer needs no lock
+        self._buffer: deque = deque(maxlen=buffer_size)
+        self._pending: Optional[queue.SimpleQueue] = None
+        self._writer_lock = threading.Lock()
+        self.recorded = 0
+
+    def start(self, kind: str, doctor_id=None, request=None):
+        """A new trace, or NULL_TRACE if this request is not sampled."""
+        if self.sample_rate <= 0 or (
+            self.sample_rate < 1 and random.random() >= self.sample_rate
+        ):
+            return NULL_TRACE
+        return Trace(self, kind, doctor_id, request)
+
+    def record(self, trace: Trace) -> None:
+        self._buffer.append(trace)
+        self.recorded += 1
+        if self.path:
+            self._writer().put(trace)
+
+    def find(
+        self,
+        token_id: Optional[uuid.UUID] = None,
+        doctor_id: Optional[uuid.UUID] = None,
+        limit: int = 50,
+    ) -> List[Dict[str, Any]]:
+        """Newest traces first, involving the token and/or the doctor."""
+        found = []
+        for trace in reversed(list(self._buffer)):
+            if token_id is not None and token_id not in map(
+                _as_uuid, trace.token_ids
+            ):
+                continue
+            if doctor_id is not None and _as_uuid(trace.doctor_id) != doctor_id:
+                continue
+            found.append(trace.to_dict())
+            if len(found) >= limit:
+                break
+        return found
+
+    def clear(self) -> None:
+        self._buffer.clear()
+
+    def _writer(self) -> queue.SimpleQueue:
+        if self._pending is None:
+            with self._writer_lock:
+                if self._pending is None:
+                    pending = queue.SimpleQueue()
+                    threading.Thread(
+                        target=self._write, args=(pending,), daemon=True
+                    ).start()
+                    self._pending = pending
+        return self._pending
+
+    def _write(self, pending: queue.SimpleQueue) -> None:
+        """Append finished traces to the trace file, one JSON object per line."""
+        while True:
+            traces = [pending.get()]
+            while not pending.empty():
+                traces.append(pending.get())
+            try:
+                with open(self.path, "a") as f:
+                    for trace in traces:
+                        f.write(json.dumps(trace.to_dict(), default=str) + "\n")
+            except OSError:
+                logger.exception("Writing decision traces to %s failed", self.path)
+
+
+def _as_uuid(value) -> Optional[uuid.UUID]:
+    if value is None or isinstance(value, uuid.UUID):
+        return value
+    return uuid.UUID(str(value))
+
+
+tracer = DecisionTracer(
+    buffer_size=settings.trace_buffer_size,
+    sample_rate=settings.trace_sample_rate,
+    path=settings.trace_file,
+)